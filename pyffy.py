@@ -1,70 +1,96 @@
 import copy
+import importlib.util
 import sys
 import time
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
+from typing import TYPE_CHECKING, Iterator
 
-import pkg_resources
-
-import pyffyCFA
+import pyffyCatalog
 import pyffyCommon
 import pyffyDB
+import pyffyDigest
 import pyffyExif
 import pyffyIO
-import pyffyMono
-import pyffyRGB
+import pyffyIOScheduler
+import pyffyJobs
+import pyffyJournal
+import pyffyMemory
+import pyffyMetadataCache
+import pyffyResources
+import pyffyTelemetry
 from pyffyExif import PyffyExif
 from pyffySettings import PyffySettings
 
+# modules which need NumPy are imported by the functions using them, so building the reference DB and the entry scripts start without NumPy
+if TYPE_CHECKING:
+    from numpy import ndarray
+
+    import pyffyFixedPoint
+    import pyffyGainMapStore
+
 
 def onePassWithOneReference(processFilesInSubfolders: bool, commonReferenceFile: str):
+    import pyffyArena
+    import pyffyStatistics
+    import pyffyTuning
     print("Pyffy is in one pass with one reference mode.")
     settings = prepareSettings()
 
-    installedPackages = {pkg.key for pkg in pkg_resources.working_set}
-    setIdlePriority(installedPackages)
-    isSend2TrashInstalled = "send2trash" in installedPackages
+    pyffyResources.apply(settings)
+    isSend2TrashInstalled = isPackageInstalled("send2trash")
 
-    computationExecutor = ThreadPoolExecutor()
+    computationExecutor = ThreadPoolExecutor(max_workers = pyffyCommon.cpuCount)
     ioExecutor = ThreadPoolExecutor()
 
+    metadataCache = pyffyMetadataCache.getCache(u".", settings)
+    getExif = pyffyExif.getExif if metadataCache is None else metadataCache.getExif
+
     referenceFilePath = commonReferenceFile
-    referenceFileExif = pyffyExif.getExif(fileName = referenceFilePath)
+    referenceFileExif = getExif(referenceFilePath)
 
-    if processFilesInSubfolders:
-        dngFiles = pyffyIO.getDngFilesInTree(u".")
-    else:
-        dngFiles = pyffyIO.getDngFilesInFolder(u".")
+    pyffyTelemetry.start(settings)
+    pyffyStatistics.start(settings)
+    pyffyArena.start(settings)
+    dngFiles = pyffyTelemetry.countFilesToProcess(pyffyJournal.recoverFiles(pyffyTelemetry.discoverFilesAhead(getDngFiles(processFilesInSubfolders, u".", settings))))
 
     for fileName in dngFiles:
         print("Processing {0}".format(fileName))
-        exif = pyffyExif.getExif(fileName)
+        exif = getExif(fileName)
 
         if not pyffyExif.isFileAndReferenceCompatible(exif, referenceFileExif):
+            pyffyTelemetry.fileSkipped()
             continue
 
         processOneFile(fileName, exif, referenceFilePath, referenceFileExif, settings, computationExecutor, ioExecutor, isSend2TrashInstalled)
         print("")
 
+    pyffyTelemetry.finish()
+    pyffyStatistics.finish()
+    if metadataCache is not None:
+        metadataCache.close()
     computationExecutor.shutdown()
     ioExecutor.shutdown()
+    pyffyTuning.shutdown()
 
 
-def onePass(processFilesInSubfolders: bool, workingPath: str):
+def onePass(processFilesInSubfolders: bool, workingPath: str, shard: tuple[int, int] | None = None):
+    import pyffyArena
+    import pyffyStatistics
+    import pyffyTuning
     print("Pyffy is in one pass with many references mode.")
 
     workingPath = workingPath.replace("\"", "").replace("'", "")
 
     settings = prepareSettings()
 
-    installedPackages = {pkg.key for pkg in pkg_resources.working_set}
-    setIdlePriority(installedPackages)
-    isSend2TrashInstalled = "send2trash" in installedPackages
+    pyffyResources.apply(settings)
+    isSend2TrashInstalled = isPackageInstalled("send2trash")
 
-    computationExecutor = ThreadPoolExecutor()
+    computationExecutor = ThreadPoolExecutor(max_workers = pyffyCommon.cpuCount)
     ioExecutor = ThreadPoolExecutor()
 
-    referenceDB = prepareReferenceDB(settings.referenceFilesRootFolder)
+    referenceDB = prepareReferenceDB(settings.referenceFilesRootFolder, settings)
 
     if referenceDB is None or len(referenceDB) == 0:
         exitWithPrompt("Reference files DB is not found or is empty.")
@@ -74,13 +100,20 @@ def onePass(processFilesInSubfolders: bool, workingPath: str):
     except:
         exitWithPrompt("Provided working path is invalid!")
 
-    if processFilesInSubfolders:
-        dngFiles = pyffyIO.getDngFilesInTree(workingPath)
-    else:
-        dngFiles = pyffyIO.getDngFilesInFolder(workingPath)
+    metadataCache = pyffyMetadataCache.getCache(workingPath, settings)
+    getExif = pyffyExif.getExif if metadataCache is None else metadataCache.getExif
+
+    jobCoordinator = pyffyJobs.getCoordinator(workingPath, settings, shard)
+    pyffyTelemetry.start(settings)
+    pyffyStatistics.start(settings)
+    pyffyArena.start(settings)
+    dngFiles = pyffyTelemetry.discoverFilesAhead(getDngFiles(processFilesInSubfolders, workingPath, settings))
+    if jobCoordinator is not None:
+        dngFiles = jobCoordinator.claimFiles(dngFiles)
+    dngFiles = pyffyTelemetry.countFilesToProcess(pyffyJournal.recoverFiles(dngFiles))
 
     for fileName in dngFiles:
-        exif = pyffyExif.getExif(fileName)
+        exif = getExif(fileName)
 
         if settings is None or len(settings.referenceFilesRootFolder) == 0:
             exitWithPrompt("Please set reference folder path in settings.json.")
@@ -90,6 +123,7 @@ def onePass(processFilesInSubfolders: bool, workingPath: str):
         if len(referenceFileRecords) == 0:
             print("No applicable reference file found in DB, skipping. It's metadata:")
             print(pyffyCommon.dictToJson(exif))
+            pyffyTelemetry.fileSkipped()
             continue
 
         if len(referenceFileRecords) > 1 and not settings.advUseFirstFoundReferenceInsteadOfSkippingProcessing:
@@ -98,22 +132,36 @@ def onePass(processFilesInSubfolders: bool, workingPath: str):
             print("Applicable reference files:")
             for referenceFileRecord in referenceFileRecords:
                 print(pyffyCommon.dictToJson(referenceFileRecord))
+            pyffyTelemetry.fileSkipped()
             continue
 
         referenceFilePath, referenceFileExif = referenceFileRecords.popitem()
         referenceFilePath = pyffyIO.getAbsolutePath(settings.referenceFilesRootFolder, referenceFilePath)
         if referenceFilePath is None:
             print("Reference field file record was found in DB, but corresponding file is not present.")
+            pyffyTelemetry.fileSkipped()
             continue
 
-        processOneFile(fileName, exif, referenceFilePath, referenceFileExif, settings, computationExecutor, ioExecutor, isSend2TrashInstalled)
+        if processOneFile(fileName, exif, referenceFilePath, referenceFileExif, settings, computationExecutor, ioExecutor, isSend2TrashInstalled) and jobCoordinator is not None:
+            jobCoordinator.complete(fileName)
         print("")
 
+    pyffyTelemetry.finish()
+    pyffyStatistics.finish()
+    if jobCoordinator is not None:
+        jobCoordinator.close()
+    if metadataCache is not None:
+        metadataCache.close()
     computationExecutor.shutdown()
     ioExecutor.shutdown()
+    pyffyTuning.shutdown()
 
 
-def twoPasses(processFilesInSubfolders: bool, workingPath: str):
+def twoPasses(processFilesInSubfolders: bool, workingPath: str, shard: tuple[int, int] | None = None, isProof: bool = False):
+    import pyffyArena
+    import pyffyProof
+    import pyffyStatistics
+    import pyffyTuning
     print("Pyffy is in two pass mode.")
 
     workingPath = workingPath.replace("\"", "").replace("'", "")
@@ -121,53 +169,138 @@ def twoPasses(processFilesInSubfolders: bool, workingPath: str):
     settings = prepareSettings()
 
     settingsForTwoPassProcessing = pyffyDB.readSettingsForTwoPassProcessing(pyffyIO.readImageSettingsForTwoPassProcessing(workingPath))
-    referenceDB = prepareReferenceDB(settings.referenceFilesRootFolder)
+    referenceDB = prepareReferenceDB(settings.referenceFilesRootFolder, settings)
 
-    if processFilesInSubfolders:
-        dngFiles = pyffyIO.getDngFilesInTree(workingPath)
-    else:
-        dngFiles = pyffyIO.getDngFilesInFolder(workingPath)
+    dngFiles = getDngFiles(processFilesInSubfolders, workingPath, settings)
+
+    metadataCache = pyffyMetadataCache.getCache(workingPath, settings)
+    getExif = pyffyExif.getExif if metadataCache is None else metadataCache.getExif
 
     if settingsForTwoPassProcessing is None:
         print("Pass one. Creating settings for all DNG files.")
 
-        pyffyIO.writeImageSettingsForTwoPassProcessing(workingPath, pyffyCommon.dictToJson(pyffyDB.createSettingsForTwoPassProcessing(dngFiles, workingPath, referenceDB, settings)))
+        pyffyIO.writeImageSettingsForTwoPassProcessing(workingPath, pyffyCommon.dictToJson(pyffyDB.createSettingsForTwoPassProcessing(dngFiles, workingPath, referenceDB, settings, getExif)))
+        if metadataCache is not None:
+            metadataCache.close()
 
         exitWithPrompt("Done. Edit {0} and start this script again for second pass.".format(pyffyIO.settingsForTwoPassProcessingFileName))
+    elif isProof:
+        print("Proof pass. Creating downscaled previews of corrected files.")
+
+        pyffyResources.apply(settings)
+        proofExecutor = ThreadPoolExecutor(max_workers = pyffyCommon.cpuCount)
+        jobs = list()
+        for fileName in dngFiles:
+            relativeFilePath = pyffyIO.getRelativePath(workingPath, fileName)
+            twoPassFileSettings = settingsForTwoPassProcessing.get(relativeFilePath)
+            if twoPassFileSettings is None:
+                continue
+
+            reference = getTwoPassReference(relativeFilePath, twoPassFileSettings, referenceDB, settings, getExif)
+            if reference is None:
+                continue
+
+            referenceFile, referenceFileExif = reference
+            exif = getExif(fileName)
+            settingsForFile = pyffyDB.updateWithTwoPassSettings(copy.deepcopy(settings), twoPassFileSettings)
+            jobs.append(pyffyProof.PyffyProofJob(fileName, relativeFilePath, exif, referenceFile, referenceFileExif, getPipeline(exif), settingsForFile))
+
+        pyffyProof.createProofs(jobs, workingPath, settings, proofExecutor)
+        if metadataCache is not None:
+            metadataCache.close()
+        proofExecutor.shutdown()
     else:
         print("Pass two.")
 
-        installedPackages = {pkg.key for pkg in pkg_resources.working_set}
-        setIdlePriority(installedPackages)
-        isSend2TrashInstalled = "send2trash" in installedPackages
+        pyffyResources.apply(settings)
+        isSend2TrashInstalled = isPackageInstalled("send2trash")
 
-        computationExecutor = ThreadPoolExecutor()
+        computationExecutor = ThreadPoolExecutor(max_workers = pyffyCommon.cpuCount)
         ioExecutor = ThreadPoolExecutor()
 
+        jobCoordinator = pyffyJobs.getCoordinator(workingPath, settings, shard)
+        pyffyTelemetry.start(settings)
+        pyffyStatistics.start(settings)
+        pyffyArena.start(settings)
+        dngFiles = pyffyTelemetry.discoverFilesAhead(dngFiles)
+        if jobCoordinator is not None:
+            dngFiles = jobCoordinator.claimFiles(dngFiles)
+        dngFiles = pyffyTelemetry.countFilesToProcess(pyffyJournal.recoverFiles(dngFiles))
+
         for fileName in dngFiles:
             relativeFilePath = pyffyIO.getRelativePath(workingPath, fileName)
             twoPassFileSettings = settingsForTwoPassProcessing.get(relativeFilePath)
 
             if twoPassFileSettings is None:
+                pyffyTelemetry.fileSkipped()
                 continue
 
-            if (twoPassFileSettings.referenceFiles is None or
-                    len(twoPassFileSettings.referenceFiles) == 0 or
-                    len(twoPassFileSettings.referenceFiles) > 1 and not settings.advUseFirstFoundReferenceInsteadOfSkippingProcessing):
-                print("Reference files entry must contain exactly one record. Skipping {0}".format(relativeFilePath))
+            reference = getTwoPassReference(relativeFilePath, twoPassFileSettings, referenceDB, settings, getExif)
+            if reference is None:
+                pyffyTelemetry.fileSkipped()
                 continue
 
-            referenceFile = twoPassFileSettings.referenceFiles[0]
-            referenceFile = pyffyIO.getAbsolutePath(settings.referenceFilesRootFolder, referenceFile)
-            referenceFileExif = pyffyExif.getExif(referenceFile)
-
+            referenceFile, referenceFileExif = reference
             settingsForFile = pyffyDB.updateWithTwoPassSettings(copy.deepcopy(settings), twoPassFileSettings)
 
-            processOneFile(fileName, pyffyExif.getExif(fileName), referenceFile, referenceFileExif, settingsForFile, computationExecutor, ioExecutor, isSend2TrashInstalled)
+            if processOneFile(fileName, getExif(fileName), referenceFile, referenceFileExif, settingsForFile, computationExecutor, ioExecutor, isSend2TrashInstalled) and jobCoordinator is not None:
+                jobCoordinator.complete(fileName)
             print("")
 
+        pyffyTelemetry.finish()
+        pyffyStatistics.finish()
+        if jobCoordinator is not None:
+            jobCoordinator.close()
+        if metadataCache is not None:
+            metadataCache.close()
         computationExecutor.shutdown()
         ioExecutor.shutdown()
+        pyffyTuning.shutdown()
+
+
+def getTwoPassReference(relativeFilePath: str, twoPassFileSettings: pyffyDB.SettingsForTwoPassProcessing, referenceDB, settings: PyffySettings, getExif) -> tuple[str, PyffyExif] | None:
+    if (twoPassFileSettings.referenceFiles is None or
+            len(twoPassFileSettings.referenceFiles) == 0 or
+            len(twoPassFileSettings.referenceFiles) > 1 and not settings.advUseFirstFoundReferenceInsteadOfSkippingProcessing):
+        print("Reference files entry must contain exactly one record. Skipping {0}".format(relativeFilePath))
+        return None
+
+    referenceFile = twoPassFileSettings.referenceFiles[0]
+    referenceFile = pyffyIO.getAbsolutePath(settings.referenceFilesRootFolder, referenceFile)
+    referenceFileExif = referenceDB.get(referenceFile)
+    if referenceFileExif is None:
+        referenceFileExif = getExif(referenceFile)
+    return referenceFile, referenceFileExif
+
+
+def extractProofArgument(arguments: [str]) -> ([str], bool):
+    if "--proof" not in arguments:
+        return arguments, False
+    return [argument for argument in arguments if argument != "--proof"], True
+
+
+def extractShardArgument(arguments: [str]) -> ([str], tuple[int, int] | None):
+    if "--shard" not in arguments:
+        return arguments, None
+
+    index = arguments.index("--shard")
+    shard = pyffyJobs.parseShard(arguments[index + 1]) if index + 1 < len(arguments) else None
+    if shard is None:
+        exitWithPrompt("Shard must be provided as --shard i/N, where 1 <= i <= N.")
+    return arguments[:index] + arguments[index + 2:], shard
+
+
+def getDngFiles(processFilesInSubfolders: bool, workingPath: str, settings: PyffySettings) -> Iterator[str]:
+    excludePatterns = list(settings.advExcludePatterns)
+    if not settings.overwriteSourceFile and len(settings.pathForProcessedFiles) != 0 and not Path(settings.pathForProcessedFiles).is_absolute():
+        # processed files are written next to the source ones, they must not be found again while the tree is still being scanned
+        processedFilesFolder = Path(settings.pathForProcessedFiles).as_posix()
+        excludePatterns += [processedFilesFolder, "*/" + processedFilesFolder]
+
+    if processFilesInSubfolders:
+        return pyffyIO.getDngFilesInTree(workingPath, settings.advMaxSubfolderDepth, settings.advIncludePatterns, excludePatterns, settings.advUseIOScheduler)
+    else:
+        return pyffyIO.getDngFilesInFolder(workingPath, settings.advIncludePatterns, excludePatterns, settings.advUseIOScheduler)
 
 
 def processOneFile(fileName: str,
@@ -177,52 +310,240 @@ def processOneFile(fileName: str,
                    settings: PyffySettings,
                    computationExecutor: ThreadPoolExecutor,
                    ioExecutor: ThreadPoolExecutor,
-                   isSend2TrashInstalled: bool):
+                   isSend2TrashInstalled: bool) -> bool:
+    # returns false if the file is skipped
+    import pyffyArena
+    import pyffyFixedPoint
+    import pyffyGainMapStore
+    import pyffyModel
+    import pyffyStatistics
+    import pyffyTuning
     if settings.advUpdateDngSoftwareTagToAvoidOverprocessing and exif.isFileAlreadyProcessed():
         print("{0} is skipped because advUpdateDngSoftwareTagToAvoidOverprocessing is true in settings.json and tag \"Software\" in dng file already contains \"pyffy\".".format(fileName))
-        return
+        pyffyTelemetry.fileSkipped()
+        return False
 
     print("Processing file {0} with reference file {1}".format(fileName, referenceFilePath))
     startTime = time.time()
-
-    imageData = pyffyIO.readImageData(fileName, exif.dataOffset, exif.dataSizeInWords)
-    referenceImageData = pyffyIO.readImageData(referenceFilePath, referenceFileExif.dataOffset, referenceFileExif.dataSizeInWords)
+    if settings.advProfileMemory:
+        pyffyMemory.startFile(fileName)
+    pyffyStatistics.startFile(fileName)
+
+    # tiled and multi-frame files are read, corrected and written tile by tile or frame by frame after the reference is prepared
+    ioAccess = pyffyIOScheduler.getAccess(settings)
+    fileSize = Path(fileName).stat().st_size
+    imageData = None
+    if not settings.advWriteGainMapOpcode and not exif.isFileTiled() and not exif.isFileMultiFrame():
+        with pyffyTelemetry.stage("readImage"):
+            imageData = readImageData(fileName, exif, ioExecutor, ioAccess)
+    pyffyMemory.markStage("readImage")
 
     fileCopyFuture = None
     if not settings.advOverWriteSourceFileInPlace:
         if settings.overwriteSourceFile:
-            fileCopyFuture = ioExecutor.submit(pyffyIO.createTempFile, fileName)
+            fileCopyFuture = ioExecutor.submit(pyffyIOScheduler.runWithAccess, ioAccess, [fileName, fileName + ".tmp"], fileSize, pyffyIO.createTempFile, fileName)
         else:
             destinationFolder = pyffyIO.getDestinationFolder(fileName, settings.pathForProcessedFiles)
             if destinationFolder is None:
                 exitWithPrompt("Path provided in pathForProcessedFiles must be valid!")
-            fileCopyFuture = ioExecutor.submit(pyffyIO.copyFileToDestination, fileName, destinationFolder)
+            fileCopyFuture = ioExecutor.submit(pyffyIOScheduler.runWithAccess, ioAccess, [fileName, destinationFolder], fileSize, pyffyIO.copyFileToDestination, fileName, destinationFolder)
+        pyffyTelemetry.trackFuture("copyFile", fileCopyFuture)
+        pyffyTelemetry.addBytesRead(fileSize)
+        pyffyTelemetry.addBytesWritten(fileSize)
+
+    pipeline = getPipeline(exif)
+    computationExecutor = pyffyTuning.apply(pipeline.getChannelsGeometry(exif), computationExecutor)
+    # fixed point gains of the previous file are reused when it had the same reference and settings, reference is not prepared at all then
+    fixedPointCorrection = None
+    if settings.advUseFixedPointCorrection and not settings.advWriteGainMapOpcode:
+        fixedPointKey = pyffyFixedPoint.getCacheKey(referenceFilePath, exif, settings)
+        fixedPointCorrection = pyffyFixedPoint.getCachedCorrection(fixedPointKey)
+    referenceChannels = None
+    if fixedPointCorrection is None:
+        if settings.advUseVignettingModel:
+            referenceChannels = pyffyModel.getReferenceChannels(referenceFileExif, pipeline.getChannelsGeometry(exif), settings)
+        gainMapStore = None
+        if referenceChannels is None and settings.advUseGainMapStore:
+            gainMapStore = pyffyGainMapStore.getStore(settings)
+            referenceChannels = gainMapStore.load(referenceFilePath, settings.advGaussianFilterSigma, pipeline.getChannelsGeometry(exif))
+        if referenceChannels is None:
+            with pyffyTelemetry.stage("readReference"):
+                referenceImageData = readImageData(referenceFilePath, referenceFileExif, ioExecutor, ioAccess)
+            pyffyMemory.markStage("readReference")
+            with pyffyTelemetry.stage("prepareReference"):
+                referenceChannels = pipeline.prepareReference(referenceImageData, exif, referenceFileExif, settings, computationExecutor)
+            pyffyArena.giveBack(referenceImageData)
+            if gainMapStore is not None:
+                gainMapStore.save(referenceFilePath, settings.advGaussianFilterSigma, pipeline.getChannelsGeometry(exif), referenceChannels)
+                gainMapStore.saveIndex()
+        if settings.advUseFixedPointCorrection and not settings.advWriteGainMapOpcode:
+            with pyffyTelemetry.stage("prepareFixedPoint"):
+                fixedPointCorrection = pyffyFixedPoint.PyffyFixedPointCorrection(pipeline.getTileCorrection(referenceChannels, exif, settings, computationExecutor))
+            pyffyFixedPoint.cacheCorrection(fixedPointKey, fixedPointCorrection)
+            pyffyMemory.markStage("prepareFixedPoint")
+
+    if settings.advWriteGainMapOpcode:
+        destinationFileName = writeGainMapOpcodes(fileName, fileCopyFuture, exif, pipeline, referenceChannels, settings, computationExecutor)
+        undoJournal = None
+    else:
+        destinationFileName, undoJournal = writeCorrectedImage(fileName, fileCopyFuture, exif, pipeline, referenceChannels, fixedPointCorrection, imageData, settings, computationExecutor, ioExecutor, ioAccess)
+    # buffers are not used after the image is written, next file of the same geometry gets them back
+    pyffyArena.giveBack(imageData, referenceChannels)
 
-    if exif.isFileLinear():
-        if exif.isFileMonochrome():
-            imageData = pyffyMono.process(imageData, referenceImageData, exif, referenceFileExif, settings)
-        else:
-            imageData = pyffyRGB.process(imageData, referenceImageData, exif, referenceFileExif, settings, computationExecutor)
+    if settings.advUpdateDngSoftwareTagToAvoidOverprocessing:
+        pyffyExif.addPyffyToSoftwareTag(destinationFileName, exif.software)
+
+    if undoJournal is not None:
+        undoJournal.commit()
+
+    if settings.overwriteSourceFile and not settings.advOverWriteSourceFileInPlace:
+        pyffyIO.replaceOriginalFileWithTmp(fileName, destinationFileName, isSend2TrashInstalled)
+    pyffyMemory.markStage("writeImage")
+
+    memoryReport = pyffyMemory.finishFile(settings.advMemoryReportsFolder, settings.advMemoryStageBudgetBytes)
+    if memoryReport is not None:
+        print(memoryReport.toTable())
+
+    fileStatistics = pyffyStatistics.finishFile()
+    if fileStatistics is not None:
+        print(fileStatistics.toTable())
+    pyffyArena.finishFile()
+
+    print("Processed in {:.2f} s".format(time.time() - startTime))
+    pyffyTelemetry.fileCompleted(fileSize)
+    return True
+
+
+def writeCorrectedImage(fileName: str,
+                        fileCopyFuture: Future | None,
+                        exif: PyffyExif,
+                        pipeline,
+                        referenceChannels: "ndarray | None",
+                        fixedPointCorrection: "pyffyFixedPoint.PyffyFixedPointCorrection | None",
+                        imageData: "ndarray | None",
+                        settings: PyffySettings,
+                        computationExecutor: ThreadPoolExecutor,
+                        ioExecutor: ThreadPoolExecutor,
+                        ioAccess) -> (str, pyffyJournal.PyffyUndoJournal | None):
+    # NewRawImageDigest is computed from the corrected data and written in place, files without it are left as is
+    import pyffyFixedPoint
+    import pyffyFrames
+    import pyffyTiles
+    digestOffset = pyffyDigest.getNewRawImageDigestOffset(fileName)
+    newRawImageDigest = None
+    if imageData is not None and fixedPointCorrection is None:
+        with pyffyTelemetry.stage("correct"):
+            imageData = pipeline.correct(imageData, referenceChannels, exif, settings, computationExecutor)
+        if digestOffset is not None and digestOffset >= 0:
+            newRawImageDigest = pyffyDigest.getNewRawImageDigest(imageData, exif, computationExecutor)
     else:
-        imageData = pyffyCFA.process(imageData, referenceImageData, exif, referenceFileExif, settings, computationExecutor)
+        tileCorrection = fixedPointCorrection if fixedPointCorrection is not None else pipeline.getTileCorrection(referenceChannels, exif, settings, computationExecutor)
+        if imageData is not None:
+            with pyffyTelemetry.stage("correct"):
+                imageData = pyffyFixedPoint.correctImage(imageData, exif, tileCorrection, computationExecutor)
+            if digestOffset is not None and digestOffset >= 0:
+                newRawImageDigest = pyffyDigest.getNewRawImageDigest(imageData, exif, computationExecutor)
 
     if fileCopyFuture is None:
         destinationFileName = fileName
     else:
         destinationFileName = fileCopyFuture.result()
 
-    pyffyIO.writeImageData(destinationFileName, exif.dataOffset, imageData)
-
-    if exif.software.count("pyffy") == 0:
+    # original bytes of everything that is overwritten in place are saved first, interrupted correction is rolled back when the file is met again
+    undoJournal = None
+    if fileCopyFuture is None and settings.advUseUndoJournal:
+        modifiedRanges = pyffyJournal.getModifiedRanges(exif, digestOffset)
+        with pyffyTelemetry.stage("writeUndoJournal"), ioAccess(fileName, sum(length for _, length in modifiedRanges)):
+            undoJournal = pyffyJournal.begin(fileName, modifiedRanges)
+        pyffyTelemetry.addBytesWritten(sum(length for _, length in modifiedRanges))
+
+    if imageData is not None:
+        with pyffyTelemetry.stage("writeImage"), ioAccess(destinationFileName, imageData.nbytes):
+            pyffyIO.writeImageData(destinationFileName, exif.dataOffset, imageData)
+        pyffyTelemetry.addBytesWritten(imageData.nbytes)
+    elif exif.isFileMultiFrame():
+        frames = exif.getFrames()
+        print("File contains {0} raw frames".format(len(frames)))
+        isDigestComputed = digestOffset is not None and digestOffset >= 0
+        with pyffyTelemetry.stage("correctFrames"):
+            newRawImageDigest = pyffyFrames.correctFrames(fileName, destinationFileName, frames, tileCorrection, isDigestComputed, settings.advMaxParallelFrames, computationExecutor, ioExecutor, ioAccess)
+        framesSize = sum(frame.dataSizeInWords * 2 for frame in frames)
+        pyffyTelemetry.addBytesRead(framesSize)
+        pyffyTelemetry.addBytesWritten(framesSize)
+    else:
+        isDigestComputedFromTiles = digestOffset is not None and digestOffset >= 0 and pyffyDigest.isFileTilingMatchingDigest(exif)
+        with pyffyTelemetry.stage("correctTiles"):
+            tileDigests = pyffyTiles.correctTiledFile(fileName, destinationFileName, exif, tileCorrection, ioExecutor, isDigestComputedFromTiles, ioAccess)
+        pyffyTelemetry.addBytesRead(exif.dataSizeInWords * 2)
+        pyffyTelemetry.addBytesWritten(exif.dataSizeInWords * 2)
+        if tileDigests is not None:
+            newRawImageDigest = pyffyDigest.combineTileDigests(tileDigests)
+
+    if newRawImageDigest is None and digestOffset is not None and digestOffset >= 0:
+        newRawImageDigest = pyffyDigest.getNewRawImageDigest(readImageData(destinationFileName, exif, ioExecutor, ioAccess), exif, computationExecutor)
+
+    if newRawImageDigest is not None:
+        pyffyDigest.writeNewRawImageDigest(destinationFileName, digestOffset, newRawImageDigest)
+    # everything written in place is on disk now, exiftool which replaces the file runs only after this is recorded
+    isChecksumRemoved = newRawImageDigest is None and digestOffset is not None
+    if undoJournal is not None:
+        undoJournal.markDataWritten(isChecksumRemoved, exif.software if settings.advUpdateDngSoftwareTagToAvoidOverprocessing else None)
+    if isChecksumRemoved:
         pyffyExif.removeDngChecksum(destinationFileName)
 
-    if settings.advUpdateDngSoftwareTagToAvoidOverprocessing:
-        pyffyExif.addPyffyToSoftwareTag(destinationFileName, exif.software)
+    return destinationFileName, undoJournal
+
+
+def writeGainMapOpcodes(fileName: str,
+                        fileCopyFuture: Future | None,
+                        exif: PyffyExif,
+                        pipeline,
+                        referenceChannels: "ndarray",
+                        settings: PyffySettings,
+                        computationExecutor: ThreadPoolExecutor) -> str:
+    # pixel data is left as is, raw converter applies the correction from the opcodes, only they and the raw IFD are written
+    import pyffyOpcodes
+    tileCorrection = pipeline.getTileCorrection(referenceChannels, exif, settings, computationExecutor)
+    opcodes = pyffyOpcodes.getGainMapOpcodes(tileCorrection, exif, settings.advGainMapOpcodePoints)
+    destinationFileName = fileName if fileCopyFuture is None else fileCopyFuture.result()
+    # every frame of multi-frame files has its own raw IFD
+    frames = exif.getFrames()
+    with pyffyTelemetry.stage("writeGainMapOpcodes"):
+        for frame in frames:
+            if not pyffyOpcodes.writeGainMapOpcodes(destinationFileName, frame, opcodes):
+                exitWithPrompt("GainMap opcodes could not be written to {0}.".format(destinationFileName))
+    pyffyTelemetry.addBytesWritten(sum(len(opcode.toBytes()) for opcode in opcodes) * len(frames))
+    return destinationFileName
+
+
+def readImageData(fileName: str, exif: PyffyExif, ioExecutor: ThreadPoolExecutor | None, ioAccess = pyffyIOScheduler.noAccessControl) -> "ndarray":
+    import pyffyTiles
+    pyffyTelemetry.addBytesRead(exif.dataSizeInWords * 2)
+    if exif.isFileTiled():
+        return pyffyTiles.readTiledImageData(fileName, exif, ioExecutor, ioAccess)
+    with ioAccess(fileName, exif.dataSizeInWords * 2):
+        return pyffyIO.readImageData(fileName, exif.dataOffset, exif.dataSizeInWords)
+
+
+def getPipeline(exif: PyffyExif):
+    import pyffyCFA
+    import pyffyMono
+    import pyffyRGB
+    if exif.isFileLinear():
+        if exif.isFileMonochrome():
+            return pyffyMono
+        else:
+            return pyffyRGB
+    else:
+        return pyffyCFA
 
-    if settings.overwriteSourceFile and not settings.advOverWriteSourceFileInPlace:
-        pyffyIO.replaceOriginalFileWithTmp(fileName, destinationFileName, isSend2TrashInstalled)
 
-    print("Processed in {:.2f} s".format(time.time() - startTime))
+def loadSettingsOrDefault() -> PyffySettings:
+    settings = PyffySettings.parse(pyffyIO.readSettings())
+    if settings is None:
+        print("Default settings are used.")
+        settings = PyffySettings()
+    return settings
 
 
 def prepareSettings():
@@ -252,7 +573,10 @@ def prepareSettings():
     return settings
 
 
-def prepareReferenceDB(referenceFilesRootFolderStr: str) -> dict[str, PyffyExif] | None:
+def prepareReferenceDB(referenceFilesRootFolderStr: str, settings: PyffySettings | None = None) -> dict[str, PyffyExif] | pyffyCatalog.PyffyReferenceCatalog | None:
+    if settings is not None and settings.advUseReferenceCatalog:
+        return prepareReferenceCatalog(referenceFilesRootFolderStr, settings)
+
     print("Reading reference files DB")
     referenceDB = pyffyDB.parseReferenceDB(pyffyIO.readReferenceFilesDB(referenceFilesRootFolderStr))
 
@@ -261,6 +585,9 @@ def prepareReferenceDB(referenceFilesRootFolderStr: str) -> dict[str, PyffyExif]
         referenceDB = pyffyDB.createReferenceDB(referenceFilesRootFolderStr)
         pyffyIO.writeReferenceFilesDB(pyffyCommon.dictToJson(referenceDB), referenceFilesRootFolderStr)
 
+    if settings is not None and settings.advUseVignettingModel and fitReferenceModels(referenceDB, referenceFilesRootFolderStr, settings):
+        pyffyIO.writeReferenceFilesDB(pyffyCommon.dictToJson(referenceDB), referenceFilesRootFolderStr)
+
     if referenceDB is not None:
         print("referenceDB contains {0} files".format(len(referenceDB)))
 
@@ -271,10 +598,120 @@ def prepareReferenceDB(referenceFilesRootFolderStr: str) -> dict[str, PyffyExif]
     return absoluteReferenceDB
 
 
-def setIdlePriority(installedPackages):
-    if "psutil" in installedPackages:
-        import psutil
-        psutil.Process().nice(psutil.IDLE_PRIORITY_CLASS)
+def prepareReferenceCatalog(referenceFilesRootFolderStr: str, settings: PyffySettings) -> pyffyCatalog.PyffyReferenceCatalog | None:
+    print("Opening reference files catalog")
+    if pyffyIO.getReferenceFilesRootFolderPath(referenceFilesRootFolderStr) is None:
+        return None
+
+    referenceCatalog = pyffyCatalog.PyffyReferenceCatalog(referenceFilesRootFolderStr)
+    if len(referenceCatalog) == 0:
+        referenceDBJson = pyffyIO.readReferenceFilesDB(referenceFilesRootFolderStr)
+        if referenceDBJson is not None:
+            print("Importing {0} into reference files catalog".format(pyffyIO.referenceFilesExifDBFileName))
+            referenceCatalog.importFromJson(referenceDBJson)
+        else:
+            print("Reference files catalog is empty, filling it")
+            referenceCatalog.update(pyffyDB.createReferenceDB(referenceFilesRootFolderStr))
+
+    if settings.advUseVignettingModel:
+        referenceDB = referenceCatalog.getRelativeItems()
+        if fitReferenceModels(referenceDB, referenceFilesRootFolderStr, settings):
+            referenceCatalog.update(referenceDB)
+
+    print("Reference files catalog contains {0} files".format(len(referenceCatalog)))
+    return referenceCatalog
+
+
+def exportReferenceCatalog(referenceFilesRootFolderStr: str):
+    referenceCatalog = pyffyCatalog.PyffyReferenceCatalog(referenceFilesRootFolderStr)
+    pyffyIO.writeReferenceFilesDB(referenceCatalog.exportToJson(), referenceFilesRootFolderStr)
+    print("{0} records are exported to {1}".format(len(referenceCatalog), pyffyIO.referenceFilesExifDBFileName))
+    referenceCatalog.close()
+
+
+def fitReferenceModels(referenceDB: dict[str, PyffyExif], referenceFilesRootFolderStr: str, settings: PyffySettings) -> bool:
+    import pyffyModel
+    executor = ThreadPoolExecutor()
+    isReferenceDBUpdated = False
+
+    for key, referenceFileExif in referenceDB.items():
+        if pyffyModel.isModelUpToDate(referenceFileExif, settings):
+            continue
+
+        referenceFilePath = pyffyIO.getAbsolutePath(referenceFilesRootFolderStr, key)
+        if referenceFilePath is None:
+            continue
+
+        print("Fitting vignetting model for {0}".format(key))
+        pipeline = getPipeline(referenceFileExif)
+        _, height, width = pipeline.getChannelsGeometry(referenceFileExif)
+        referenceImageData = readImageData(referenceFilePath, referenceFileExif, executor)
+        referenceChannels = pipeline.prepareReference(referenceImageData, referenceFileExif, referenceFileExif, settings, executor)
+
+        model = pyffyModel.fitModel(referenceChannels, height, width, settings.advVignettingModelDegree, settings.advGaussianFilterSigma)
+        print("Residual error against blurred reference: max {:.5f}, rms {:.5f}".format(model.maxResidual, model.rmsResidual))
+
+        referenceFileExif.vignettingModel = vars(model)
+        isReferenceDBUpdated = True
+
+    executor.shutdown()
+    return isReferenceDBUpdated
+
+
+def precomputeGainMaps(referenceFilesRootFolderStr: str, referenceDB: dict[str, PyffyExif] | pyffyCatalog.PyffyReferenceCatalog, settings: PyffySettings):
+    import pyffyGainMapStore
+    print("Precomputing gain maps for sigma {0}".format(settings.advGaussianFilterSigma))
+    startTime = time.time()
+
+    originalSettings = settings
+    settings = copy.deepcopy(settings)
+    settings.referenceFilesRootFolder = referenceFilesRootFolderStr
+    settings.useMultithreading = False
+    gainMapStore = pyffyGainMapStore.getStore(settings)
+
+    # every reference is processed in single thread, parallelism is achieved by processing many references at once
+    pyffyResources.setLibraryThreads(1)
+    with ThreadPoolExecutor(max_workers = pyffyCommon.cpuCount) as executor:
+        futures = [executor.submit(precomputeGainMap, gainMapStore, referenceFilePath, referenceFileExif, settings) for referenceFilePath, referenceFileExif in referenceDB.items() if referenceFilePath is not None]
+        gainMapPaths = [future.result() for future in futures]
+    pyffyResources.setLibraryThreads(pyffyResources.getLibraryThreads(originalSettings))
+
+    gainMapStore.removeStaleGainMaps([referenceFilePath for referenceFilePath, _ in referenceDB.items() if referenceFilePath is not None])
+    gainMapStore.saveIndex()
+    print("Gain maps for {0} reference files are ready in {1:.2f} s".format(len(gainMapPaths), time.time() - startTime))
+
+
+def precomputeGainMap(gainMapStore: "pyffyGainMapStore.PyffyGainMapStore", referenceFilePath: str, referenceFileExif: PyffyExif, settings: PyffySettings):
+    channelsGeometry = getPipeline(referenceFileExif).getChannelsGeometry(referenceFileExif)
+    gainMapPath = gainMapStore.getGainMapPath(referenceFilePath, settings.advGaussianFilterSigma, channelsGeometry)
+    if gainMapPath.exists():
+        return gainMapPath
+
+    print("Precomputing gain map for {0}".format(referenceFilePath))
+    referenceImageData = readImageData(referenceFilePath, referenceFileExif, None)
+    referenceChannels = getPipeline(referenceFileExif).prepareReference(referenceImageData, referenceFileExif, referenceFileExif, settings, None)
+    return gainMapStore.save(referenceFilePath, settings.advGaussianFilterSigma, channelsGeometry, referenceChannels)
+
+
+def autotune(referenceDB: dict[str, PyffyExif] | pyffyCatalog.PyffyReferenceCatalog, settings: PyffySettings):
+    # one reference file per channels geometry is enough, synthetic data of its size is benchmarked
+    import pyffyTuning
+    referenceFiles = dict()
+    for referenceFilePath, referenceFileExif in referenceDB.items():
+        pipeline = getPipeline(referenceFileExif)
+        referenceFiles.setdefault(pyffyTuning.getGeometryKey(pipeline.getChannelsGeometry(referenceFileExif)), (pipeline, referenceFileExif))
+
+    if len(referenceFiles) == 0:
+        exitWithPrompt("Reference files DB is empty, there is nothing to tune.")
+
+    pyffyResources.apply(settings)
+
+    profile = pyffyTuning.tune(referenceFiles, settings)
+    pyffyIO.writeTuningProfile(pyffyCommon.dictToJson(profile))
+
+
+def isPackageInstalled(packageName: str) -> bool:
+    return importlib.util.find_spec(packageName) is not None
 
 
 def exitWithPrompt(message: str | None = None):
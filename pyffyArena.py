@@ -0,0 +1,127 @@
+import threading
+
+import numpy as np
+from numpy import ndarray
+
+from pyffySettings import PyffySettings
+
+
+class PyffyBufferArena:
+    def __init__(self, maxIdleBytes: int, minAvailableBytes: int):
+        # idle buffers are kept by (shape, dtype) and by the thread which gave them back, so a thread gets back memory it has already touched
+        self.maxIdleBytes = maxIdleBytes
+        self.minAvailableBytes = minAvailableBytes
+        self.lock = threading.Lock()
+        self.buffers: dict[tuple, dict[int, list[ndarray]]] = {}
+        self.idleBytes = 0
+        self.idleIds = set()
+        self.borrowedKeys = set()
+        self.reusedCount = 0
+        self.allocatedCount = 0
+
+    def borrow(self, shape: tuple, dtype) -> ndarray:
+        key = (tuple(shape), np.dtype(dtype).str)
+        threadId = threading.get_ident()
+        with self.lock:
+            self.borrowedKeys.add(key)
+            threadBuffers = self.buffers.get(key)
+            if threadBuffers is not None:
+                # buffers given back by this thread are preferred, any idle buffer of the key is better than a new one
+                threadId = threadId if len(threadBuffers.get(threadId, [])) != 0 else next((i for i, buffers in threadBuffers.items() if len(buffers) != 0), None)
+                if threadId is not None:
+                    buffer = threadBuffers[threadId].pop()
+                    self.idleIds.discard(id(buffer))
+                    self.idleBytes -= buffer.nbytes
+                    self.reusedCount += 1
+                    return buffer
+            self.allocatedCount += 1
+
+        if self.minAvailableBytes > 0:
+            availableBytes = getAvailableBytes()
+            if availableBytes is not None and availableBytes < self.minAvailableBytes:
+                self.trim(0)
+        return np.empty(shape, dtype = dtype)
+
+    def giveBack(self, buffer: ndarray):
+        # only whole buffers are kept, views are traced back to the array which owns the memory
+        while isinstance(buffer.base, ndarray):
+            buffer = buffer.base
+        if buffer.base is not None or not buffer.flags.c_contiguous or not buffer.flags.writeable:
+            return
+        key = (buffer.shape, buffer.dtype.str)
+        with self.lock:
+            # buffer given back twice, for example through two views, would be lent to two borrowers
+            if id(buffer) in self.idleIds:
+                return
+            self.idleIds.add(id(buffer))
+            self.buffers.setdefault(key, {}).setdefault(threading.get_ident(), []).append(buffer)
+            self.idleBytes += buffer.nbytes
+
+    def finishFile(self):
+        # buffers of geometries which were not used for the file are dropped, consecutive files almost always share one
+        with self.lock:
+            for key in [key for key in self.buffers.keys() if key not in self.borrowedKeys]:
+                for buffers in self.buffers.pop(key).values():
+                    for buffer in buffers:
+                        self.idleIds.discard(id(buffer))
+                        self.idleBytes -= buffer.nbytes
+            self.borrowedKeys.clear()
+        availableBytes = getAvailableBytes() if self.minAvailableBytes > 0 else None
+        self.trim(0 if availableBytes is not None and availableBytes < self.minAvailableBytes else self.maxIdleBytes)
+
+    def trim(self, maxIdleBytes: int):
+        # largest buffers are dropped first, they are the ones which hold the most memory
+        with self.lock:
+            while self.idleBytes > maxIdleBytes:
+                buffers = max((buffers for threadBuffers in self.buffers.values() for buffers in threadBuffers.values() if len(buffers) != 0), key = lambda buffers: buffers[-1].nbytes)
+                buffer = buffers.pop()
+                self.idleIds.discard(id(buffer))
+                self.idleBytes -= buffer.nbytes
+            self.buffers = {key: {i: buffers for i, buffers in threadBuffers.items() if len(buffers) != 0} for key, threadBuffers in self.buffers.items()}
+            self.buffers = {key: threadBuffers for key, threadBuffers in self.buffers.items() if len(threadBuffers) != 0}
+
+
+# arena of the running batch, None when buffers are not reused and every borrow is a new allocation
+arena: PyffyBufferArena | None = None
+
+
+def start(settings: PyffySettings):
+    global arena
+    arena = PyffyBufferArena(settings.advBufferArenaMaxIdleBytes, settings.advBufferArenaMinAvailableBytes) if settings.advUseBufferArena else None
+
+
+def borrow(shape: tuple, dtype) -> ndarray:
+    if arena is None:
+        return np.empty(shape, dtype = dtype)
+    return arena.borrow(shape, dtype)
+
+
+def giveBack(*buffers: ndarray | None):
+    # caller must not use given back buffers or any views of them afterwards
+    if arena is None:
+        return
+    for buffer in buffers:
+        if buffer is not None:
+            arena.giveBack(buffer)
+
+
+def finishFile():
+    if arena is not None:
+        arena.finishFile()
+
+
+def getAvailableBytes() -> int | None:
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
@@ -0,0 +1,21 @@
+import sys
+
+import pyffy
+
+if len(sys.argv) == 1:
+    referenceFilesRootFolder = None
+elif len(sys.argv) == 2:
+    referenceFilesRootFolder = sys.argv[1]
+else:
+    pyffy.exitWithPrompt("Only one folder can be provided to this script. Exiting now.")
+
+settings = pyffy.loadSettingsOrDefault()
+if referenceFilesRootFolder is None:
+    referenceFilesRootFolder = settings.referenceFilesRootFolder
+if len(referenceFilesRootFolder) == 0:
+    pyffy.exitWithPrompt("Please set reference folder path in settings.json or provide it to this script.")
+
+referenceDB = pyffy.prepareReferenceDB(referenceFilesRootFolder, settings)
+if referenceDB is None:
+    pyffy.exitWithPrompt("Reference files DB is not found.")
+pyffy.autotune(referenceDB, settings)
@@ -3,78 +3,194 @@ from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from numpy import float32, ndarray, uint16
 
+import pyffyArena
 import pyffyCommon
+import pyffyMemory
+import pyffyStatistics
+import pyffyTiles
 from pyffyExif import PyffyExif
 from pyffySettings import PyffySettings
 
 
 def bitwiseMask(image: ndarray[uint16], exif: PyffyExif, bits: int, leaveLSB: bool, executor: ThreadPoolExecutor) -> ndarray[uint16]:
+    patternDim = getPatternDim(exif)
     activeAreaImage = pyffyCommon.getActiveAreaPixels(image, exif.imageHeight, exif.imageWidth, exif.activeArea)
-    activeAreaImageHeight = activeAreaImage.shape[0]
-    activeAreaImageWidth = activeAreaImage.shape[1]
-    channels = imageToChannels(activeAreaImage, exif.blackLevels)
+    blackLevels = getChannelBlackLevels(exif, patternDim)
+    channels = imageToChannels(activeAreaImage, blackLevels, patternDim)
     channels = pyffyCommon.bitwiseMask(channels, bits, leaveLSB)
     for i in range(channels.shape[0]):
-        channels[i] += pyffyCommon.getBlackWhiteLevel(exif.blackLevels, i)
-    activeAreaImage = channelsToImage(channels, activeAreaImageHeight, activeAreaImageWidth, True, executor)
-    return pyffyCommon.setActiveAreaPixels(image, activeAreaImage, exif.imageHeight, exif.imageWidth, exif.activeArea)
+        channels[i] += blackLevels[i]
+    channelsToImage(channels, activeAreaImage, patternDim)
+    return image.reshape(-1)
 
 
 def process(image: ndarray[uint16], reference: ndarray[uint16], exif: PyffyExif, referenceExif: PyffyExif, settings: PyffySettings, executor: ThreadPoolExecutor) -> ndarray[uint16]:
-    activeAreaImage = pyffyCommon.getActiveAreaPixels(image, exif.imageHeight, exif.imageWidth, exif.activeArea)
-    activeAreaImageHeight = activeAreaImage.shape[0]
-    activeAreaImageWidth = activeAreaImage.shape[1]
-    activeAreaReference = pyffyCommon.getActiveAreaPixels(reference, referenceExif.imageHeight, referenceExif.imageWidth, exif.activeArea)
-    channels, referenceChannels = imagesToChannels(activeAreaImage, activeAreaReference, exif.blackLevels, referenceExif.blackLevels, settings.useMultithreading, executor)
+    referenceChannels = prepareReference(reference, exif, referenceExif, settings, executor)
+    image = correct(image, referenceChannels, exif, settings, executor)
+    pyffyArena.giveBack(referenceChannels)
+    return image
+
+
+def getPatternDim(exif: PyffyExif) -> (int, int):
+    # CFARepeatPatternDim is absent in old reference DBs, all of them are Bayer
+    if len(exif.cfaRepeatPatternDim) == 2:
+        return exif.cfaRepeatPatternDim[0], exif.cfaRepeatPatternDim[1]
+    return 2, 2
+
+
+def getChannelBlackLevels(exif: PyffyExif, patternDim: (int, int)) -> [int]:
+    # black level of every position of the CFA pattern, BlackLevel repeats on BlackLevelRepeatDim grid, which is not the CFA one for X-Trans
+    patternRows, patternColumns = patternDim
+    if len(exif.blackLevels) <= 1:
+        return [pyffyCommon.getBlackWhiteLevel(exif.blackLevels, 0)] * (patternRows * patternColumns)
+
+    if len(exif.blackLevelRepeatDim) == 2:
+        repeatRows, repeatColumns = exif.blackLevelRepeatDim
+    elif len(exif.blackLevels) == patternRows * patternColumns:
+        # BlackLevelRepeatDim is absent in old reference DBs, their black levels follow the CFA pattern
+        repeatRows, repeatColumns = patternDim
+    else:
+        repeatRows = repeatColumns = int(round(len(exif.blackLevels) ** 0.5))
+    if repeatRows * repeatColumns != len(exif.blackLevels):
+        raise ValueError("{0} black levels do not match BlackLevelRepeatDim {1}x{2}".format(len(exif.blackLevels), repeatRows, repeatColumns))
+    return [exif.blackLevels[row % repeatRows * repeatColumns + column % repeatColumns] for row in range(patternRows) for column in range(patternColumns)]
 
-    referenceChannels = referenceChannels.astype(float32)
-    referenceChannels = pyffyCommon.blurChannels(referenceChannels, activeAreaImageHeight // 2, activeAreaImageWidth // 2, settings.advGaussianFilterSigma, settings.useMultithreading, executor)
-    referenceChannels = pyffyCommon.normalizeChannels(referenceChannels, settings.useMultithreading, executor)
 
-    channels = channels.astype(float32)
-    channels, referenceChannels = pyffyCommon.correctLuminance(channels, referenceChannels, exif.colorPattern, settings.luminanceCorrectionIntensity, settings.useMultithreading, executor)
-    channels = pyffyCommon.correctColor(channels, referenceChannels, exif.colorPattern, settings.colorCorrectionIntensity, settings.useMultithreading, executor)
-    channels = pyffyCommon.fitChannelsToAllowedRange(channels, exif.blackLevels, exif.whiteLevels, settings.advLimitToWhiteLevels, settings.useMultithreading, executor)
-
-    channels = channels.astype(uint16)
-    activeAreaImage = channelsToImage(channels, activeAreaImageHeight, activeAreaImageWidth, settings.useMultithreading, executor)
-    return pyffyCommon.setActiveAreaPixels(image, activeAreaImage, exif.imageHeight, exif.imageWidth, exif.activeArea)
+def getChannelsGeometry(exif: PyffyExif) -> (int, int, int):
+    patternRows, patternColumns = getPatternDim(exif)
+    return patternRows * patternColumns, (exif.activeArea[2] - exif.activeArea[0]) // patternRows, (exif.activeArea[3] - exif.activeArea[1]) // patternColumns
 
 
-def imagesToChannels(image: ndarray[uint16], reference: ndarray[uint16], blackLevels: [int], referenceBlackLevels: [int], useMultithreading: bool, executor: ThreadPoolExecutor) -> (ndarray[uint16], ndarray[uint16]):
-    if useMultithreading:
-        channelsFuture = executor.submit(imageToChannels, image, blackLevels)
-        referenceFuture = executor.submit(imageToChannels, reference, referenceBlackLevels)
-        return channelsFuture.result(), referenceFuture.result()
-    else:
-        channels = imageToChannels(image, blackLevels)
-        referenceChannels = imageToChannels(reference, referenceBlackLevels)
-        return channels, referenceChannels
-
-
-def imageToChannels(image: ndarray[uint16], blackLevels: [int]) -> ndarray[uint16]:
-    r1 = image[::2].reshape((-1))
-    r2 = image[1::2].reshape((-1))
-    channels = np.empty((4, image.size // 4), dtype = uint16)
-    channels[0] = r1[0::2].clip(pyffyCommon.getBlackWhiteLevel(blackLevels, 0)) - pyffyCommon.getBlackWhiteLevel(blackLevels, 0)
-    channels[1] = r1[1::2].clip(pyffyCommon.getBlackWhiteLevel(blackLevels, 1)) - pyffyCommon.getBlackWhiteLevel(blackLevels, 1)
-    channels[2] = r2[0::2].clip(pyffyCommon.getBlackWhiteLevel(blackLevels, 2)) - pyffyCommon.getBlackWhiteLevel(blackLevels, 2)
-    channels[3] = r2[1::2].clip(pyffyCommon.getBlackWhiteLevel(blackLevels, 3)) - pyffyCommon.getBlackWhiteLevel(blackLevels, 3)
+def prepareReference(reference: ndarray[uint16], exif: PyffyExif, referenceExif: PyffyExif, settings: PyffySettings, executor: ThreadPoolExecutor) -> ndarray[float32]:
+    _, height, width = getChannelsGeometry(exif)
+    activeAreaReference = pyffyCommon.getActiveAreaPixels(reference, referenceExif.imageHeight, referenceExif.imageWidth, exif.activeArea)
+    uint16Channels = imageToChannels(activeAreaReference, getChannelBlackLevels(referenceExif, getPatternDim(exif)), getPatternDim(exif))
+    pyffyMemory.markStage("referenceToChannels")
+
+    referenceChannels = pyffyCommon.channelsToFloat(uint16Channels)
+    pyffyArena.giveBack(uint16Channels)
+    pyffyMemory.markStage("referenceToFloat")
+    # sigma is set for Bayer channels, it is scaled to the channel geometry so the blur covers the same sensor area for any pattern
+    gaussianFilterSigma = settings.advGaussianFilterSigma * 2 / max(getPatternDim(exif))
+    blurredChannels = pyffyCommon.blurChannels(referenceChannels, height, width, gaussianFilterSigma, settings.useMultithreading, executor)
+    pyffyArena.giveBack(referenceChannels)
+    pyffyMemory.markStage("blurReference")
+    referenceChannels = pyffyCommon.normalizeChannels(blurredChannels, settings.useMultithreading, executor)
+    pyffyArena.giveBack(blurredChannels)
+    pyffyMemory.markStage("normalizeReference")
+    return referenceChannels
+
+
+def correct(image: ndarray[uint16], referenceChannels: ndarray[float32], exif: PyffyExif, settings: PyffySettings, executor: ThreadPoolExecutor) -> ndarray[uint16]:
+    patternDim = getPatternDim(exif)
+    activeAreaImage = pyffyCommon.getActiveAreaPixels(image, exif.imageHeight, exif.imageWidth, exif.activeArea)
+    blackLevels = getChannelBlackLevels(exif, patternDim)
+    # reference channels are still unchanged here, luminance correction below divides them in place
+    correctPartialBlocks(activeAreaImage, referenceChannels, exif, blackLevels, settings)
+    uint16Channels = imageToChannels(activeAreaImage, blackLevels, patternDim)
+    pyffyMemory.markStage("imageToChannels")
+
+    # uint16 channels are read by statistics before they are overwritten with the result
+    sourceChannels = uint16Channels if pyffyStatistics.current is not None else None
+    channels = pyffyCommon.channelsToFloat(uint16Channels)
+    pyffyMemory.markStage("imageToFloat")
+    channels, referenceChannels = pyffyCommon.correctLuminance(channels, referenceChannels, exif.colorPattern, settings.luminanceCorrectionIntensity, settings.useMultithreading, executor)
+    pyffyMemory.markStage("correctLuminance")
+    channels = pyffyCommon.correctColor(channels, referenceChannels, exif.colorPattern, settings.colorCorrectionIntensity, settings.useMultithreading, executor)
+    pyffyMemory.markStage("correctColor")
+    channels = pyffyCommon.fitChannelsToAllowedRange(channels, blackLevels, exif.whiteLevels, settings.advLimitToWhiteLevels, settings.useMultithreading, executor, sourceChannels)
+    pyffyMemory.markStage("fitToAllowedRange")
+
+    np.copyto(uint16Channels, channels, casting = "unsafe")
+    pyffyArena.giveBack(channels)
+    pyffyMemory.markStage("channelsToUint16")
+    channelsToImage(uint16Channels, activeAreaImage, patternDim)
+    pyffyArena.giveBack(uint16Channels)
+    pyffyMemory.markStage("channelsToImage")
+    return image.reshape(-1)
+
+
+def correctPartialBlocks(activeAreaImage: ndarray[uint16], referenceChannels: ndarray[float32], exif: PyffyExif, blackLevels: [int], settings: PyffySettings):
+    # rows and columns which do not make a full repeat pattern at the bottom and right edges are not in the channels,
+    # they are corrected with the gain of the same pattern position in the nearest full pattern
+    patternRows, patternColumns = getPatternDim(exif)
+    channelsCount, height, width = getChannelsGeometry(exif)
+    fullRows, fullColumns = height * patternRows, width * patternColumns
+    if height == 0 or width == 0:
+        return
+    referencePlanes = referenceChannels.reshape(channelsCount, height, width)
+    regions = [(fullRows, 0, activeAreaImage.shape[0], fullColumns, referencePlanes[:, height - 1:, :]),
+               (0, fullColumns, fullRows, activeAreaImage.shape[1], referencePlanes[:, :, width - 1:]),
+               (fullRows, fullColumns, activeAreaImage.shape[0], activeAreaImage.shape[1], referencePlanes[:, height - 1:, width - 1:])]
+
+    for top, left, bottom, right, regionReference in regions:
+        if bottom == top or right == left:
+            continue
+        # region is padded to full patterns, padding is black and is dropped after correction
+        blocksDown, blocksAcross = regionReference.shape[1], regionReference.shape[2]
+        region = np.zeros((blocksDown * patternRows, blocksAcross * patternColumns), dtype = uint16)
+        region[:bottom - top, :right - left] = activeAreaImage[top:bottom, left:right]
+        uint16Channels = imageToChannels(region, blackLevels, (patternRows, patternColumns))
+        channels = pyffyCommon.channelsToFloat(uint16Channels)
+        regionReferenceChannels = regionReference.reshape(channelsCount, -1).copy()
+        channels, regionReferenceChannels = pyffyCommon.correctLuminance(channels, regionReferenceChannels, exif.colorPattern, settings.luminanceCorrectionIntensity, False, None)
+        channels = pyffyCommon.correctColor(channels, regionReferenceChannels, exif.colorPattern, settings.colorCorrectionIntensity, False, None)
+        channels = pyffyCommon.fitChannelsToAllowedRange(channels, blackLevels, exif.whiteLevels, settings.advLimitToWhiteLevels, False, None)
+        np.copyto(uint16Channels, channels, casting = "unsafe")
+        channelsToImage(uint16Channels, region, (patternRows, patternColumns))
+        pyffyArena.giveBack(channels, uint16Channels)
+        activeAreaImage[top:bottom, left:right] = region[:bottom - top, :right - left]
+
+
+def fillPartialBlocks(raster: ndarray, patternDim: (int, int)) -> ndarray:
+    # rows and columns which do not make a full repeat pattern get the values of the same pattern position in the nearest full pattern
+    patternRows, patternColumns = patternDim
+    fullRows, fullColumns = raster.shape[0] // patternRows * patternRows, raster.shape[1] // patternColumns * patternColumns
+    if fullRows != 0 and fullRows != raster.shape[0]:
+        raster[fullRows:] = raster[fullRows - patternRows:raster.shape[0] - patternRows]
+    if fullColumns != 0 and fullColumns != raster.shape[1]:
+        raster[:, fullColumns:] = raster[:, fullColumns - patternColumns:raster.shape[1] - patternColumns]
+    return raster
+
+
+def getTileCorrection(referenceChannels: ndarray[float32], exif: PyffyExif, settings: PyffySettings, executor: ThreadPoolExecutor) -> pyffyTiles.PyffyTileCorrection:
+    patternRows, patternColumns = getPatternDim(exif)
+    _, height, width = getChannelsGeometry(exif)
+    gainChannels = np.ones_like(referenceChannels)
+    gainChannels, referenceChannels = pyffyCommon.correctLuminance(gainChannels, referenceChannels, exif.colorPattern, settings.luminanceCorrectionIntensity, settings.useMultithreading, executor)
+    gainChannels = pyffyCommon.correctColor(gainChannels, referenceChannels, exif.colorPattern, settings.colorCorrectionIntensity, settings.useMultithreading, executor)
+    gainRaster = np.ones((exif.activeArea[2] - exif.activeArea[0], exif.activeArea[3] - exif.activeArea[1]), dtype = float32)
+    channelsToImage(gainChannels, gainRaster, (patternRows, patternColumns))
+    fillPartialBlocks(gainRaster, (patternRows, patternColumns))
+
+    whiteLevels = exif.whiteLevels if settings.advLimitToWhiteLevels else [65535]
+    channelIndexPattern = [[row * patternColumns + column for column in range(patternColumns)] for row in range(patternRows)]
+    return pyffyTiles.PyffyTileCorrection(gainRaster, exif.activeArea, pyffyTiles.getLevelsPattern(getChannelBlackLevels(exif, (patternRows, patternColumns)), channelIndexPattern), pyffyTiles.getLevelsPattern(whiteLevels, channelIndexPattern))
+
+
+def getChannelViews(image: ndarray, patternDim: (int, int)) -> ndarray:
+    # view of shape (patternRows, patternColumns, height, width) over the image, every color of the repeat pattern is a strided plane, nothing is copied
+    # rows and columns which do not make a full repeat pattern at the bottom and right edges are left out
+    patternRows, patternColumns = patternDim
+    height, width = image.shape[0] // patternRows, image.shape[1] // patternColumns
+    image = image[:height * patternRows, :width * patternColumns]
+    return image.reshape(height, patternRows, width, patternColumns).transpose(1, 3, 0, 2)
+
+
+def imageToChannels(image: ndarray[uint16], blackLevels: [int], patternDim: (int, int) = (2, 2)) -> ndarray[uint16]:
+    views = getChannelViews(image, patternDim)
+    patternRows, patternColumns, height, width = views.shape
+    blackLevelsPattern = np.array([pyffyCommon.getBlackWhiteLevel(blackLevels, i) for i in range(patternRows * patternColumns)], dtype = uint16).reshape(patternRows, patternColumns, 1, 1)
+    channels = pyffyArena.borrow((patternRows * patternColumns, height * width), uint16)
+    # strided planes are gathered into contiguous channels by the same pass which subtracts black
+    channelViews = channels.reshape(patternRows, patternColumns, height, width)
+    np.maximum(views, blackLevelsPattern, out = channelViews)
+    channelViews -= blackLevelsPattern
     return channels
 
 
-def channelsToImage(channels: ndarray[uint16], height: int, width: int, useMultithreading: bool, executor: ThreadPoolExecutor) -> ndarray[uint16]:
-    if useMultithreading:
-        f1 = executor.submit(twoChannelsToOne, (channels[0], channels[1]), height, width)
-        f2 = executor.submit(twoChannelsToOne, (channels[2], channels[3]), height, width)
-        return np.hstack((f1.result(), f2.result())).reshape(height, width)
-    else:
-        channels01 = twoChannelsToOne((channels[0], channels[1]), height, width)
-        channels23 = twoChannelsToOne((channels[2], channels[3]), height, width)
-        return np.hstack((channels01, channels23)).reshape(height, width)
-
-
-def twoChannelsToOne(channels: (ndarray[uint16], ndarray[uint16]), height: int, width: int) -> ndarray[uint16]:
-    channels = np.row_stack(channels)
-    channels = np.reshape(channels, (1, channels[0].size * 2), "F")
-    return np.reshape(channels, (height // 2, width))
+def channelsToImage(channels: ndarray, image: ndarray, patternDim: (int, int) = (2, 2)) -> ndarray:
+    # channels are scattered back into the image through the same strided view, image dtype is kept
+    views = getChannelViews(image, patternDim)
+    views[...] = channels.reshape(views.shape)
+    return image
@@ -0,0 +1,119 @@
+import json
+from pathlib import Path
+
+import pyffyCommon
+from pyffyExif import PyffyExif
+from pyffySettings import PyffySettings
+
+referenceCatalogFileName = "referenceDB.sqlite"
+
+createReferenceCatalogScript = """
+CREATE TABLE IF NOT EXISTS referenceFiles (
+    path TEXT PRIMARY KEY,
+    cameraMaker TEXT,
+    cameraModel TEXT,
+    lens TEXT,
+    imageHeight INTEGER,
+    imageWidth INTEGER,
+    focalLength REAL,
+    fNumber REAL,
+    photometricInterpretation TEXT,
+    samplesPerPixel INTEGER,
+    exif TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS referenceFilesByCamera ON referenceFiles (cameraMaker, cameraModel, imageHeight, imageWidth, focalLength, fNumber);
+CREATE INDEX IF NOT EXISTS referenceFilesByLens ON referenceFiles (lens);
+CREATE INDEX IF NOT EXISTS referenceFilesByFocalLength ON referenceFiles (focalLength);
+CREATE INDEX IF NOT EXISTS referenceFilesByFNumber ON referenceFiles (fNumber);
+"""
+
+
+class PyffyReferenceCatalog:
+    def __init__(self, referenceFilesRootFolderStr: str):
+        # sqlite3 is loaded only when the catalog is used, plain reference DB does not need it
+        import sqlite3
+        self.rootFolder = Path(referenceFilesRootFolderStr).resolve()
+        self.connection = sqlite3.connect(self.rootFolder.joinpath(referenceCatalogFileName), timeout = 30)
+        # WAL lets many pyffy processes read the catalog while one of them updates it
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.executescript(createReferenceCatalogScript)
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM referenceFiles").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def getAbsolutePath(self, relativePath: str) -> str:
+        return str(self.rootFolder.joinpath(relativePath))
+
+    def getRelativePath(self, absolutePath: str) -> str:
+        return str(Path(absolutePath).relative_to(self.rootFolder))
+
+    def update(self, referenceDB: dict[str, PyffyExif]):
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO referenceFiles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                        [(relativePath,
+                                          exif.cameraMaker,
+                                          exif.cameraModel,
+                                          exif.lens,
+                                          exif.imageHeight,
+                                          exif.imageWidth,
+                                          exif.focalLength,
+                                          exif.fNumber,
+                                          exif.photometricInterpretation,
+                                          exif.samplesPerPixel,
+                                          pyffyCommon.dictToJson(exif)) for relativePath, exif in referenceDB.items()])
+
+    def importFromJson(self, referenceDBJson: str) -> int:
+        referenceDB = {relativePath: PyffyExif(exifDict) for relativePath, exifDict in json.loads(referenceDBJson).items()}
+        self.update(referenceDB)
+        return len(referenceDB)
+
+    def exportToJson(self) -> str:
+        return pyffyCommon.dictToJson(self.getRelativeItems())
+
+    def getRelativeItems(self) -> dict[str, PyffyExif]:
+        return {relativePath: PyffyExif(json.loads(exifJson)) for relativePath, exifJson in self.connection.execute("SELECT path, exif FROM referenceFiles")}
+
+    def items(self) -> [(str, PyffyExif)]:
+        return [(self.getAbsolutePath(relativePath), exif) for relativePath, exif in self.getRelativeItems().items()]
+
+    def get(self, absolutePath: str, default: PyffyExif | None = None) -> PyffyExif | None:
+        try:
+            relativePath = self.getRelativePath(absolutePath)
+        except ValueError:
+            return default
+
+        row = self.connection.execute("SELECT exif FROM referenceFiles WHERE path = ?", (relativePath,)).fetchone()
+        return default if row is None else PyffyExif(json.loads(row[0]))
+
+    def query(self, conditions: str, parameters: list) -> dict[str, PyffyExif]:
+        rows = self.connection.execute("SELECT path, exif FROM referenceFiles WHERE " + conditions, parameters)
+        return {self.getAbsolutePath(relativePath): PyffyExif(json.loads(exifJson)) for relativePath, exifJson in rows}
+
+    def getReferenceFileRecords(self, exif: PyffyExif, settings: PyffySettings) -> dict[str, PyffyExif]:
+        # same rules as pyffyDB.getReferenceFileRecords, expressed as indexed queries
+        conditions = "cameraMaker IS ? AND cameraModel IS ? AND imageHeight = ? AND imageWidth = ? AND photometricInterpretation IS ? AND samplesPerPixel IS ?"
+        parameters = [exif.cameraMaker, exif.cameraModel, exif.imageHeight, exif.imageWidth, exif.photometricInterpretation, exif.samplesPerPixel]
+        if not settings.advIgnoreLensTag:
+            conditions += " AND lens IS ?"
+            parameters.append(exif.lens)
+
+        isStrictFocalLengthFound = self.connection.execute("SELECT EXISTS (SELECT 1 FROM referenceFiles WHERE " + conditions + " AND focalLength = ?)", parameters + [exif.focalLength]).fetchone()[0]
+        if isStrictFocalLengthFound:
+            conditions += " AND focalLength = ?"
+            parameters.append(exif.focalLength)
+        else:
+            # focalLength * (1 - p) <= exif focal length <= focalLength * (1 + p), rewritten as a range on the column
+            maxAllowedDifference = settings.advMaxAllowedFocalLengthDifferencePercent
+            conditions += " AND focalLength >= ?"
+            parameters.append(exif.focalLength / (1 + maxAllowedDifference))
+            if maxAllowedDifference < 1:
+                conditions += " AND focalLength <= ?"
+                parameters.append(exif.focalLength / (1 - maxAllowedDifference))
+
+        conditions += " AND fNumber IS ?"
+        parameters.append(exif.fNumber)
+
+        return self.query(conditions, parameters)
@@ -1,43 +1,54 @@
 import json
+import os
+import sys
 from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
 
-import cv2
-import numpy as np
-from numpy import float32, ndarray, uint16
+# NumPy and the modules which need it are imported by the functions using them, so the reference DB, settings and jobs helpers load without NumPy
+if TYPE_CHECKING:
+    from numpy import float32, ndarray, uint16
 
+# set by pyffyTuning for the geometry being processed, defaults are used when there is no tuning profile
+tunedParallelism: int | None = None
+blurEngine: str = "GaussianBlur"
+# set by pyffyResources, CPUs the process may use and threads OpenCV may start, OpenCV is configured when it is loaded
+cpuCount: int = os.cpu_count() or 1
+openCVThreads: int | None = None
+isOpenCVConfigured = False
 
-def correctLuminance(channels: ndarray[float32],
-                     referenceChannels: ndarray[float32],
+
+def correctLuminance(channels: "ndarray[float32]",
+                     referenceChannels: "ndarray[float32]",
                      colorPattern: [int],
                      luminanceCorrectionIntensity: float,
                      useMultithreading: bool,
-                     executor: ThreadPoolExecutor) -> (ndarray[float32], ndarray[float32]):
+                     executor: ThreadPoolExecutor) -> "(ndarray[float32], ndarray[float32])":
+    import numpy as np
+    import pyffyArena
     averagedGreenReferenceChannels = None
     greenChannelsCount = 0
     for i in range(channels.shape[0]):
         if colorPattern[i] == 1:
             greenChannelsCount += 1
             if averagedGreenReferenceChannels is None:
-                averagedGreenReferenceChannels = np.copy(referenceChannels[i])
+                averagedGreenReferenceChannels = pyffyArena.borrow(referenceChannels[i].shape, np.float32)
+                np.copyto(averagedGreenReferenceChannels, referenceChannels[i])
             else:
                 averagedGreenReferenceChannels += referenceChannels[i]
 
-    averagedGreenReferenceChannels = averagedGreenReferenceChannels / greenChannelsCount
+    averagedGreenReferenceChannels /= greenChannelsCount
 
     if useMultithreading:
-        futures = dict()
-        if luminanceCorrectionIntensity != 0:
+        futures = list()
+        bands = getBands(channels.shape[1], channels.shape[0])
+        for start, end in bands:
+            if luminanceCorrectionIntensity != 0:
+                for i in range(channels.shape[0]):
+                    futures.append(executor.submit(divideChannelBand, channels[i], averagedGreenReferenceChannels, luminanceCorrectionIntensity, start, end))
             for i in range(channels.shape[0]):
-                futures[i] = executor.submit(divideChannel, channels[i], averagedGreenReferenceChannels, luminanceCorrectionIntensity)
-            for i in range(len(futures)):
-                channels[i] = futures[i].result()
-            futures.clear()
-
-        for i in range(channels.shape[0]):
-            if colorPattern[i] != 1:
-                futures[i] = executor.submit(divideChannel, referenceChannels[i], averagedGreenReferenceChannels)
-        for key in futures.keys():
-            referenceChannels[key] = futures[key].result()
+                if colorPattern[i] != 1:
+                    futures.append(executor.submit(divideChannelBand, referenceChannels[i], averagedGreenReferenceChannels, 1.0, start, end))
+        waitForAll(futures)
     else:
         if luminanceCorrectionIntensity != 0:
             for i in range(channels.shape[0]):
@@ -46,20 +57,21 @@ def correctLuminance(channels: ndarray[float32],
         for i in range(channels.shape[0]):
             if colorPattern[i] != 1:
                 referenceChannels[i] = divideChannel(referenceChannels[i], averagedGreenReferenceChannels)
+    pyffyArena.giveBack(averagedGreenReferenceChannels)
     return channels, referenceChannels
 
 
-def correctColor(channels: ndarray[float32], referenceChannels: ndarray[float32], colorPattern: [], correctionIntensity: float, useMultithreading: bool = False, executor: ThreadPoolExecutor = None) -> ndarray[float32]:
+def correctColor(channels: "ndarray[float32]", referenceChannels: "ndarray[float32]", colorPattern: [], correctionIntensity: float, useMultithreading: bool = False, executor: ThreadPoolExecutor = None) -> "ndarray[float32]":
     if correctionIntensity == 0:
         return channels
 
     if useMultithreading:
-        futures = dict()
-        for i in range(channels.shape[0]):
-            if colorPattern[i] != 1:
-                futures[i] = executor.submit(divideChannel, channels[i], referenceChannels[i], correctionIntensity)
-        for key in futures.keys():
-            channels[key] = futures[key].result()
+        futures = list()
+        for start, end in getBands(channels.shape[1], channels.shape[0]):
+            for i in range(channels.shape[0]):
+                if colorPattern[i] != 1:
+                    futures.append(executor.submit(divideChannelBand, channels[i], referenceChannels[i], correctionIntensity, start, end))
+        waitForAll(futures)
     else:
         for i in range(channels.shape[0]):
             if colorPattern[i] != 1:
@@ -67,85 +79,207 @@ def correctColor(channels: ndarray[float32], referenceChannels: ndarray[float32]
     return channels
 
 
-def correctMonochrome(image: ndarray[float32], reference: ndarray[float32], luminanceCorrectionIntensity: float) -> ndarray[float32]:
-    return divideChannel(image, reference / np.max(reference), luminanceCorrectionIntensity)
+def correctMonochrome(image: "ndarray[float32]", reference: "ndarray[float32]", luminanceCorrectionIntensity: float, useMultithreading: bool = False, executor: ThreadPoolExecutor = None) -> "ndarray[float32]":
+    import numpy as np
+    if not useMultithreading or luminanceCorrectionIntensity == 0:
+        return divideChannel(image, reference / np.max(reference), luminanceCorrectionIntensity)
 
+    reference = normalizeChannels(reference.reshape((1, -1)), useMultithreading, executor)[0]
+    waitForAll([executor.submit(divideChannelBand, image, reference, luminanceCorrectionIntensity, start, end) for start, end in getBands(image.size, 1)])
+    return image
 
-def divideChannel(channel: ndarray[float32], reference: ndarray[float32], intensity: float = 1.0) -> ndarray[float32]:
+
+def divideChannel(channel: "ndarray[float32]", reference: "ndarray[float32]", intensity: float = 1.0, out: "ndarray[float32] | None" = None) -> "ndarray[float32]":
+    import numpy as np
     if intensity == 0:
         return channel
+    # pixels with zero reference stay zero
+    if out is None:
+        out = np.zeros_like(channel, dtype = np.float32)
+    else:
+        out.fill(0)
     if intensity == 1:
-        return np.divide(channel, reference, out = np.zeros_like(channel, dtype = float32), where = reference != 0)
+        return np.divide(channel, reference, out = out, where = reference != 0)
     else:
-        return np.divide(channel, 1 - (1 - reference * intensity), out = np.zeros_like(channel, dtype = float32), where = reference != 0)
+        return np.divide(channel, 1 - (1 - reference * intensity), out = out, where = reference != 0)
+
 
+def divideChannelBand(channel: "ndarray[float32]", reference: "ndarray[float32]", intensity: float, start: int, end: int):
+    import numpy as np
+    import pyffyArena
+    out = pyffyArena.borrow((end - start,), np.float32)
+    channel[start:end] = divideChannel(channel[start:end], reference[start:end], intensity, out)
+    pyffyArena.giveBack(out)
 
-def fitChannelsToAllowedRange(channels: ndarray[float32], blackLevels: [int], whiteLevels: [int], limitToWhiteLevel: bool, useMultithreading: bool, executor: ThreadPoolExecutor) -> ndarray[float32]:
+
+def fitChannelsToAllowedRange(channels: "ndarray[float32]",
+                              blackLevels: [int],
+                              whiteLevels: [int],
+                              limitToWhiteLevel: bool,
+                              useMultithreading: bool,
+                              executor: ThreadPoolExecutor,
+                              sourceChannels: "ndarray[uint16] | None" = None) -> "ndarray[float32]":
+    # sourceChannels are channels before correction with black subtracted, statistics are collected from them when they are provided
     if useMultithreading:
         futures = list()
-        for i in range(channels.shape[0]):
-            futures.append(executor.submit(fitChannelToAllowedRange, channels[i], getBlackWhiteLevel(blackLevels, i), getBlackWhiteLevel(whiteLevels, i), limitToWhiteLevel))
-        for i in range(channels.shape[0]):
-            channels[i] = futures[i].result()
+        for start, end in getBands(channels.shape[1], channels.shape[0]):
+            for i in range(channels.shape[0]):
+                futures.append(executor.submit(fitChannelBandToAllowedRange, channels[i], getBlackWhiteLevel(blackLevels, i), getBlackWhiteLevel(whiteLevels, i), limitToWhiteLevel, start, end, i, sourceChannels))
+        waitForAll(futures)
     else:
         for i in range(channels.shape[0]):
-            channels[i] = fitChannelToAllowedRange(channels[i], getBlackWhiteLevel(blackLevels, i), getBlackWhiteLevel(whiteLevels, i), limitToWhiteLevel)
+            channels[i] = fitChannelToAllowedRange(channels[i], getBlackWhiteLevel(blackLevels, i), getBlackWhiteLevel(whiteLevels, i), limitToWhiteLevel, i, None if sourceChannels is None else sourceChannels[i])
 
     return channels
 
 
-def fitChannelToAllowedRange(channel: ndarray[float32], blackLevel: int, whiteLevel: int, limitToWhiteLevel: bool) -> ndarray[float32]:
+def fitChannelToAllowedRange(channel: "ndarray[float32]", blackLevel: int, whiteLevel: int, limitToWhiteLevel: bool, channelIndex: int = 0, sourceChannel: "ndarray[uint16] | None" = None) -> "ndarray[float32]":
+    import numpy as np
+    import pyffyStatistics
+    gain = None
+    if sourceChannel is not None:
+        # gain is known only for pixels above black
+        isAboveBlack = sourceChannel != 0
+        gain = channel[isAboveBlack] / sourceChannel[isAboveBlack]
+
     channel += blackLevel
 
     if not limitToWhiteLevel:
         whiteLevel = 65535
 
-    channel = np.clip(channel, a_min = 0, a_max = whiteLevel)
+    if gain is not None:
+        # values are at hand before the clip, so statistics do not need another pass over the image
+        pyffyStatistics.addChannel(channelIndex, sourceChannel, 0, gain, channel, whiteLevel)
+
+    np.clip(channel, a_min = 0, a_max = whiteLevel, out = channel)
 
     return channel
 
 
-def blurChannels(channels: ndarray[float32], height: int, width: int, gaussianFilterSigma: float, useMultithreading: bool, executor: ThreadPoolExecutor) -> ndarray[float32]:
+def fitChannelBandToAllowedRange(channel: "ndarray[float32]", blackLevel: int, whiteLevel: int, limitToWhiteLevel: bool, start: int, end: int, channelIndex: int = 0, sourceChannels: "ndarray[uint16] | None" = None):
+    sourceChannel = None if sourceChannels is None else sourceChannels[channelIndex][start:end]
+    channel[start:end] = fitChannelToAllowedRange(channel[start:end], blackLevel, whiteLevel, limitToWhiteLevel, channelIndex, sourceChannel)
+
+
+def blurChannels(channels: "ndarray[float32]", height: int, width: int, gaussianFilterSigma: float, useMultithreading: bool, executor: ThreadPoolExecutor) -> "ndarray[float32]":
+    import numpy as np
+    import pyffyArena
+    result = pyffyArena.borrow(channels.shape, np.float32)
     if useMultithreading:
-        futures = []
-        for i in range(channels.shape[0]):
-            futures.append(executor.submit(blurChannel, channels[i], height, width, gaussianFilterSigma))
-        result = np.empty_like(channels, dtype = float32)
-        for i in range(channels.shape[0]):
-            result[i] = futures[i].result()
+        # bands are blurred with a halo of kernel radius rows, so results are identical to blurring the whole channel
+        halo = getGaussianKernelRadius(gaussianFilterSigma)
+        futures = list()
+        for start, end in getBands(height, channels.shape[0], halo):
+            for i in range(channels.shape[0]):
+                futures.append(executor.submit(blurChannelBand, channels[i], result[i], height, width, gaussianFilterSigma, halo, start, end))
+        waitForAll(futures)
     else:
-        result = np.empty_like(channels, dtype = float32)
         for i in range(channels.shape[0]):
             result[i] = blurChannel(channels[i], height, width, gaussianFilterSigma)
     return result
 
 
-def blurChannel(channel: ndarray[float32], height: int, width: int, gaussianFilterSigma: float) -> ndarray[float32]:
+def blurChannel(channel: "ndarray[float32]", height: int, width: int, gaussianFilterSigma: float) -> "ndarray[float32]":
     channel = channel.reshape(height, width)
-    channel = cv2.GaussianBlur(channel, (0, 0), gaussianFilterSigma, gaussianFilterSigma)
+    channel = gaussianBlur(channel, gaussianFilterSigma)
     return channel.reshape(-1)
 
 
-def normalizeChannels(channels: ndarray[float32], useMultithreading: bool, executor: ThreadPoolExecutor) -> ndarray[float32]:
+def blurChannelBand(channel: "ndarray[float32]", result: "ndarray[float32]", height: int, width: int, gaussianFilterSigma: float, halo: int, start: int, end: int):
+    haloStart = max(0, start - halo)
+    haloEnd = min(height, end + halo)
+    band = gaussianBlur(channel.reshape(height, width)[haloStart:haloEnd], gaussianFilterSigma)
+    result.reshape(height, width)[start:end] = band[start - haloStart:end - haloStart]
+
+
+def gaussianBlur(image: "ndarray[float32]", gaussianFilterSigma: float) -> "ndarray[float32]":
+    cv2 = getOpenCV()
+    if blurEngine == "sepFilter2D":
+        # same kernel and border as GaussianBlur, but OpenCV picks another implementation, which is faster on some CPUs
+        kernel = cv2.getGaussianKernel(getGaussianKernelRadius(gaussianFilterSigma) * 2 - 1, gaussianFilterSigma, cv2.CV_32F)
+        return cv2.sepFilter2D(image, -1, kernel, kernel)
+    return cv2.GaussianBlur(image, (0, 0), gaussianFilterSigma, gaussianFilterSigma)
+
+
+def getOpenCV():
+    global isOpenCVConfigured
+    import cv2
+    if not isOpenCVConfigured:
+        isOpenCVConfigured = True
+        if openCVThreads is not None:
+            cv2.setNumThreads(openCVThreads)
+    return cv2
+
+
+def setOpenCVThreads(threads: int):
+    # OpenCV is loaded on the first blur, so startup is not slowed down by it, threads are set then if it is not loaded yet
+    global openCVThreads, isOpenCVConfigured
+    openCVThreads = threads
+    isOpenCVConfigured = False
+    if "cv2" in sys.modules:
+        getOpenCV()
+
+
+def getGaussianKernelRadius(gaussianFilterSigma: float) -> int:
+    # same kernel size as cv2.GaussianBlur chooses for float images when ksize is (0, 0)
+    return (int(round(gaussianFilterSigma * 8 + 1)) | 1) // 2 + 1
+
+
+def resizeChannel(channel: "ndarray[float32]", height: int, width: int, newHeight: int, newWidth: int) -> "ndarray[float32]":
+    cv2 = getOpenCV()
+    channel = channel.reshape(height, width)
+    interpolation = cv2.INTER_AREA if newHeight < height else cv2.INTER_LINEAR
+    channel = cv2.resize(channel, (newWidth, newHeight), interpolation = interpolation)
+    return channel.reshape(-1)
+
+
+def normalizeChannels(channels: "ndarray[float32]", useMultithreading: bool, executor: ThreadPoolExecutor) -> "ndarray[float32]":
+    import numpy as np
+    import pyffyArena
+    result = pyffyArena.borrow(channels.shape, np.float32)
     if useMultithreading:
-        futures = []
-        for i in range(channels.shape[0]):
-            futures.append(executor.submit(scaleChannel, channels[i]))
-        result = np.empty_like(channels, dtype = float32)
-        for i in range(channels.shape[0]):
-            result[i] = futures[i].result()
+        bands = getBands(channels.shape[1], channels.shape[0])
+        maxFutures = [[executor.submit(np.max, channels[i][start:end]) for start, end in bands] for i in range(channels.shape[0])]
+        maxValues = [max(future.result() for future in futures) for futures in maxFutures]
+
+        futures = list()
+        for start, end in bands:
+            for i in range(channels.shape[0]):
+                futures.append(executor.submit(np.divide, channels[i][start:end], maxValues[i], out = result[i][start:end]))
+        waitForAll(futures)
     else:
-        result = np.empty_like(channels, dtype = float32)
         for i in range(channels.shape[0]):
             result[i] = scaleChannel(channels[i])
     return result
 
 
-def scaleChannel(channel: ndarray[float32]) -> ndarray[float32]:
+def scaleChannel(channel: "ndarray[float32]") -> "ndarray[float32]":
+    import numpy as np
     return channel / np.max(channel)
 
 
+def channelsToFloat(channels: "ndarray") -> "ndarray[float32]":
+    import numpy as np
+    import pyffyArena
+    result = pyffyArena.borrow(channels.shape, np.float32)
+    np.copyto(result, channels)
+    return result
+
+
+def getBands(size: int, tasksCount: int, minBandSize: int = 1) -> [(int, int)]:
+    parallelism = tunedParallelism if tunedParallelism is not None else cpuCount
+    bandsCount = max(1, min(-(-parallelism // tasksCount), size // max(1, minBandSize)))
+    bandSize = -(-size // bandsCount)
+    return [(start, min(start + bandSize, size)) for start in range(0, size, bandSize)]
+
+
+def waitForAll(futures: list):
+    for future in futures:
+        future.result()
+
+
 def calculateEVDifference(value1: float, value2: float) -> float:
+    import numpy as np
     return np.fabs(np.round(np.log10(np.pow(value1 / value2, 2)) / np.log10(2)))
 
 
@@ -153,7 +287,7 @@ def dictToJson(content) -> str:
     return json.dumps(content, indent = 4, default = lambda x: x.__dict__)
 
 
-def subtractBlack(channels: ndarray[float32], blackLevels: [int]) -> ndarray[float32]:
+def subtractBlack(channels: "ndarray[float32]", blackLevels: [int]) -> "ndarray[float32]":
     for i in range(channels.shape[0]):
         blackLevel = getBlackWhiteLevel(blackLevels, i)
         if blackLevel != 0:
@@ -161,7 +295,7 @@ def subtractBlack(channels: ndarray[float32], blackLevels: [int]) -> ndarray[flo
     return channels
 
 
-def addBlack(channels: ndarray[float32], blackLevels: [int]) -> ndarray[float32]:
+def addBlack(channels: "ndarray[float32]", blackLevels: [int]) -> "ndarray[float32]":
     for i in range(channels.shape[0]):
         blackLevel = getBlackWhiteLevel(blackLevels, i)
         if blackLevel != 0:
@@ -169,11 +303,11 @@ def addBlack(channels: ndarray[float32], blackLevels: [int]) -> ndarray[float32]
     return channels
 
 
-def getActiveAreaPixels(image: ndarray[uint16], height: int, width: int, activeArea: [int]) -> ndarray[uint16]:
+def getActiveAreaPixels(image: "ndarray[uint16]", height: int, width: int, activeArea: [int]) -> "ndarray[uint16]":
     return image.reshape(height, width)[activeArea[0]:activeArea[2], activeArea[1]:activeArea[3]]
 
 
-def setActiveAreaPixels(image: ndarray[float32], activeAreaImage: ndarray[float32], height: int, width: int, activeArea: [int]) -> ndarray[float32]:
+def setActiveAreaPixels(image: "ndarray[float32]", activeAreaImage: "ndarray[float32]", height: int, width: int, activeArea: [int]) -> "ndarray[float32]":
     image = image.reshape(height, width)
     activeAreaImage = activeAreaImage.reshape(activeArea[2] - activeArea[0], activeArea[3] - activeArea[1])
     image[activeArea[0]:activeArea[2], activeArea[1]:activeArea[3]] = activeAreaImage
@@ -190,6 +324,7 @@ def getBlackWhiteLevel(levels: [int], channelIndex: int) -> int:
 
 
 def getMinBlackWhiteLevel(levels: [int]) -> int:
+    import numpy as np
     if len(levels) == 0:
         return 0
     else:
@@ -197,23 +332,25 @@ def getMinBlackWhiteLevel(levels: [int]) -> int:
 
 
 def getMaxBlackWhiteLevel(levels: [int]) -> int:
+    import numpy as np
     if len(levels) == 0:
         return 0
     else:
         return np.max(levels)
 
 
-def bitwiseMask(data: ndarray[uint16], bits: int, leaveLSB: bool) -> ndarray[uint16]:
-    mask = uint16(0xffff)
+def bitwiseMask(data: "ndarray[uint16]", bits: int, leaveLSB: bool) -> "ndarray[uint16]":
+    import numpy as np
+    mask = np.uint16(0xffff)
     if bits > 16:
         bits = 16
     elif bits < 0:
         bits = 0
 
     if leaveLSB:
-        mask ^= uint16(mask << bits)
+        mask ^= np.uint16(mask << bits)
     else:
-        mask &= uint16(mask << 16 - bits)
+        mask &= np.uint16(mask << 16 - bits)
 
     data &= mask
 
@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from numpy import float32, ndarray, uint16
+
+import pyffy
+from pyffyExif import PyffyExif
+from pyffySettings import PyffySettings
+
+
+class PyffyCorrector:
+    def __init__(self,
+                 referenceExif: PyffyExif | dict,
+                 settings: PyffySettings | None = None,
+                 reference: ndarray[uint16] | None = None,
+                 referenceChannels: ndarray[float32] | None = None,
+                 executor: ThreadPoolExecutor | None = None):
+        # reference is a raw reference image, referenceChannels are already blurred and normalized ones (from the gain map store or vignetting model)
+        self.referenceExif = toExif(referenceExif)
+        self.settings = settings if settings is not None else PyffySettings()
+        self.pipeline = pyffy.getPipeline(self.referenceExif)
+        self.channelsGeometry = self.pipeline.getChannelsGeometry(self.referenceExif)
+
+        self.isExecutorOwned = executor is None and self.settings.useMultithreading
+        self.executor = ThreadPoolExecutor() if self.isExecutorOwned else executor
+
+        if referenceChannels is not None:
+            self.referenceChannels = referenceChannels
+        elif reference is not None:
+            self.referenceChannels = self.pipeline.prepareReference(reference.reshape(-1), self.referenceExif, self.referenceExif, self.settings, self.executor)
+        else:
+            raise ValueError("Either reference or referenceChannels must be provided")
+
+        channelsCount, height, width = self.channelsGeometry
+        if self.referenceChannels.shape != (channelsCount, height * width):
+            raise ValueError("Reference channels shape is {0}, expected {1}".format(self.referenceChannels.shape, (channelsCount, height * width)))
+
+    def correct(self, image: ndarray[uint16], exif: PyffyExif | dict, out: ndarray[uint16] | None = None) -> ndarray[uint16]:
+        exif = toExif(exif)
+        if self.pipeline is not pyffy.getPipeline(exif) or self.pipeline.getChannelsGeometry(exif) != self.channelsGeometry:
+            raise ValueError("Image geometry or type does not match the reference")
+
+        if out is None:
+            out = np.empty_like(image, dtype = uint16)
+        elif out.size != image.size or out.dtype != uint16:
+            raise ValueError("Output buffer must be uint16 and have the same size as the image")
+
+        # pipelines modify both image and reference channels in place, so they work on copies
+        # reshape of non contiguous output would be a copy, so such output gets the result only when it is complete
+        work = out if out.flags.c_contiguous else np.empty(image.size, dtype = uint16)
+        np.copyto(work.reshape(-1), image.reshape(-1))
+        result = self.pipeline.correct(work.reshape(-1), np.copy(self.referenceChannels), exif, self.settings, self.executor)
+        if work is not out or not np.shares_memory(result, out):
+            out[...] = result.reshape(out.shape)
+        return out
+
+    def correctBatch(self, images: [ndarray[uint16]], exifs: [PyffyExif | dict], outs: list[ndarray[uint16]] | None = None) -> [ndarray[uint16]]:
+        if len(images) != len(exifs) or outs is not None and len(outs) != len(images):
+            raise ValueError("Images, exifs and output buffers counts must be equal")
+
+        return [self.correct(images[i], exifs[i], None if outs is None else outs[i]) for i in range(len(images))]
+
+    def close(self):
+        if self.isExecutorOwned:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+
+def toExif(exif: PyffyExif | dict) -> PyffyExif:
+    return PyffyExif(exif) if isinstance(exif, dict) else exif
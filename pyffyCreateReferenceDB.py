@@ -3,6 +3,13 @@ import sys
 import pyffy
 
 if len(sys.argv) == 1:
-    pyffy.prepareReferenceDB(u".")
+    referenceFilesRootFolder = u"."
 elif len(sys.argv) == 2:
-    pyffy.prepareReferenceDB(sys.argv[1])
+    referenceFilesRootFolder = sys.argv[1]
+else:
+    pyffy.exitWithPrompt("Only one folder can be provided to this script. Exiting now.")
+
+settings = pyffy.loadSettingsOrDefault()
+referenceDB = pyffy.prepareReferenceDB(referenceFilesRootFolder, settings)
+if settings.advUseGainMapStore:
+    pyffy.precomputeGainMaps(referenceFilesRootFolder, referenceDB, settings)
@@ -1,5 +1,7 @@
 import json
+from typing import Callable
 
+import pyffyCatalog
 import pyffyCommon
 import pyffyExif
 import pyffyIO
@@ -24,12 +26,16 @@ class SettingsForTwoPassProcessing:
             [setattr(self, key, val) for key, val in jsonDict.items() if hasattr(self, key)]
 
 
-def createSettingsForTwoPassProcessing(files: list[str], rootFolder: str, referenceDB: dict[str, PyffyExif], settings: PyffySettings) -> dict[str, SettingsForTwoPassProcessing]:
+def createSettingsForTwoPassProcessing(files: list[str],
+                                       rootFolder: str,
+                                       referenceDB: dict[str, PyffyExif] | pyffyCatalog.PyffyReferenceCatalog,
+                                       settings: PyffySettings,
+                                       getExif: Callable[[str], PyffyExif | None] = pyffyExif.getExif) -> dict[str, SettingsForTwoPassProcessing]:
     processingSettingsDict = dict[str, SettingsForTwoPassProcessing]()
 
     for fileName in files:
         print(fileName)
-        exif = pyffyExif.getExif(fileName = fileName)
+        exif = getExif(fileName)
         if exif is None or settings.advUpdateDngSoftwareTagToAvoidOverprocessing and pyffyExif.isFileAlreadyProcessed(exif):
             continue
 
@@ -91,7 +97,10 @@ def parseReferenceDB(valueString: str | None) -> dict[str, PyffyExif] | None:
     return referenceDB
 
 
-def getReferenceFileRecords(referenceDB: dict[str, PyffyExif], exif: PyffyExif, settings: PyffySettings) -> dict[str, pyffyExif.PyffyExif]:
+def getReferenceFileRecords(referenceDB: dict[str, PyffyExif] | pyffyCatalog.PyffyReferenceCatalog, exif: PyffyExif, settings: PyffySettings) -> dict[str, pyffyExif.PyffyExif]:
+    if isinstance(referenceDB, pyffyCatalog.PyffyReferenceCatalog):
+        return referenceDB.getReferenceFileRecords(exif, settings)
+
     referenceDB = filterByCameraMaker(referenceDB, exif)
     referenceDB = filterByCameraModel(referenceDB, exif)
     referenceDB = filterByLens(referenceDB, exif, settings)
@@ -0,0 +1,90 @@
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from numpy import ndarray, uint16
+
+from pyffyExif import PyffyExif
+from pyffyIO import PositionalFile
+
+newRawImageDigestTag = 0xC7A7
+newRawImageDigestSize = 16
+# DNG SDK hashes the raw image in tiles of this size and then hashes the sequence of tile digests
+digestTileSize = 256
+
+
+def getNewRawImageDigest(image: "ndarray[uint16]", exif: PyffyExif, executor: ThreadPoolExecutor | None) -> bytes:
+    image = image.reshape(exif.imageHeight, exif.imageWidth * exif.samplesPerPixel)
+    tiles = getDigestTiles(exif.imageHeight, exif.imageWidth)
+    if executor is None:
+        tileDigests = [getTileDigest(image, top, left, bottom, right, exif.samplesPerPixel) for top, left, bottom, right in tiles]
+    else:
+        futures = [executor.submit(getTileDigest, image, top, left, bottom, right, exif.samplesPerPixel) for top, left, bottom, right in tiles]
+        tileDigests = [future.result() for future in futures]
+    return combineTileDigests(tileDigests)
+
+
+def getDigestTiles(height: int, width: int) -> [(int, int, int, int)]:
+    return [(top, left, min(top + digestTileSize, height), min(left + digestTileSize, width))
+            for top in range(0, height, digestTileSize)
+            for left in range(0, width, digestTileSize)]
+
+
+def getTileDigest(image: "ndarray[uint16]", top: int, left: int, bottom: int, right: int, samplesPerPixel: int) -> bytes:
+    # image rows are interleaved samples, tile is hashed plane after plane as 16-bit little-endian values
+    block = image[top:bottom, left * samplesPerPixel:right * samplesPerPixel]
+    return getBlockDigest(block, samplesPerPixel)
+
+
+def getBlockDigest(block: "ndarray[uint16]", samplesPerPixel: int) -> bytes:
+    import hashlib
+    import numpy as np
+    height, width = block.shape
+    planes = block.reshape(height, width // samplesPerPixel, samplesPerPixel).transpose(2, 0, 1)
+    return hashlib.md5(np.ascontiguousarray(planes, dtype = "<u2").tobytes()).digest()
+
+
+def combineTileDigests(tileDigests: [bytes]) -> bytes:
+    import hashlib
+    return hashlib.md5(b"".join(tileDigests)).digest()
+
+
+def getNewRawImageDigestOffset(fileName: str) -> int | None:
+    file = PositionalFile(fileName)
+    try:
+        return findNewRawImageDigestOffset(file)
+    finally:
+        file.close()
+
+
+def writeNewRawImageDigest(fileName: str, valueOffset: int, digest: bytes):
+    # digest is written over the existing tag value, so the file is not rewritten
+    file = PositionalFile(fileName, writable = True)
+    try:
+        file.writeAt(valueOffset, digest)
+    finally:
+        file.close()
+
+
+def findNewRawImageDigestOffset(file: PositionalFile) -> int | None:
+    # NewRawImageDigest is stored in IFD 0, returns None if there is no such tag and -1 if it has unexpected format
+    header = file.readAt(0, 8)
+    byteOrder = "<" if header[:2] == b"II" else ">"
+    ifdOffset = struct.unpack(byteOrder + "I", header[4:8])[0]
+
+    entriesCount = struct.unpack(byteOrder + "H", file.readAt(ifdOffset, 2))[0]
+    entries = file.readAt(ifdOffset + 2, entriesCount * 12)
+    for i in range(entriesCount):
+        tag, tagType, count, valueOffset = struct.unpack(byteOrder + "HHII", entries[i * 12:i * 12 + 12])
+        if tag != newRawImageDigestTag:
+            continue
+        # BYTE or UNDEFINED, 16 bytes do not fit into the entry, so the value is stored at the offset
+        if tagType not in [1, 7] or count != newRawImageDigestSize:
+            return -1
+        return valueOffset
+    return None
+
+
+def isFileTilingMatchingDigest(exif: PyffyExif) -> bool:
+    return exif.tileWidth == digestTileSize and exif.tileLength == digestTileSize
@@ -1,3 +1,4 @@
+import copy
 import json
 import subprocess
 
@@ -25,9 +26,18 @@ class PyffyExif:
         self.dataOffset: int = 0
         self.dataSizeInWords: int = 0
         self.colorPattern: [int] = []
+        self.cfaRepeatPatternDim: [int] = []
+        self.blackLevelRepeatDim: [int] = []
         self.photometricInterpretation: str = ""
         self.samplesPerPixel: int = 0
         self.software: str = ""
+        self.tileWidth: int = 0
+        self.tileLength: int = 0
+        self.tileOffsets: [int] = []
+        self.tileByteCounts: [int] = []
+        self.vignettingModel: dict | None = None
+        # data layout of every raw frame after the first one in multi-frame (pixel shift) files, see getDataLayout
+        self.frames: [dict] = []
 
         if jsonDict is not None:
             [setattr(self, key, val) for key, val in jsonDict.items() if hasattr(self, key)]
@@ -38,6 +48,23 @@ class PyffyExif:
     def isFileMonochrome(self):
         return self.isFileLinear() and self.samplesPerPixel == 1
 
+    def isFileTiled(self) -> bool:
+        return len(self.tileOffsets) != 0
+
+    def isFileMultiFrame(self) -> bool:
+        return len(self.frames) != 0
+
+    def getFrames(self) -> list["PyffyExif"]:
+        # frames share geometry, levels and color pattern, only data layout differs
+        frames = [self]
+        for frameLayout in self.frames:
+            frame = copy.copy(self)
+            frame.frames = []
+            frame.tileWidth, frame.tileLength, frame.tileOffsets, frame.tileByteCounts = 0, 0, [], []
+            [setattr(frame, key, val) for key, val in frameLayout.items()]
+            frames.append(frame)
+        return frames
+
     def isFileAlreadyProcessed(self) -> bool:
         return self.software.count("pyffy") == 1
 
@@ -62,21 +89,22 @@ def getExif(fileName: str = None, exifDict: dict = None) -> PyffyExif | None:
     pyffyExif.focalLength = parseFocalLength(findExifValue(exifDict, "FocalLength"))
     pyffyExif.software = findExifValue(exifDict, "Software")
 
-    cfaExif = None
-    # dng can contain many images like previews altogether with CFA image, looking for CFA section
+    # dng can contain many images like previews altogether with CFA image, looking for CFA sections, pixel shift files have one per frame
+    rawExifs = []
     for exifSubdict in exifDict.values():
         if type(exifSubdict) is not dict:
             continue
         photometricInterpretation = dict(exifSubdict).get("PhotometricInterpretation")
         if photometricInterpretation in supportedPhotometricInterpretations and isFileSupported(exifSubdict):
-            cfaExif = exifSubdict
-            pyffyExif.photometricInterpretation = photometricInterpretation
-            break
+            rawExifs.append(exifSubdict)
 
-    if cfaExif is None:
+    if len(rawExifs) == 0:
         print("File does not contain supported raw image.")
         return None
 
+    cfaExif = rawExifs[0]
+    pyffyExif.photometricInterpretation = cfaExif.get("PhotometricInterpretation")
+
     pyffyExif.imageHeight = cfaExif.get("ImageHeight")
     pyffyExif.imageWidth = cfaExif.get("ImageWidth")
 
@@ -109,34 +137,64 @@ def getExif(fileName: str = None, exifDict: dict = None) -> PyffyExif | None:
     except:
         pass
 
-    stripOffsets = cfaExif.get("StripOffsets")
-    if type(stripOffsets) is str:
-        pyffyExif.dataOffset = int(stripOffsets.split(" ")[0])
-    elif type(stripOffsets) is int:
-        pyffyExif.dataOffset = stripOffsets
-
-    stripByteCounts = cfaExif.get("StripByteCounts")
-    if type(stripByteCounts) is str:
-        stripByteCounts = stripByteCounts.split(" ")
-        pyffyExif.dataSizeInWords = 0
-        for stripByteCount in stripByteCounts:
-            pyffyExif.dataSizeInWords += int(stripByteCount)
-    elif type(stripByteCounts) is int:
-        pyffyExif.dataSizeInWords = stripByteCounts
-    pyffyExif.dataSizeInWords = pyffyExif.dataSizeInWords // 2
+    [setattr(pyffyExif, key, val) for key, val in getDataLayout(cfaExif).items()]
 
     cfaPattern = getExifValue(cfaExif, "CFAPattern2")
     if cfaPattern is not None:  # bayer dng
         for item in cfaPattern.split(" "):
             pyffyExif.colorPattern.append(int(item))
+        # 2 2 for Bayer, 6 6 for X-Trans, colors are listed row by row
+        pyffyExif.cfaRepeatPatternDim = parseIntList(getExifValue(cfaExif, "CFARepeatPatternDim"))
+        # black levels repeat on their own grid, usually 1 1 or 2 2, also for X-Trans
+        pyffyExif.blackLevelRepeatDim = parseIntList(getExifValue(cfaExif, "BlackLevelRepeatDim"))
 
     pyffyExif.samplesPerPixel = getExifValue(cfaExif, "SamplesPerPixel")
     if pyffyExif.photometricInterpretation == "Linear Raw" and pyffyExif.samplesPerPixel == 3:  # linear color dng
         pyffyExif.colorPattern = [0, 1, 2]
 
+    for frameExif in rawExifs[1:]:
+        if not isFrameMatching(cfaExif, frameExif):
+            print("File contains raw image of other geometry, it is ignored.")
+            continue
+        pyffyExif.frames.append(getDataLayout(frameExif))
+
     return pyffyExif
 
 
+def getDataLayout(rawExif: dict) -> dict:
+    dataOffset = 0
+    stripOffsets = rawExif.get("StripOffsets")
+    if type(stripOffsets) is str:
+        dataOffset = int(stripOffsets.split(" ")[0])
+    elif type(stripOffsets) is int:
+        dataOffset = stripOffsets
+
+    dataSizeInWords = 0
+    stripByteCounts = rawExif.get("StripByteCounts")
+    if type(stripByteCounts) is str:
+        stripByteCounts = stripByteCounts.split(" ")
+        for stripByteCount in stripByteCounts:
+            dataSizeInWords += int(stripByteCount)
+    elif type(stripByteCounts) is int:
+        dataSizeInWords = stripByteCounts
+    dataSizeInWords = dataSizeInWords // 2
+
+    layout = {"dataOffset": dataOffset, "dataSizeInWords": dataSizeInWords}
+    tileOffsets = parseIntList(rawExif.get("TileOffsets"))
+    if len(tileOffsets) != 0:
+        layout["tileWidth"] = getExifValue(rawExif, "TileWidth")
+        layout["tileLength"] = getExifValue(rawExif, "TileLength")
+        layout["tileOffsets"] = tileOffsets
+        layout["tileByteCounts"] = parseIntList(rawExif.get("TileByteCounts"))
+        layout["dataOffset"] = tileOffsets[0]
+        layout["dataSizeInWords"] = sum(layout["tileByteCounts"]) // 2
+    return layout
+
+
+def isFrameMatching(rawExif: dict, frameExif: dict) -> bool:
+    return all(rawExif.get(tagName) == frameExif.get(tagName) for tagName in ["PhotometricInterpretation", "ImageWidth", "ImageHeight", "SamplesPerPixel", "CFAPattern2", "CFARepeatPatternDim"])
+
+
 def parseFocalLength(focalLengthStr: str) -> float:
     try:
         return float(str(focalLengthStr).removesuffix("mm").strip())
@@ -144,6 +202,15 @@ def parseFocalLength(focalLengthStr: str) -> float:
         return 0
 
 
+def parseIntList(value: str | int | None) -> [int]:
+    if type(value) is int:
+        return [value]
+    elif type(value) is str:
+        return [int(item) for item in value.split(" ") if len(item) != 0]
+    else:
+        return []
+
+
 def getExifValue(exifDict: dict, tagName: str) -> str | int | float | None:
     value = exifDict.get(tagName)
     if value is None:
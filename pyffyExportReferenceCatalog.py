@@ -0,0 +1,10 @@
+import sys
+
+import pyffy
+
+if len(sys.argv) == 1:
+    pyffy.exportReferenceCatalog(u".")
+elif len(sys.argv) == 2:
+    pyffy.exportReferenceCatalog(sys.argv[1])
+else:
+    pyffy.exitWithPrompt("Only one folder can be provided to this script. Exiting now.")
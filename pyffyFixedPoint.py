@@ -0,0 +1,113 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from numpy import float32, ndarray, uint16, uint32
+
+import pyffyArena
+import pyffyCommon
+import pyffyStatistics
+import pyffyTiles
+from pyffyExif import PyffyExif
+from pyffySettings import PyffySettings
+
+# image is corrected in bands of this many rows, uint32 accumulator of a band stays in CPU cache
+fixedPointBandRows = 64
+# exif fields which the gains depend on, the others differ from file to file without changing them
+correctionExifFields = ["imageHeight", "imageWidth", "activeArea", "blackLevels", "blackLevelRepeatDim", "whiteLevels", "colorPattern", "cfaRepeatPatternDim", "photometricInterpretation", "samplesPerPixel"]
+
+
+class PyffyFixedPointCorrection:
+    def __init__(self, correction: pyffyTiles.PyffyTileCorrection):
+        # gain is stored as unsigned Q format with as many fractional bits as the largest gain allows
+        maxGain = float(np.max(correction.gainRaster)) if correction.gainRaster.size != 0 else 1.0
+        self.fractionalBits = getFractionalBits(maxGain)
+        # one temporary float raster is made, rounding and clipping work in it
+        gainRaster = correction.gainRaster * float32(1 << self.fractionalBits)
+        np.rint(gainRaster, out = gainRaster)
+        np.clip(gainRaster, 0, 65535, out = gainRaster)
+        self.gainRaster = gainRaster.astype(uint16)
+        self.area = correction.area
+        self.blackLevelsPattern = correction.blackLevelsPattern.astype(uint16)
+        self.whiteLevelsPattern = correction.whiteLevelsPattern.astype(uint16)
+        # single level for all channels is the usual case, it is applied as a scalar without building a pattern block
+        self.blackLevel = getUniformLevel(self.blackLevelsPattern)
+        self.whiteLevel = getUniformLevel(self.whiteLevelsPattern)
+
+    def correctBlock(self, block: ndarray[uint16], top: int, left: int) -> ndarray[uint16]:
+        return correctBlock(block, top, left, self)
+
+
+# correction of the last reference, consecutive files almost always share it, so its gains are prepared once for all of them
+cachedKey: str | None = None
+cachedCorrection: PyffyFixedPointCorrection | None = None
+
+
+def getCacheKey(referenceFilePath: str, exif: PyffyExif, settings: PyffySettings) -> str:
+    # any setting may change the gains, so all of them are in the key, changed reference file gets a new key through its size and modification time
+    stat = os.stat(referenceFilePath)
+    return pyffyCommon.dictToJson({"reference": [referenceFilePath, stat.st_size, stat.st_mtime_ns],
+                                   "exif": {field: getattr(exif, field) for field in correctionExifFields},
+                                   "settings": settings})
+
+
+def getCachedCorrection(key: str) -> PyffyFixedPointCorrection | None:
+    return cachedCorrection if key == cachedKey else None
+
+
+def cacheCorrection(key: str, correction: PyffyFixedPointCorrection):
+    global cachedKey, cachedCorrection
+    cachedKey, cachedCorrection = key, correction
+
+
+def getFractionalBits(maxGain: float) -> int:
+    integerBits = max(1, int(np.ceil(np.log2(maxGain + 1))))
+    return max(0, 16 - integerBits)
+
+
+def getUniformLevel(pattern: ndarray[uint16]) -> int | None:
+    return int(pattern.flat[0]) if np.all(pattern == pattern.flat[0]) else None
+
+
+def correctBlock(block: ndarray[uint16], top: int, left: int, correction: PyffyFixedPointCorrection, accumulator: ndarray[uint32] | None = None) -> ndarray[uint16]:
+    # (value - black) * gain fits into uint32 for any uint16 value and gain, so no wider type is needed
+    height, width = block.shape
+    if accumulator is None:
+        accumulator = np.empty((height, width), dtype = uint32)
+    accumulator = accumulator[:height, :width]
+    gain = correction.gainRaster[top:top + height, left:left + width]
+    blackLevels = correction.blackLevel if correction.blackLevel is not None else pyffyTiles.getPatternBlock(correction.blackLevelsPattern, top, left, height, width)
+    whiteLevels = correction.whiteLevel if correction.whiteLevel is not None else pyffyTiles.getPatternBlock(correction.whiteLevelsPattern, top, left, height, width)
+
+    np.maximum(block, blackLevels, out = accumulator, casting = "unsafe")
+    accumulator -= blackLevels
+    accumulator *= gain
+    # shift truncates the same way as the float path cast does
+    accumulator >>= correction.fractionalBits
+    accumulator += blackLevels
+    pyffyStatistics.addBlock(block, gain, accumulator, correction.blackLevelsPattern, correction.whiteLevelsPattern, top, left, 1 / (1 << correction.fractionalBits))
+    np.minimum(accumulator, whiteLevels, out = accumulator)
+    np.copyto(block, accumulator, casting = "unsafe")
+    return block
+
+
+def correctImage(image: ndarray[uint16], exif: PyffyExif, correction: PyffyFixedPointCorrection, executor: ThreadPoolExecutor | None) -> ndarray[uint16]:
+    # image is corrected in place, nothing of the image size is allocated
+    image2d = image.reshape(exif.imageHeight, exif.imageWidth * exif.samplesPerPixel)
+    areaTop, _, areaBottom, _ = correction.area
+    bands = pyffyCommon.getBands(areaBottom - areaTop, 1, fixedPointBandRows)
+    if executor is None:
+        for start, end in bands:
+            correctBand(image2d, correction, start, end)
+    else:
+        pyffyCommon.waitForAll([executor.submit(correctBand, image2d, correction, start, end) for start, end in bands])
+    return image
+
+
+def correctBand(image: ndarray[uint16], correction: PyffyFixedPointCorrection, start: int, end: int):
+    areaTop, areaLeft, _, areaRight = correction.area
+    accumulator = pyffyArena.borrow((fixedPointBandRows, areaRight - areaLeft), uint32)
+    for top in range(start, end, fixedPointBandRows):
+        bottom = min(top + fixedPointBandRows, end)
+        correctBlock(image[areaTop + top:areaTop + bottom, areaLeft:areaRight], top, 0, correction, accumulator)
+    pyffyArena.giveBack(accumulator)
@@ -0,0 +1,77 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from numpy import ndarray, uint16
+
+import pyffyCommon
+import pyffyDigest
+import pyffyIOScheduler
+import pyffyTiles
+from pyffyExif import PyffyExif
+from pyffyIO import PositionalFile
+
+
+def correctFrames(sourceFileName: str,
+                  destinationFileName: str,
+                  frames: [PyffyExif],
+                  correction: pyffyTiles.PyffyTileCorrection,
+                  isDigestComputed: bool,
+                  maxParallelFrames: int,
+                  computationExecutor: ThreadPoolExecutor,
+                  ioExecutor: ThreadPoolExecutor,
+                  ioAccess = pyffyIOScheduler.noAccessControl) -> bytes | None:
+    # every frame is corrected with the same gain raster, frames go through one pair of positional files, so the destination is written in a single pass
+    # NewRawImageDigest covers the first frame only, it is returned if requested and can be computed from the corrected data
+    isInPlace = sourceFileName == destinationFileName
+    sourceFile = PositionalFile(sourceFileName, writable = isInPlace)
+    destinationFile = sourceFile if isInPlace else PositionalFile(destinationFileName, writable = True)
+    try:
+        # frames run on their own executor, they wait for bands and tiles submitted to the shared executors
+        with ThreadPoolExecutor(max_workers = max(1, min(maxParallelFrames, len(frames)))) as frameExecutor:
+            futures = [frameExecutor.submit(correctFrame, sourceFile, destinationFile, frame, correction, isDigestComputed and i == 0, computationExecutor, ioExecutor, ioAccess) for i, frame in enumerate(frames)]
+            digests = [future.result() for future in futures]
+    finally:
+        sourceFile.close()
+        if not isInPlace:
+            destinationFile.close()
+    return digests[0]
+
+
+def correctFrame(sourceFile: PositionalFile,
+                 destinationFile: PositionalFile,
+                 frame: PyffyExif,
+                 correction: pyffyTiles.PyffyTileCorrection,
+                 isDigestComputed: bool,
+                 computationExecutor: ThreadPoolExecutor,
+                 ioExecutor: ThreadPoolExecutor,
+                 ioAccess = pyffyIOScheduler.noAccessControl) -> bytes | None:
+    if frame.isFileTiled():
+        isDigestComputedFromTiles = isDigestComputed and pyffyDigest.isFileTilingMatchingDigest(frame)
+        tileDigests = pyffyTiles.correctTiles(sourceFile, destinationFile, frame, correction, ioExecutor, isDigestComputedFromTiles, ioAccess)
+        return None if tileDigests is None else pyffyDigest.combineTileDigests(tileDigests)
+
+    with ioAccess(sourceFile.fileName, frame.dataSizeInWords * 2):
+        sourceFile.adviseSequentialRead(frame.dataOffset, frame.dataSizeInWords * 2)
+        image = np.frombuffer(sourceFile.readAt(frame.dataOffset, frame.dataSizeInWords * 2), dtype = uint16).copy()
+    image = correctStripedFrame(image.reshape(frame.imageHeight, frame.imageWidth * frame.samplesPerPixel), correction, computationExecutor)
+    with ioAccess(destinationFile.fileName, image.nbytes):
+        destinationFile.writeAt(frame.dataOffset, image.tobytes())
+    return pyffyDigest.getNewRawImageDigest(image, frame, computationExecutor) if isDigestComputed else None
+
+
+def correctStripedFrame(image: ndarray[uint16], correction: pyffyTiles.PyffyTileCorrection, executor: ThreadPoolExecutor | None) -> ndarray[uint16]:
+    # frame is corrected in bands of rows, so float copy of the whole frame is never allocated
+    areaTop, areaLeft, areaBottom, areaRight = correction.area
+    bands = pyffyCommon.getBands(areaBottom - areaTop, 1)
+    if executor is None:
+        for start, end in bands:
+            correctBand(image, correction, start, end)
+    else:
+        pyffyCommon.waitForAll([executor.submit(correctBand, image, correction, start, end) for start, end in bands])
+    return image
+
+
+def correctBand(image: ndarray[uint16], correction: pyffyTiles.PyffyTileCorrection, start: int, end: int):
+    areaTop, areaLeft, areaBottom, areaRight = correction.area
+    block = image[areaTop + start:areaTop + end, areaLeft:areaRight]
+    image[areaTop + start:areaTop + end, areaLeft:areaRight] = correction.correctBlock(block, start, 0)
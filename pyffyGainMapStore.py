@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+from numpy import float16, float32, ndarray
+
+import pyffyCommon
+from pyffySettings import PyffySettings
+
+gainMapStoreFolderName = "gainMaps"
+gainMapStoreIndexFileName = "gainMaps.json"
+contentHashChunkSize = 16 * 1024 * 1024
+
+stores: dict[str, "PyffyGainMapStore"] = dict()
+
+
+class PyffyGainMapStore:
+    def __init__(self, referenceFilesRootFolderStr: str, downsampleFactor: int):
+        self.folder = Path(referenceFilesRootFolderStr).resolve().joinpath(gainMapStoreFolderName)
+        self.downsampleFactor = max(1, downsampleFactor)
+        self.lock = threading.Lock()
+        self.index: dict[str, dict] = dict()
+
+        indexPath = self.folder.joinpath(gainMapStoreIndexFileName)
+        if indexPath.exists():
+            try:
+                with open(indexPath, "r") as f:
+                    self.index = json.load(f)
+            except:
+                print("Gain map store index is damaged, it will be rebuilt")
+
+    def getContentHash(self, referenceFilePath: str) -> str:
+        # the file is hashed only when its size or modification time differs from the indexed one
+        stat = os.stat(referenceFilePath)
+        with self.lock:
+            entry = self.index.get(referenceFilePath)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+            return entry["contentHash"]
+
+        contentHash = hashlib.sha1()
+        with open(referenceFilePath, "rb") as f:
+            while chunk := f.read(contentHashChunkSize):
+                contentHash.update(chunk)
+
+        with self.lock:
+            self.index[referenceFilePath] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "contentHash": contentHash.hexdigest()}
+        return contentHash.hexdigest()
+
+    def getGainMapPath(self, referenceFilePath: str, gaussianFilterSigma: float, channelsGeometry: (int, int, int)) -> Path:
+        channelsCount, height, width = channelsGeometry
+        return self.folder.joinpath("{0}_sigma{1:g}_{2}x{3}x{4}.npy".format(self.getContentHash(referenceFilePath), gaussianFilterSigma, channelsCount, height, width))
+
+    def load(self, referenceFilePath: str, gaussianFilterSigma: float, channelsGeometry: (int, int, int)) -> ndarray[float32] | None:
+        gainMapPath = self.getGainMapPath(referenceFilePath, gaussianFilterSigma, channelsGeometry)
+        if not gainMapPath.exists():
+            return None
+
+        try:
+            downsampledChannels = np.load(gainMapPath, mmap_mode = "r")
+        except:
+            print("Gain map {0} could not be read".format(gainMapPath.name))
+            return None
+
+        return upsampleChannels(downsampledChannels, channelsGeometry)
+
+    def save(self, referenceFilePath: str, gaussianFilterSigma: float, channelsGeometry: (int, int, int), channels: ndarray[float32]) -> Path:
+        gainMapPath = self.getGainMapPath(referenceFilePath, gaussianFilterSigma, channelsGeometry)
+        if gainMapPath.exists():
+            return gainMapPath
+        downsampledChannels = downsampleChannels(channels, channelsGeometry, self.downsampleFactor)
+        self.folder.mkdir(parents = True, exist_ok = True)
+        # references with the same content and other pyffy instances write the same map, every writer has its own temporary file
+        tmpPath = getTmpPath(gainMapPath)
+        try:
+            with open(tmpPath, "wb") as f:
+                np.save(f, downsampledChannels)
+            os.replace(tmpPath, gainMapPath)
+        except OSError:
+            # map written by another writer is as good as this one, it may also be open by a reader, which prevents replacing it on Windows
+            if not gainMapPath.exists():
+                raise
+        finally:
+            tmpPath.unlink(missing_ok = True)
+        return gainMapPath
+
+    def saveIndex(self):
+        self.folder.mkdir(parents = True, exist_ok = True)
+        with self.lock:
+            content = pyffyCommon.dictToJson(self.index)
+        # index is replaced atomically, so a reader or an interrupted write never leaves it truncated
+        indexPath = self.folder.joinpath(gainMapStoreIndexFileName)
+        tmpPath = getTmpPath(indexPath)
+        try:
+            with open(tmpPath, "wt") as f:
+                f.write(content)
+            os.replace(tmpPath, indexPath)
+        finally:
+            tmpPath.unlink(missing_ok = True)
+
+    def removeStaleGainMaps(self, referenceFilePaths: [str]):
+        # only maps of reference contents which no longer exist are removed, maps for other sigmas are saved by two pass mode and are still valid
+        validContentHashes = {self.getContentHash(referenceFilePath) for referenceFilePath in referenceFilePaths}
+        if not self.folder.exists():
+            return
+        for gainMapPath in self.folder.glob("*.npy"):
+            if gainMapPath.name.split("_")[0] not in validContentHashes:
+                print("Removing stale gain map {0}".format(gainMapPath.name))
+                gainMapPath.unlink(missing_ok = True)
+
+        with self.lock:
+            self.index = {key: value for key, value in self.index.items() if Path(key).exists()}
+
+
+def getTmpPath(path: Path) -> Path:
+    return path.with_suffix(".{0}.{1}.tmp".format(os.getpid(), threading.get_ident()))
+
+
+def downsampleChannels(channels: ndarray[float32], channelsGeometry: (int, int, int), downsampleFactor: int) -> ndarray[float16]:
+    channelsCount, height, width = channelsGeometry
+    downsampledHeight = max(1, height // downsampleFactor)
+    downsampledWidth = max(1, width // downsampleFactor)
+
+    downsampledChannels = np.empty((channelsCount, downsampledHeight, downsampledWidth), dtype = float16)
+    for i in range(channelsCount):
+        channel = pyffyCommon.resizeChannel(channels[i], height, width, downsampledHeight, downsampledWidth)
+        downsampledChannels[i] = channel.reshape(downsampledHeight, downsampledWidth)
+    return downsampledChannels
+
+
+def upsampleChannels(downsampledChannels: ndarray[float16], channelsGeometry: (int, int, int)) -> ndarray[float32]:
+    channelsCount, height, width = channelsGeometry
+    channels = np.empty((channelsCount, height * width), dtype = float32)
+    for i in range(channelsCount):
+        downsampledChannel = downsampledChannels[i].astype(float32)
+        channel = pyffyCommon.resizeChannel(downsampledChannel, downsampledChannel.shape[0], downsampledChannel.shape[1], height, width)
+        channels[i] = pyffyCommon.scaleChannel(channel)
+    return channels
+
+
+def getStore(settings: PyffySettings) -> PyffyGainMapStore:
+    store = stores.get(settings.referenceFilesRootFolder)
+    if store is None:
+        store = PyffyGainMapStore(settings.referenceFilesRootFolder, settings.advGainMapDownsampleFactor)
+        stores[settings.referenceFilesRootFolder] = store
+    return store
@@ -1,25 +1,75 @@
 import fileNameUtils
+import fnmatch
 import os
 import shutil
+import threading
 from pathlib import Path
+from typing import TYPE_CHECKING, Iterator
 
-import numpy as np
-from numpy import ndarray
+if TYPE_CHECKING:
+    from numpy import ndarray
 
 referenceFilesExifDBFileName = "referenceDB.json"
 settingsForTwoPassProcessingFileName = "processingSettings.json"
+tuningProfileFileName = "tuning.json"
 
 
-def readImageData(fileName: str, offset: int, length: int) -> ndarray:
-    return np.fromfile(fileName, dtype = np.uint16, count = length, offset = offset)
+def readImageData(fileName: str, offset: int, length: int) -> "ndarray":
+    # NumPy is loaded only when pixels are read, building the reference DB and listing files do not need it
+    import numpy as np
+    import pyffyArena
+    with open(fileName, "rb") as f:
+        adviseSequentialRead(f.fileno(), offset, length * 2)
+        # image is read straight into a buffer of the arena, so consecutive files of one geometry reuse its pages
+        image = pyffyArena.borrow((length,), np.uint16)
+        f.seek(offset)
+        bytesCount = f.readinto(image)
+        return image[:bytesCount // 2]
+
+
+def adviseSequentialRead(fd: int, offset: int, length: int):
+    # kernel reads the whole range ahead with large requests, which matters most for spinning disks
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
 
 
-def writeImageData(fileName: str, offset: int, cfa: ndarray):
+def writeImageData(fileName: str, offset: int, cfa: "ndarray"):
     with open(fileName, "r+b") as f:
         f.seek(offset)
         f.write(cfa.tobytes())
 
 
+class PositionalFile:
+    def __init__(self, fileName: str, writable: bool = False):
+        self.fileName = fileName
+        flags = os.O_RDWR if writable else os.O_RDONLY
+        self.fd = os.open(fileName, flags | getattr(os, "O_BINARY", 0))
+        # platforms without pread/pwrite (Windows) fall back to seek + read/write under lock
+        self.lock = threading.Lock()
+
+    def readAt(self, offset: int, length: int) -> bytes:
+        if hasattr(os, "pread"):
+            return os.pread(self.fd, length, offset)
+        with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, length)
+
+    def writeAt(self, offset: int, data: bytes):
+        if hasattr(os, "pwrite"):
+            os.pwrite(self.fd, data, offset)
+            return
+        with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            os.write(self.fd, data)
+
+    def adviseSequentialRead(self, offset: int, length: int):
+        adviseSequentialRead(self.fd, offset, length)
+
+    def close(self):
+        os.close(self.fd)
+
+
 def getReferenceFilesRootFolderPath(referenceFilesRootFolderPath: str) -> Path | None:
     referenceFolderPath = Path(referenceFilesRootFolderPath).resolve().absolute()
     if referenceFolderPath.exists():
@@ -67,21 +117,51 @@ def readImageSettingsForTwoPassProcessing(path: str) -> str | None:
         return f.read()
 
 
-def getDngFilesInFolder(rootFolder: str) -> list[str]:
-    files = [f for f in os.listdir(rootFolder) if os.path.isfile(os.path.join(rootFolder, f)) and str(f).lower().endswith(".dng")]
-    result = []
-    for fileName in files:
-        result.append(str(os.path.join(rootFolder, fileName)))
-    return result
-
-
-def getDngFilesInTree(rootFolder: str) -> list[str]:
-    result = []
-    for root, dirs, files in os.walk(rootFolder):
-        for name in files:
-            if name.lower().endswith(".dng"):
-                result.append(str(Path(os.path.join(root, name)).resolve()))
-    return result
+def getDngFilesInFolder(rootFolder: str, includePatterns: [str] = None, excludePatterns: [str] = None, isOrderedByInode: bool = False) -> Iterator[str]:
+    return getDngFilesInTree(rootFolder, 0, includePatterns, excludePatterns, isOrderedByInode)
+
+
+def getDngFilesInTree(rootFolder: str, maxDepth: int = -1, includePatterns: [str] = None, excludePatterns: [str] = None, isOrderedByInode: bool = False) -> Iterator[str]:
+    # files are yielded folder by folder, so processing starts before the whole tree is scanned
+    rootFolder = str(Path(rootFolder).resolve())
+    includePatterns = includePatterns or []
+    excludePatterns = excludePatterns or []
+    folders = [(rootFolder, "", 0)]
+
+    while len(folders) != 0:
+        folder, relativeFolder, depth = folders.pop()
+        subfolders = []
+        files = []
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    relativePath = relativeFolder + entry.name
+                    if isPathMatching(relativePath, excludePatterns):
+                        continue
+                    if entry.is_dir() and not entry.is_symlink():
+                        if maxDepth < 0 or depth < maxDepth:
+                            subfolders.append((entry.path, relativePath + "/", depth + 1))
+                    elif entry.name.lower().endswith(".dng") and entry.is_file():
+                        if len(includePatterns) == 0 or isPathMatching(relativePath, includePatterns):
+                            files.append(entry)
+        except OSError as e:
+            print("Folder {0} can not be read: {1}".format(folder, e))
+
+        # folder is read completely before its files are returned, so its handle is not held open while they are processed
+        if isOrderedByInode:
+            # files of one folder are returned in inode order, which follows their placement on disk much closer than the directory order
+            files.sort(key = lambda x: x.inode())
+        for entry in files:
+            yield entry.path
+
+        folders.extend(reversed(subfolders))
+
+
+def isPathMatching(relativePath: str, patterns: [str]) -> bool:
+    for pattern in patterns:
+        if fnmatch.fnmatch(relativePath, pattern):
+            return True
+    return False
 
 
 def getRelativePath(rootFolder: str, absolutePath: str) -> str:
@@ -114,6 +194,20 @@ def readSettings() -> str | None:
         return f.read()
 
 
+def writeTuningProfile(profileString: str):
+    # tuning profile is kept next to settings.json
+    print("Writing tuning profile")
+    with open(tuningProfileFileName, "wt") as f:
+        f.write(profileString)
+
+
+def readTuningProfile() -> str | None:
+    if not Path(tuningProfileFileName).exists():
+        return None
+    with open(tuningProfileFileName, "r") as f:
+        return f.read()
+
+
 def createTempFile(fileName) -> str:
     return shutil.copyfile(fileName, fileName + ".tmp")
 
@@ -0,0 +1,133 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from pyffySettings import PyffySettings
+
+rotationalDeviceConcurrency = 1
+networkDeviceConcurrency = 2
+solidStateDeviceConcurrency = 4
+
+scheduler: "PyffyIOScheduler | None" = None
+
+
+class PyffyDevice:
+    def __init__(self, deviceId: int, kind: str, concurrency: int, bandwidthBytesPerSecond: float):
+        self.deviceId = deviceId
+        self.kind = kind
+        self.concurrency = concurrency
+        self.bandwidthBytesPerSecond = bandwidthBytesPerSecond
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.lock = threading.Lock()
+        self.nextTransferTime = 0.0
+
+    def throttle(self, bytesCount: int):
+        # transfers are booked one after another on the device timeline, so the average rate never exceeds the cap
+        if self.bandwidthBytesPerSecond <= 0 or bytesCount <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            startTime = max(now, self.nextTransferTime)
+            self.nextTransferTime = startTime + bytesCount / self.bandwidthBytesPerSecond
+        if startTime > now:
+            time.sleep(startTime - now)
+
+
+class PyffyIOScheduler:
+    def __init__(self, deviceLimits: dict[str, dict]):
+        # limits from settings are keyed by any path on the device, they are resolved to device ids once
+        self.deviceLimits = {getDeviceId(path): limits for path, limits in deviceLimits.items()}
+        self.devices: dict[int, PyffyDevice] = dict()
+        self.lock = threading.Lock()
+
+    def getDevice(self, path: str) -> PyffyDevice:
+        deviceId = getDeviceId(path)
+        with self.lock:
+            device = self.devices.get(deviceId)
+            if device is None:
+                device = self.createDevice(deviceId)
+                self.devices[deviceId] = device
+                print("I/O device {0} is {1}, concurrency {2}".format(deviceId, device.kind, device.concurrency))
+        return device
+
+    def createDevice(self, deviceId: int) -> PyffyDevice:
+        kind = getDeviceKind(deviceId)
+        if kind == "rotational":
+            concurrency = rotationalDeviceConcurrency
+        elif kind == "network":
+            concurrency = networkDeviceConcurrency
+        else:
+            concurrency = solidStateDeviceConcurrency
+
+        limits = self.deviceLimits.get(deviceId, dict())
+        concurrency = max(1, int(limits.get("concurrency", concurrency)))
+        bandwidthBytesPerSecond = float(limits.get("bandwidthMBps", 0)) * 2 ** 20
+        return PyffyDevice(deviceId, kind, concurrency, bandwidthBytesPerSecond)
+
+    @contextmanager
+    def access(self, paths: str | list[str], bytesCount: int = 0):
+        # copy reads one device and writes another, slots are taken once per device and in the same order by every thread, so they can not deadlock
+        paths = [paths] if isinstance(paths, str) else paths
+        devices = sorted({device.deviceId: device for device in [self.getDevice(path) for path in paths]}.values(), key = lambda x: x.deviceId)
+        for device in devices:
+            device.semaphore.acquire()
+        try:
+            for device in devices:
+                device.throttle(bytesCount)
+            yield
+        finally:
+            for device in reversed(devices):
+                device.semaphore.release()
+
+
+@contextmanager
+def noAccessControl(paths: str | list[str], bytesCount: int = 0):
+    yield
+
+
+def runWithAccess(ioAccess, paths: str | list[str], bytesCount: int, function, *args):
+    with ioAccess(paths, bytesCount):
+        return function(*args)
+
+
+def getScheduler(settings: PyffySettings) -> PyffyIOScheduler | None:
+    # one scheduler per process, devices are shared by all files and passes
+    global scheduler
+    if not settings.advUseIOScheduler:
+        return None
+    if scheduler is None:
+        scheduler = PyffyIOScheduler(settings.advIODeviceLimits)
+    return scheduler
+
+
+def getAccess(settings: PyffySettings):
+    ioScheduler = getScheduler(settings)
+    return noAccessControl if ioScheduler is None else ioScheduler.access
+
+
+def getDeviceId(path: str) -> int:
+    # destination files may not exist yet, so the nearest existing parent decides the device
+    currentPath = Path(path).absolute()
+    while not currentPath.exists() and currentPath.parent != currentPath:
+        currentPath = currentPath.parent
+    return os.stat(currentPath).st_dev
+
+
+def getDeviceKind(deviceId: int) -> str:
+    # network and virtual file systems have no block device behind them, major number is 0 for them on Linux
+    if not hasattr(os, "major") or not Path("/sys/dev/block").exists():
+        return "unknown"
+    major, minor = os.major(deviceId), os.minor(deviceId)
+    if major == 0:
+        return "network"
+
+    blockDevicePath = Path("/sys/dev/block/{0}:{1}".format(major, minor))
+    # partitions have no queue folder, it belongs to the whole disk
+    for queuePath in [blockDevicePath.joinpath("queue"), blockDevicePath.joinpath("..", "queue")]:
+        try:
+            return "rotational" if queuePath.joinpath("rotational").read_text().strip() == "1" else "solid state"
+        except OSError:
+            continue
+    return "unknown"
@@ -0,0 +1,233 @@
+import os
+import socket
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Iterator
+
+import pyffyIO
+from pyffySettings import PyffySettings
+
+lockFileSuffix = ".lock"
+doneFileSuffix = ".done"
+takeoverFileSuffix = ".takeover"
+
+
+class PyffyJobCoordinator:
+    def __init__(self, workingPath: str, jobFolder: str | None, workerId: str, leaseSeconds: float, shard: tuple[int, int] | None):
+        # files are identified by the path relative to the working folder, so hosts that mount the share at different paths agree on them
+        self.workingPath = workingPath
+        self.jobFolder = None if jobFolder is None else Path(workingPath).joinpath(jobFolder)
+        self.workerId = workerId
+        self.leaseSeconds = leaseSeconds
+        self.shard = shard
+        self.heldLockPaths: set[Path] = set()
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+        self.renewThread = None
+
+        if self.jobFolder is not None:
+            self.jobFolder.mkdir(parents = True, exist_ok = True)
+            self.renewThread = threading.Thread(target = self.renewLeases, daemon = True)
+            self.renewThread.start()
+
+    def claimFiles(self, dngFiles: Iterator[str]) -> Iterator[str]:
+        # caller calls complete for every file it has processed, lease of a file it skipped is released when it asks for the next one,
+        # so skipped files are left for other workers and a crash leaves only a lease that expires
+        for fileName in dngFiles:
+            if not self.isInShard(fileName) or not self.claim(fileName):
+                continue
+            yield fileName
+            self.releaseFile(fileName)
+
+    def isInShard(self, fileName: str) -> bool:
+        if self.shard is None:
+            return True
+        shardIndex, shardsCount = self.shard
+        return zlib.crc32(self.getRelativePath(fileName).encode("utf-8")) % shardsCount == shardIndex - 1
+
+    def claim(self, fileName: str) -> bool:
+        if self.jobFolder is None:
+            return True
+
+        lockPath, donePath = self.getJobPaths(fileName)
+        if donePath.exists():
+            return False
+
+        if not self.createLockFile(lockPath):
+            if not self.takeOverExpiredLease(lockPath):
+                return False
+            print("Lease on {0} has expired, taking it over".format(fileName))
+
+        # other worker could complete the file between the check above and lock creation
+        if donePath.exists():
+            self.release(lockPath)
+            return False
+
+        with self.lock:
+            self.heldLockPaths.add(lockPath)
+        return True
+
+    def complete(self, fileName: str):
+        if self.jobFolder is None:
+            return
+
+        lockPath, donePath = self.getJobPaths(fileName)
+        tmpPath = donePath.with_suffix(".{0}.tmp".format(os.getpid()))
+        with open(tmpPath, "wt") as f:
+            f.write("{0}\n{1}\n{2}\n".format(self.getRelativePath(fileName), self.workerId, time.strftime("%Y-%m-%d %H:%M:%S")))
+        os.replace(tmpPath, donePath)
+        self.release(lockPath)
+
+    def releaseFile(self, fileName: str):
+        if self.jobFolder is None:
+            return
+        lockPath, _ = self.getJobPaths(fileName)
+        with self.lock:
+            isHeld = lockPath in self.heldLockPaths
+        if isHeld:
+            self.release(lockPath)
+
+    def release(self, lockPath: Path):
+        with self.lock:
+            self.heldLockPaths.discard(lockPath)
+        # lock is moved away before its owner is checked, so a lock another worker has taken over meanwhile is not deleted
+        privatePath = lockPath.with_suffix(".{0}.release".format(os.getpid()))
+        try:
+            os.rename(lockPath, privatePath)
+        except OSError:
+            return
+        lease = self.readLease(privatePath)
+        if lease is not None and lease[0] != self.workerId:
+            self.restoreLockFile(privatePath, lockPath)
+        privatePath.unlink(missing_ok = True)
+
+    def close(self):
+        self.stopEvent.set()
+        if self.renewThread is not None:
+            self.renewThread.join()
+        for lockPath in list(self.heldLockPaths):
+            self.release(lockPath)
+        if self.jobFolder is not None:
+            self.getClockPath().unlink(missing_ok = True)
+
+    def renewLeases(self):
+        while not self.stopEvent.wait(self.leaseSeconds / 3):
+            with self.lock:
+                lockPaths = list(self.heldLockPaths)
+            for lockPath in lockPaths:
+                try:
+                    os.utime(lockPath)
+                except OSError:
+                    print("Lease {0} is lost".format(lockPath.name))
+
+    def createLockFile(self, lockPath: Path) -> bool:
+        # O_EXCL creation is atomic on local file systems and on NFSv3+/SMB shares
+        try:
+            fd = os.open(lockPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "wt") as f:
+            f.write(self.workerId)
+        return True
+
+    def isLeaseExpired(self, lockPath: Path) -> bool:
+        try:
+            return self.getSharedClockTime() - lockPath.stat().st_mtime > self.leaseSeconds
+        except FileNotFoundError:
+            return True
+
+    def takeOverExpiredLease(self, lockPath: Path) -> bool:
+        # workers which found the lease expired compete for a takeover file named after the expired lock, it is created with O_EXCL,
+        # so only one of them takes the lease over, takeover file of a worker that crashed meanwhile expires like a lease and the next generation is used
+        lease = self.readLease(lockPath)
+        if lease is None:
+            return self.createLockFile(lockPath)
+        if not self.isLeaseExpired(lockPath):
+            return False
+
+        generation = 0
+        while not self.createLockFile(self.getTakeoverPath(lockPath, lease, generation)):
+            if not self.isLeaseExpired(self.getTakeoverPath(lockPath, lease, generation)):
+                return False
+            generation += 1
+        try:
+            return self.removeExpiredLockFile(lockPath, lease) and self.createLockFile(lockPath)
+        finally:
+            for i in range(generation + 1):
+                self.getTakeoverPath(lockPath, lease, i).unlink(missing_ok = True)
+
+    def removeExpiredLockFile(self, lockPath: Path, lease: (str, int)) -> bool:
+        stalePath = lockPath.with_suffix(".{0}.stale".format(os.getpid()))
+        try:
+            os.rename(lockPath, stalePath)
+        except FileNotFoundError:
+            return True
+        except OSError:
+            return False
+        # lock renewed by its owner or replaced after it was found expired is put back
+        if self.readLease(stalePath) != lease:
+            self.restoreLockFile(stalePath, lockPath)
+            stalePath.unlink(missing_ok = True)
+            return False
+        stalePath.unlink(missing_ok = True)
+        return True
+
+    def restoreLockFile(self, movedPath: Path, lockPath: Path):
+        # link fails if a new lock has been created meanwhile, that one is kept
+        try:
+            os.link(movedPath, lockPath)
+        except FileExistsError:
+            pass
+        except OSError:
+            if not lockPath.exists():
+                os.replace(movedPath, lockPath)
+
+    def readLease(self, lockPath: Path) -> tuple[str, int] | None:
+        # lease is identified by its owner and the time it was renewed last
+        try:
+            return lockPath.read_text(), lockPath.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def getSharedClockTime(self) -> float:
+        # leases are compared with the file server clock, not with the local one, so clock skew between hosts does not matter
+        clockPath = self.getClockPath()
+        clockPath.touch()
+        return clockPath.stat().st_mtime
+
+    def getClockPath(self) -> Path:
+        import hashlib
+        return self.jobFolder.joinpath("{0}.clock".format(hashlib.sha1(self.workerId.encode("utf-8")).hexdigest()))
+
+    def getTakeoverPath(self, lockPath: Path, lease: (str, int), generation: int) -> Path:
+        import hashlib
+        leaseHash = hashlib.sha1("{0}:{1}".format(*lease).encode("utf-8")).hexdigest()[:16]
+        return lockPath.with_suffix(".{0}.{1}{2}".format(leaseHash, generation, takeoverFileSuffix))
+
+    def getJobPaths(self, fileName: str) -> (Path, Path):
+        import hashlib
+        name = hashlib.sha1(self.getRelativePath(fileName).encode("utf-8")).hexdigest()
+        return self.jobFolder.joinpath(name + lockFileSuffix), self.jobFolder.joinpath(name + doneFileSuffix)
+
+    def getRelativePath(self, fileName: str) -> str:
+        return Path(pyffyIO.getRelativePath(self.workingPath, fileName)).as_posix()
+
+
+def getCoordinator(workingPath: str, settings: PyffySettings, shard: tuple[int, int] | None) -> PyffyJobCoordinator | None:
+    if len(settings.advJobFolder) == 0 and shard is None:
+        return None
+
+    workerId = settings.advWorkerId if len(settings.advWorkerId) != 0 else "{0}-{1}".format(socket.gethostname(), os.getpid())
+    return PyffyJobCoordinator(workingPath, settings.advJobFolder if len(settings.advJobFolder) != 0 else None, workerId, settings.advJobLeaseSeconds, shard)
+
+
+def parseShard(shardStr: str) -> tuple[int, int] | None:
+    try:
+        shardIndex, shardsCount = [int(part) for part in shardStr.split("/")]
+    except ValueError:
+        return None
+    if shardsCount < 1 or not 1 <= shardIndex <= shardsCount:
+        return None
+    return shardIndex, shardsCount
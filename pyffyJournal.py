@@ -0,0 +1,199 @@
+import json
+import os
+import struct
+import zlib
+from pathlib import Path
+from typing import Iterator
+
+import pyffyDigest
+import pyffyExif
+from pyffyExif import PyffyExif
+from pyffyIO import PositionalFile
+
+journalSuffix = ".pyffyundo"
+journalMagic = b"PYFFYUNDO1"
+# appended to the journal when corrected data is on disk, it is followed by metadata updates which are still to be done
+dataWrittenMagic = b"PYFFYDATA1"
+# ranges are copied to and from the journal in chunks of this size, so memory use does not depend on file size
+journalChunkSize = 16 * 2 ** 20
+
+
+class PyffyUndoJournal:
+    def __init__(self, fileName: str, journalFileName: str):
+        self.fileName = fileName
+        self.journalFileName = journalFileName
+
+    def markDataWritten(self, isChecksumRemoved: bool, software: str | None):
+        # after this point exiftool may replace the file, so interrupted correction is finished instead of rolled back
+        syncFile(self.fileName)
+        marker = json.dumps({"removeChecksum": isChecksumRemoved, "software": software}).encode("utf-8")
+        with open(self.journalFileName, "ab") as f:
+            f.write(dataWrittenMagic + struct.pack("<I", len(marker)) + marker)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def commit(self):
+        # corrected data must be on disk before the only copy of the original data is removed
+        syncFile(self.fileName)
+        os.remove(self.journalFileName)
+        syncFolder(self.journalFileName)
+
+
+def getJournalFileName(fileName: str) -> str:
+    return fileName + journalSuffix
+
+
+def getModifiedRanges(exif: PyffyExif, digestOffset: int | None) -> [(int, int)]:
+    ranges = []
+    for frame in exif.getFrames():
+        if frame.isFileTiled():
+            ranges.extend(zip(frame.tileOffsets, frame.tileByteCounts))
+        else:
+            ranges.append((frame.dataOffset, frame.dataSizeInWords * 2))
+    if digestOffset is not None and digestOffset >= 0:
+        ranges.append((digestOffset, pyffyDigest.newRawImageDigestSize))
+    return ranges
+
+
+def begin(fileName: str, ranges: [(int, int)]) -> PyffyUndoJournal:
+    # journal is written under temporary name and renamed when it is complete and on disk, so existing journal is always valid
+    journalFileName = getJournalFileName(fileName)
+    stat = os.stat(fileName)
+    header = json.dumps({"size": stat.st_size, "device": stat.st_dev, "inode": stat.st_ino, "ranges": ranges}).encode("utf-8")
+
+    file = PositionalFile(fileName)
+    try:
+        with open(journalFileName + ".tmp", "wb") as f:
+            f.write(journalMagic)
+            f.write(struct.pack("<I", len(header)))
+            f.write(header)
+            checksum = 0
+            for offset, length in ranges:
+                for chunkOffset, chunkLength in getChunks(offset, length):
+                    data = file.readAt(chunkOffset, chunkLength)
+                    checksum = zlib.crc32(data, checksum)
+                    f.write(data)
+            f.write(struct.pack("<I", checksum))
+            f.flush()
+            os.fsync(f.fileno())
+    finally:
+        file.close()
+
+    os.replace(journalFileName + ".tmp", journalFileName)
+    syncFolder(journalFileName)
+    return PyffyUndoJournal(fileName, journalFileName)
+
+
+def rollback(fileName: str) -> bool:
+    # returns False if the file must not be processed, because its journal can not be applied or its correction was already written
+    journalFileName = getJournalFileName(fileName)
+    # incomplete journal means the file was not touched yet
+    Path(journalFileName + ".tmp").unlink(missing_ok = True)
+    if not Path(journalFileName).exists():
+        return True
+
+    with open(journalFileName, "rb") as f:
+        header, dataOffset = readJournalHeader(f)
+        if header is None or not isJournalDataValid(f, dataOffset, header["ranges"]):
+            print("Undo journal {0} is damaged, it is left for manual recovery and {1} is skipped.".format(journalFileName, fileName))
+            return False
+
+        dataWritten = readDataWrittenMarker(f)
+        stat = os.stat(fileName)
+        if dataWritten is not None:
+            # corrected data is complete, only metadata updates by exiftool could be interrupted, both of them can be repeated
+            print("Correction of {0} was written before interruption, finishing metadata update.".format(fileName))
+            if dataWritten["removeChecksum"]:
+                pyffyExif.removeDngChecksum(fileName)
+            if dataWritten["software"] is not None:
+                pyffyExif.addPyffyToSoftwareTag(fileName, dataWritten["software"])
+            isProcessed = False
+        elif stat.st_dev != header["device"] or stat.st_ino != header["inode"] or stat.st_size != header["size"]:
+            print("{0} was replaced by something else during correction, undo journal {1} is left for manual recovery and the file is skipped.".format(fileName, journalFileName))
+            return False
+        else:
+            isProcessed = True
+            print("Rolling back interrupted correction of {0}".format(fileName))
+            file = PositionalFile(fileName, writable = True)
+            try:
+                f.seek(dataOffset)
+                for offset, length in header["ranges"]:
+                    for chunkOffset, chunkLength in getChunks(offset, length):
+                        file.writeAt(chunkOffset, f.read(chunkLength))
+                os.fsync(file.fd)
+            finally:
+                file.close()
+
+    os.remove(journalFileName)
+    syncFolder(journalFileName)
+    return isProcessed
+
+
+def recoverFiles(dngFiles: Iterator[str]) -> Iterator[str]:
+    # every file is checked before its metadata or data is read, interrupted files are restored and processed again
+    for fileName in dngFiles:
+        if rollback(fileName):
+            yield fileName
+
+
+def readJournalHeader(f) -> (dict | None, int):
+    if f.read(len(journalMagic)) != journalMagic:
+        return None, 0
+    headerSize = struct.unpack("<I", f.read(4))[0]
+    try:
+        header = json.loads(f.read(headerSize).decode("utf-8"))
+    except ValueError:
+        return None, 0
+    return header, len(journalMagic) + 4 + headerSize
+
+
+def readDataWrittenMarker(f) -> dict | None:
+    # marker follows the checksum, incomplete marker means data was not completely written
+    if f.read(len(dataWrittenMagic)) != dataWrittenMagic:
+        return None
+    markerSize = f.read(4)
+    if len(markerSize) != 4:
+        return None
+    try:
+        return json.loads(f.read(struct.unpack("<I", markerSize)[0]).decode("utf-8"))
+    except ValueError:
+        return None
+
+
+def isJournalDataValid(f, dataOffset: int, ranges: [(int, int)]) -> bool:
+    f.seek(dataOffset)
+    checksum = 0
+    for offset, length in ranges:
+        for chunkOffset, chunkLength in getChunks(offset, length):
+            data = f.read(chunkLength)
+            if len(data) != chunkLength:
+                return False
+            checksum = zlib.crc32(data, checksum)
+    storedChecksum = f.read(4)
+    return len(storedChecksum) == 4 and struct.unpack("<I", storedChecksum)[0] == checksum
+
+
+def getChunks(offset: int, length: int) -> [(int, int)]:
+    return [(chunkOffset, min(journalChunkSize, offset + length - chunkOffset)) for chunkOffset in range(offset, offset + length, journalChunkSize)]
+
+
+def syncFile(fileName: str):
+    fd = os.open(fileName, os.O_RDWR | getattr(os, "O_BINARY", 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def syncFolder(fileName: str):
+    # makes rename and removal durable, folders can not be opened on Windows, NTFS journals metadata itself
+    try:
+        fd = os.open(Path(fileName).parent, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
@@ -0,0 +1,98 @@
+import os
+import threading
+import tracemalloc
+from pathlib import Path
+
+import pyffyCommon
+
+
+class PyffyMemoryStage:
+    def __init__(self, name: str, peakBytes: int, currentBytes: int, rssBytes: int):
+        self.name = name
+        self.peakBytes = peakBytes
+        self.currentBytes = currentBytes
+        self.rssBytes = rssBytes
+
+
+class PyffyMemoryReport:
+    def __init__(self, fileName: str):
+        self.fileName = fileName
+        self.stages: [PyffyMemoryStage] = []
+
+    def getExceededStages(self, stageBudgetBytes: int) -> [PyffyMemoryStage]:
+        if stageBudgetBytes <= 0:
+            return []
+        return [stage for stage in self.stages if stage.peakBytes > stageBudgetBytes]
+
+    def toTable(self) -> str:
+        lines = ["{0:<24}{1:>14}{2:>14}{3:>14}".format("stage", "peak, MB", "current, MB", "RSS, MB")]
+        for stage in self.stages:
+            lines.append("{0:<24}{1:>14.1f}{2:>14.1f}{3:>14.1f}".format(stage.name, stage.peakBytes / 2 ** 20, stage.currentBytes / 2 ** 20, stage.rssBytes / 2 ** 20))
+        return "\n".join(lines)
+
+
+# report of the file being processed now, None when memory profiling is disabled
+report: PyffyMemoryReport | None = None
+# stages can be marked from worker threads, report is replaced and appended only under the lock
+lock = threading.Lock()
+# tracing started by pyffy is stopped when the file is finished, tracing started by the user is left running
+isTracingStarted = False
+
+
+def startFile(fileName: str):
+    global report, isTracingStarted
+    with lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            isTracingStarted = True
+        tracemalloc.reset_peak()
+        report = PyffyMemoryReport(fileName)
+
+
+def markStage(stageName: str):
+    # peak is the highest traced allocation (NumPy buffers included) since the previous stage boundary
+    if report is None:
+        return
+    with lock:
+        if report is None:
+            return
+        currentBytes, peakBytes = tracemalloc.get_traced_memory()
+        report.stages.append(PyffyMemoryStage(stageName, peakBytes, currentBytes, getRssBytes()))
+        tracemalloc.reset_peak()
+
+
+def finishFile(reportsFolder: str | None, stageBudgetBytes: int) -> PyffyMemoryReport | None:
+    global report, isTracingStarted
+    with lock:
+        finishedReport = report
+        report = None
+        # tracing slows down every allocation, so it does not run between files or after the batch
+        if isTracingStarted:
+            tracemalloc.stop()
+            isTracingStarted = False
+    if finishedReport is None:
+        return None
+
+    if reportsFolder is not None and len(reportsFolder) != 0:
+        Path(reportsFolder).mkdir(parents = True, exist_ok = True)
+        with open(Path(reportsFolder).joinpath(Path(finishedReport.fileName).name + ".memory.json"), "wt") as f:
+            f.write(pyffyCommon.dictToJson(finishedReport))
+
+    for stage in finishedReport.getExceededStages(stageBudgetBytes):
+        print("Stage {0} used {1:.1f} MB, budget is {2:.1f} MB".format(stage.name, stage.peakBytes / 2 ** 20, stageBudgetBytes / 2 ** 20))
+
+    return finishedReport
+
+
+def getRssBytes() -> int:
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split(" ")[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
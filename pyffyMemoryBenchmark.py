@@ -0,0 +1,34 @@
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pyffy
+import pyffyMemory
+import pyffySynthetic
+
+# usage: pyffyMemoryBenchmark.py [megapixels] [stage budget in MB]
+megapixels = float(sys.argv[1]) if len(sys.argv) > 1 else 24
+settings = pyffy.loadSettingsOrDefault()
+if len(sys.argv) > 2:
+    settings.advMemoryStageBudgetBytes = int(float(sys.argv[2]) * 2 ** 20)
+
+height = int((megapixels * 1e6 / 1.5) ** 0.5) // 2 * 2
+width = int(height * 1.5) // 2 * 2
+executor = ThreadPoolExecutor()
+isBudgetExceeded = False
+
+for kind in pyffySynthetic.syntheticKinds:
+    image, reference, exif = pyffySynthetic.createSyntheticPair(kind, height, width)
+    pyffyMemory.startFile("synthetic_{0}_{1}x{2}".format(kind, width, height))
+    pyffy.getPipeline(exif).process(image, reference, exif, exif, settings, executor)
+    report = pyffyMemory.finishFile(settings.advMemoryReportsFolder, settings.advMemoryStageBudgetBytes)
+
+    print("{0}, {1}x{2}".format(kind, width, height))
+    print(report.toTable())
+    print("")
+    isBudgetExceeded |= len(report.getExceededStages(settings.advMemoryStageBudgetBytes)) != 0
+
+executor.shutdown()
+
+if isBudgetExceeded:
+    print("Memory budget of {0:.1f} MB per stage is exceeded.".format(settings.advMemoryStageBudgetBytes / 2 ** 20))
+    sys.exit(1)
@@ -0,0 +1,101 @@
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Callable
+
+import pyffyCommon
+import pyffyExif
+from pyffyExif import PyffyExif
+from pyffySettings import PyffySettings
+
+metadataCacheFlushSize = 256
+exifFields = vars(PyffyExif()).keys()
+
+createMetadataCacheScript = """
+CREATE TABLE IF NOT EXISTS metadata (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    exif TEXT NOT NULL
+);
+"""
+
+
+class PyffyMetadataCache:
+    def __init__(self, cacheFilePathStr: str, extractExif: Callable[[str], PyffyExif | None] = pyffyExif.getExif):
+        # paths under the cache file folder are stored relative to it, so the cache stays valid when the whole tree is moved or mounted elsewhere
+        self.cacheFilePath = Path(cacheFilePathStr).resolve()
+        self.rootFolder = self.cacheFilePath.parent
+        # keys are made without touching the file system, the root is resolved once here and scanned paths are under the resolved root already
+        self.rootFolderPrefix = os.path.join(str(self.rootFolder), "")
+        self.extractExif = extractExif
+        self.lock = threading.Lock()
+        self.pendingRows: [(str, int, int, str)] = []
+        self.hitsCount = 0
+        self.missesCount = 0
+
+        self.rootFolder.mkdir(parents = True, exist_ok = True)
+        import sqlite3
+        self.connection = sqlite3.connect(self.cacheFilePath, timeout = 30, check_same_thread = False)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.executescript(createMetadataCacheScript)
+        # whole cache is loaded with one query, it is much cheaper than one query per file
+        self.entries: dict[str, (int, int, str)] = {path: (size, mtime, exifJson) for path, size, mtime, exifJson in self.connection.execute("SELECT path, size, mtime, exif FROM metadata")}
+
+    def getExif(self, fileName: str) -> PyffyExif | None:
+        try:
+            stat = os.stat(fileName)
+        except OSError:
+            return self.extractExif(fileName)
+
+        key = self.getKey(fileName)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            exifDict = json.loads(entry[2])
+            # entries written before PyffyExif got new fields are extracted again
+            if exifFields <= exifDict.keys():
+                with self.lock:
+                    self.hitsCount += 1
+                return PyffyExif(exifDict)
+
+        with self.lock:
+            self.missesCount += 1
+        exif = self.extractExif(fileName)
+        if exif is None:
+            return None
+
+        row = (key, stat.st_size, stat.st_mtime_ns, pyffyCommon.dictToJson(exif))
+        with self.lock:
+            self.entries[key] = row[1:]
+            self.pendingRows.append(row)
+            isFlushNeeded = len(self.pendingRows) >= metadataCacheFlushSize
+        if isFlushNeeded:
+            self.flush()
+        return exif
+
+    def flush(self):
+        with self.lock:
+            rows = self.pendingRows
+            self.pendingRows = []
+            if len(rows) != 0:
+                with self.connection:
+                    self.connection.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)", rows)
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+        print("Metadata cache: {0} files found in cache, {1} files read".format(self.hitsCount, self.missesCount))
+
+    def getKey(self, fileName: str) -> str:
+        path = os.path.abspath(fileName)
+        if path.startswith(self.rootFolderPrefix):
+            path = path[len(self.rootFolderPrefix):]
+        return Path(path).as_posix()
+
+
+def getCache(workingPath: str, settings: PyffySettings) -> PyffyMetadataCache | None:
+    if len(settings.advMetadataCacheFile) == 0:
+        return None
+    return PyffyMetadataCache(str(Path(workingPath).joinpath(settings.advMetadataCacheFile)))
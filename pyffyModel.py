@@ -0,0 +1,106 @@
+import numpy as np
+from numpy import float32, float64, ndarray
+
+from pyffyExif import PyffyExif
+from pyffySettings import PyffySettings
+
+# blurred reference is very smooth, so the fit is done on a sparse grid of at most this many samples per side
+maxFitSamplesPerSide = 256
+
+
+class PyffyVignettingModel:
+    def __init__(self, jsonDict: None | dict = None):
+        self.degree: int = 0
+        self.gaussianFilterSigma: float = 0
+        self.channelHeight: int = 0
+        self.channelWidth: int = 0
+        self.coefficients: [[float]] = []
+        self.maxResidual: float = 0
+        self.rmsResidual: float = 0
+
+        if jsonDict is not None:
+            [setattr(self, key, val) for key, val in jsonDict.items() if hasattr(self, key)]
+
+
+def getModel(referenceExif: PyffyExif) -> PyffyVignettingModel | None:
+    if referenceExif is None or referenceExif.vignettingModel is None:
+        return None
+    return PyffyVignettingModel(referenceExif.vignettingModel)
+
+
+def isModelUpToDate(referenceExif: PyffyExif, settings: PyffySettings) -> bool:
+    model = getModel(referenceExif)
+    return (model is not None and
+            model.degree == settings.advVignettingModelDegree and
+            model.gaussianFilterSigma == settings.advGaussianFilterSigma)
+
+
+def fitModel(referenceChannels: ndarray[float32], height: int, width: int, degree: int, gaussianFilterSigma: float) -> PyffyVignettingModel:
+    model = PyffyVignettingModel()
+    model.degree = degree
+    model.gaussianFilterSigma = gaussianFilterSigma
+    model.channelHeight = height
+    model.channelWidth = width
+
+    rowStep = max(1, height // maxFitSamplesPerSide)
+    columnStep = max(1, width // maxFitSamplesPerSide)
+    rows = np.arange(0, height, rowStep)
+    columns = np.arange(0, width, columnStep)
+    y, x = np.meshgrid(getNormalizedCoordinates(height)[rows], getNormalizedCoordinates(width)[columns], indexing = "ij")
+
+    powers = getPowers(degree)
+    basis = np.empty((y.size, len(powers)), dtype = float64)
+    for i, (yPower, xPower) in enumerate(powers):
+        basis[:, i] = (y ** yPower * x ** xPower).reshape(-1)
+
+    for channel in referenceChannels:
+        samples = channel.reshape(height, width)[rows][:, columns].astype(float64).reshape(-1)
+        coefficients = np.linalg.lstsq(basis, samples, rcond = None)[0]
+        model.coefficients.append(coefficients.tolist())
+
+    evaluatedChannels = evaluateModel(model, height, width)
+    residual = np.abs(evaluatedChannels - referenceChannels)
+    model.maxResidual = float(np.max(residual))
+    model.rmsResidual = float(np.sqrt(np.mean(np.square(residual, dtype = float64))))
+
+    return model
+
+
+def evaluateModel(model: PyffyVignettingModel, height: int, width: int) -> ndarray[float32] | None:
+    if model.channelHeight != height or model.channelWidth != width:
+        print("Vignetting model geometry {0}x{1} does not match image geometry {2}x{3}".format(model.channelWidth, model.channelHeight, width, height))
+        return None
+
+    # gain(y, x) = sum(c[i, j] * y^i * x^j) is evaluated for the whole plane as Y @ C @ X.T
+    yPowers = np.vander(getNormalizedCoordinates(height), model.degree + 1, increasing = True).astype(float32)
+    xPowers = np.vander(getNormalizedCoordinates(width), model.degree + 1, increasing = True).astype(float32)
+
+    channels = np.empty((len(model.coefficients), height * width), dtype = float32)
+    for i, coefficients in enumerate(model.coefficients):
+        coefficientsMatrix = np.zeros((model.degree + 1, model.degree + 1), dtype = float64)
+        for (yPower, xPower), coefficient in zip(getPowers(model.degree), coefficients):
+            coefficientsMatrix[yPower, xPower] = coefficient
+        channel = yPowers @ (coefficientsMatrix @ xPowers.T.astype(float64)).astype(float32)
+        channels[i] = (channel / np.max(channel)).reshape(-1)
+
+    return channels
+
+
+def getReferenceChannels(referenceExif: PyffyExif, channelsGeometry: (int, int, int), settings: PyffySettings) -> ndarray[float32] | None:
+    if not isModelUpToDate(referenceExif, settings):
+        return None
+
+    channelsCount, height, width = channelsGeometry
+    model = getModel(referenceExif)
+    if len(model.coefficients) != channelsCount:
+        return None
+
+    return evaluateModel(model, height, width)
+
+
+def getPowers(degree: int) -> [(int, int)]:
+    return [(yPower, xPower) for yPower in range(degree + 1) for xPower in range(degree + 1 - yPower)]
+
+
+def getNormalizedCoordinates(size: int) -> ndarray[float64]:
+    return (np.arange(size, dtype = float64) + 0.5) / size * 2 - 1
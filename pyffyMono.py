@@ -1,6 +1,13 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 from numpy import float32, ndarray, uint16
 
+import pyffyArena
 import pyffyCommon
+import pyffyMemory
+import pyffyStatistics
+import pyffyTiles
 from pyffyExif import PyffyExif
 from pyffySettings import PyffySettings
 
@@ -13,22 +20,62 @@ def bitwiseMask(image: ndarray[uint16], exif: PyffyExif, bits: int, leaveLSB: bo
     return pyffyCommon.setActiveAreaPixels(image, activeAreaImage, exif.imageHeight, exif.imageWidth, exif.activeArea)
 
 
-def process(image: ndarray[uint16], reference: ndarray[uint16], exif: PyffyExif, referenceExif: PyffyExif, settings: PyffySettings) -> ndarray[uint16]:
-    activeAreaImage = pyffyCommon.getActiveAreaPixels(image, exif.imageHeight, exif.imageWidth, exif.activeArea)
-    activeAreaImageHeight = activeAreaImage.shape[0]
-    activeAreaImageWidth = activeAreaImage.shape[1]
-    activeAreaImage = activeAreaImage.reshape((-1))
-    activeAreaImage = activeAreaImage.clip(pyffyCommon.getBlackWhiteLevel(exif.blackLevels, 0)) - pyffyCommon.getBlackWhiteLevel(exif.blackLevels, 0)
+def process(image: ndarray[uint16], reference: ndarray[uint16], exif: PyffyExif, referenceExif: PyffyExif, settings: PyffySettings, executor: ThreadPoolExecutor) -> ndarray[uint16]:
+    referenceChannels = prepareReference(reference, exif, referenceExif, settings, executor)
+    image = correct(image, referenceChannels, exif, settings, executor)
+    pyffyArena.giveBack(referenceChannels)
+    return image
+
+
+def getChannelsGeometry(exif: PyffyExif) -> (int, int, int):
+    return 1, exif.activeArea[2] - exif.activeArea[0], exif.activeArea[3] - exif.activeArea[1]
+
+
+def prepareReference(reference: ndarray[uint16], exif: PyffyExif, referenceExif: PyffyExif, settings: PyffySettings, executor: ThreadPoolExecutor) -> ndarray[float32]:
     activeAreaReference = pyffyCommon.getActiveAreaPixels(reference, referenceExif.imageHeight, referenceExif.imageWidth, exif.activeArea)
     activeAreaReference -= pyffyCommon.getBlackWhiteLevel(referenceExif.blackLevels, 0)
+    pyffyMemory.markStage("referenceToChannels")
 
-    activeAreaReference = activeAreaReference.astype(float32)
-    activeAreaReference = pyffyCommon.blurChannel(activeAreaReference, activeAreaImageHeight, activeAreaImageWidth, settings.advGaussianFilterSigma)
-    activeAreaReference = pyffyCommon.scaleChannel(activeAreaReference)
+    referenceChannels = pyffyArena.borrow((1, activeAreaReference.size), float32)
+    np.copyto(referenceChannels.reshape(activeAreaReference.shape), activeAreaReference)
+    pyffyMemory.markStage("referenceToFloat")
+    blurredChannels = pyffyCommon.blurChannels(referenceChannels, activeAreaReference.shape[0], activeAreaReference.shape[1], settings.advGaussianFilterSigma, settings.useMultithreading, executor)
+    pyffyArena.giveBack(referenceChannels)
+    pyffyMemory.markStage("blurReference")
+    referenceChannels = pyffyCommon.normalizeChannels(blurredChannels, settings.useMultithreading, executor)
+    pyffyArena.giveBack(blurredChannels)
+    pyffyMemory.markStage("normalizeReference")
+    return referenceChannels
 
-    activeAreaImage = activeAreaImage.astype(float32)
-    activeAreaImage = pyffyCommon.correctMonochrome(activeAreaImage, activeAreaReference, settings.luminanceCorrectionIntensity)
-    activeAreaImage = pyffyCommon.fitChannelToAllowedRange(activeAreaImage, pyffyCommon.getBlackWhiteLevel(exif.blackLevels, 0), pyffyCommon.getBlackWhiteLevel(exif.whiteLevels, 1), settings.advLimitToWhiteLevels)
 
-    activeAreaImage = activeAreaImage.astype(uint16)
-    return pyffyCommon.setActiveAreaPixels(image, activeAreaImage, exif.imageHeight, exif.imageWidth, exif.activeArea)
+def correct(image: ndarray[uint16], referenceChannels: ndarray[float32], exif: PyffyExif, settings: PyffySettings, executor: ThreadPoolExecutor) -> ndarray[uint16]:
+    activeAreaImage = pyffyCommon.getActiveAreaPixels(image, exif.imageHeight, exif.imageWidth, exif.activeArea)
+    blackLevel = pyffyCommon.getBlackWhiteLevel(exif.blackLevels, 0)
+    uint16Channels = pyffyArena.borrow((1, activeAreaImage.size), uint16)
+    np.maximum(activeAreaImage, blackLevel, out = uint16Channels.reshape(activeAreaImage.shape))
+    uint16Channels -= blackLevel
+    pyffyMemory.markStage("imageToChannels")
+
+    # uint16 pixels are read by statistics before they are overwritten with the result
+    sourceChannels = uint16Channels if pyffyStatistics.current is not None else None
+    channels = pyffyCommon.channelsToFloat(uint16Channels)
+    pyffyMemory.markStage("imageToFloat")
+    channels[0] = pyffyCommon.correctMonochrome(channels[0], referenceChannels[0], settings.luminanceCorrectionIntensity, settings.useMultithreading, executor)
+    pyffyMemory.markStage("correctLuminance")
+    channels = pyffyCommon.fitChannelsToAllowedRange(channels, [pyffyCommon.getBlackWhiteLevel(exif.blackLevels, 0)], [pyffyCommon.getBlackWhiteLevel(exif.whiteLevels, 1)], settings.advLimitToWhiteLevels, settings.useMultithreading, executor, sourceChannels)
+    pyffyMemory.markStage("fitToAllowedRange")
+
+    np.copyto(uint16Channels, channels, casting = "unsafe")
+    pyffyArena.giveBack(channels)
+    pyffyMemory.markStage("channelsToUint16")
+    image = pyffyCommon.setActiveAreaPixels(image, uint16Channels, exif.imageHeight, exif.imageWidth, exif.activeArea)
+    pyffyArena.giveBack(uint16Channels)
+    return image
+
+
+def getTileCorrection(referenceChannels: ndarray[float32], exif: PyffyExif, settings: PyffySettings, executor: ThreadPoolExecutor) -> pyffyTiles.PyffyTileCorrection:
+    _, height, width = getChannelsGeometry(exif)
+    gainRaster = pyffyCommon.correctMonochrome(np.ones_like(referenceChannels[0]), referenceChannels[0], settings.luminanceCorrectionIntensity).reshape(height, width)
+
+    whiteLevelsPattern = pyffyTiles.getLevelsPattern(exif.whiteLevels, [[1]]) if settings.advLimitToWhiteLevels else pyffyTiles.getLevelsPattern([65535], [[0]])
+    return pyffyTiles.PyffyTileCorrection(gainRaster, exif.activeArea, pyffyTiles.getLevelsPattern(exif.blackLevels, [[0]]), whiteLevelsPattern)
@@ -2,9 +2,10 @@ import sys
 
 import pyffy
 
-if len(sys.argv) == 1:
-    pyffy.onePass(processFilesInSubfolders = False, workingPath = u".")
-elif len(sys.argv) == 2:
-    pyffy.onePass(processFilesInSubfolders = False, workingPath = sys.argv[1])
+arguments, shard = pyffy.extractShardArgument(sys.argv[1:])
+if len(arguments) == 0:
+    pyffy.onePass(processFilesInSubfolders = False, workingPath = u".", shard = shard)
+elif len(arguments) == 1:
+    pyffy.onePass(processFilesInSubfolders = False, workingPath = arguments[0], shard = shard)
 else:
     pyffy.exitWithPrompt("Only one folder can be provided to this script. Exiting now.")
@@ -0,0 +1,192 @@
+import os
+import struct
+
+import numpy as np
+from numpy import float32, ndarray
+
+import pyffyTiles
+from pyffyExif import PyffyExif
+from pyffyIO import PositionalFile
+
+gainMapOpcodeId = 9
+# GainMap opcode was introduced in DNG 1.3
+gainMapOpcodeVersion = 0x01030000
+opcodeList2Tag = 0xC741
+subIFDsTag = 0x014A
+stripOffsetsTag = 0x0111
+tileOffsetsTag = 0x0144
+tiffTypeUndefined = 7
+tiffTypeSizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4}
+
+
+class PyffyGainMapOpcode:
+    def __init__(self, area: [int], plane: int, planes: int, rowPitch: int, columnPitch: int, gains: ndarray[float32]):
+        # area [top, left, bottom, right] is relative to the active area, gains are (mapPointsV, mapPointsH, mapPlanes) and span the whole active area
+        self.area = area
+        self.plane = plane
+        self.planes = planes
+        self.rowPitch = rowPitch
+        self.columnPitch = columnPitch
+        self.gains = gains
+
+    def toBytes(self) -> bytes:
+        mapPointsV, mapPointsH, mapPlanes = self.gains.shape
+        parameters = struct.pack(">IIIIIIIIII", *self.area, self.plane, self.planes, self.rowPitch, self.columnPitch, mapPointsV, mapPointsH)
+        parameters += struct.pack(">dddd", 1 / max(1, mapPointsV - 1), 1 / max(1, mapPointsH - 1), 0.0, 0.0)
+        parameters += struct.pack(">I", mapPlanes) + self.gains.astype(">f4").tobytes()
+        # flags are 0, converter which does not know the opcode must not render the file without correction
+        return struct.pack(">IIII", gainMapOpcodeId, gainMapOpcodeVersion, 0, len(parameters)) + parameters
+
+
+def getMapPointsCount(height: int, width: int, mapPointsOnLongSide: int) -> (int, int):
+    scale = (max(2, mapPointsOnLongSide) - 1) / max(height, width)
+    return max(2, round(height * scale) + 1), max(2, round(width * scale) + 1)
+
+
+def getGainMapOpcodes(correction: pyffyTiles.PyffyTileCorrection, exif: PyffyExif, mapPointsOnLongSide: int) -> [PyffyGainMapOpcode]:
+    # CFA gets an opcode per position of the repeat pattern, linear raw gets one opcode with a map plane per color
+    samplesPerPixel = max(1, exif.samplesPerPixel)
+    areaTop, areaLeft, areaBottom, areaRight = correction.area
+    height, width = areaBottom - areaTop, (areaRight - areaLeft) // samplesPerPixel
+    mapPointsV, mapPointsH = getMapPointsCount(height, width, mapPointsOnLongSide)
+    # map points are placed at relative positions 0..1 of the active area, which are pixel edges, so pixel centers are half a pixel inside
+    mapRows = np.linspace(0, height, mapPointsV) - 0.5
+    mapColumns = np.linspace(0, width, mapPointsH) - 0.5
+
+    if samplesPerPixel != 1:
+        planes = correction.gainRaster.reshape(height, width, samplesPerPixel)
+        gains = np.stack([interpolate(planes[:, :, plane], mapRows, mapColumns) for plane in range(samplesPerPixel)], axis = 2)
+        return [PyffyGainMapOpcode([0, 0, height, width], 0, samplesPerPixel, 1, 1, gains)]
+
+    patternRows, patternColumns = correction.blackLevelsPattern.shape
+    # maps are built only from full repeat patterns, rows and columns at the edges which do not complete one get the gain of the last full pattern
+    fullRows, fullColumns = height // patternRows * patternRows, width // patternColumns * patternColumns
+    opcodes = []
+    for row in range(patternRows):
+        for column in range(patternColumns):
+            plane = correction.gainRaster[row:fullRows:patternRows, column:fullColumns:patternColumns]
+            gains = interpolate(plane, (mapRows - row) / patternRows, (mapColumns - column) / patternColumns)
+            opcodes.append(PyffyGainMapOpcode([row, column, height, width], 0, 1, patternRows, patternColumns, gains[:, :, np.newaxis]))
+    return opcodes
+
+
+def renderGainRaster(opcodes: [PyffyGainMapOpcode], correction: pyffyTiles.PyffyTileCorrection, samplesPerPixel: int) -> ndarray[float32]:
+    # gain raster as a raw converter interpolates it from the maps, it is used to validate the map density
+    samplesPerPixel = max(1, samplesPerPixel)
+    height, width = correction.gainRaster.shape[0], correction.gainRaster.shape[1] // samplesPerPixel
+    gainRaster = np.ones((height, width, samplesPerPixel), dtype = float32)
+    for opcode in opcodes:
+        top, left, bottom, right = opcode.area
+        mapPointsV, mapPointsH, mapPlanes = opcode.gains.shape
+        rows = (np.arange(top, bottom, opcode.rowPitch) + 0.5) / height * (mapPointsV - 1)
+        columns = (np.arange(left, right, opcode.columnPitch) + 0.5) / width * (mapPointsH - 1)
+        for plane in range(opcode.plane, opcode.plane + opcode.planes):
+            gains = opcode.gains[:, :, min(plane - opcode.plane, mapPlanes - 1)]
+            gainRaster[top:bottom:opcode.rowPitch, left:right:opcode.columnPitch, plane] = interpolate(gains, rows, columns)
+    return gainRaster.reshape(height, width * samplesPerPixel)
+
+
+def interpolate(values: ndarray[float32], rowPositions: ndarray, columnPositions: ndarray) -> ndarray[float32]:
+    # bilinear interpolation, positions are in index units of values and are clamped to its edges
+    rowPositions = np.clip(rowPositions, 0, values.shape[0] - 1)
+    columnPositions = np.clip(columnPositions, 0, values.shape[1] - 1)
+    top = np.floor(rowPositions).astype(np.intp)
+    bottom = np.minimum(top + 1, values.shape[0] - 1)
+    left = np.floor(columnPositions).astype(np.intp)
+    right = np.minimum(left + 1, values.shape[1] - 1)
+    rowWeights = (rowPositions - top).astype(float32)[:, np.newaxis]
+    columnWeights = (columnPositions - left).astype(float32)
+
+    rows = values[top] * (1 - rowWeights) + values[bottom] * rowWeights
+    return rows[:, left] * (1 - columnWeights) + rows[:, right] * columnWeights
+
+
+def writeGainMapOpcodes(fileName: str, exif: PyffyExif, opcodes: [PyffyGainMapOpcode]) -> bool:
+    # opcodes are added to OpcodeList2 of the raw IFD, list and IFD are appended to the file and the pointer to the IFD is switched last,
+    # so the file is valid at any moment and pixel data is not touched
+    file = PositionalFile(fileName, writable = True)
+    try:
+        header = file.readAt(0, 8)
+        byteOrder = "<" if header[:2] == b"II" else ">"
+        rawIFD = findRawIFD(file, byteOrder, struct.unpack(byteOrder + "I", header[4:8])[0], 4, exif.dataOffset, set())
+        if rawIFD is None:
+            print("Raw IFD is not found in {0}, GainMap opcodes are not written.".format(fileName))
+            return False
+        ifdOffset, pointerOffset = rawIFD
+
+        entries, nextIFDOffset = readIFD(file, byteOrder, ifdOffset)
+        opcodeList = None
+        for tag, tagType, count, value in entries:
+            if tag == opcodeList2Tag:
+                opcodeList = readEntryValue(file, byteOrder, tagType, count, value)
+        opcodeList = appendOpcodes(opcodeList, opcodes)
+
+        fileSize = os.fstat(file.fd).st_size
+        opcodeListOffset = fileSize + fileSize % 2
+        newIFDOffset = opcodeListOffset + len(opcodeList) + len(opcodeList) % 2
+        entries = [entry for entry in entries if entry[0] != opcodeList2Tag]
+        entries.append((opcodeList2Tag, tiffTypeUndefined, len(opcodeList), struct.pack(byteOrder + "I", opcodeListOffset)))
+        entries.sort(key = lambda entry: entry[0])
+
+        newIFD = struct.pack(byteOrder + "H", len(entries))
+        newIFD += b"".join(struct.pack(byteOrder + "HHI", tag, tagType, count) + value for tag, tagType, count, value in entries)
+        newIFD += struct.pack(byteOrder + "I", nextIFDOffset)
+        file.writeAt(fileSize, b"\0" * (opcodeListOffset - fileSize) + opcodeList + b"\0" * (len(opcodeList) % 2) + newIFD)
+        os.fsync(file.fd)
+        file.writeAt(pointerOffset, struct.pack(byteOrder + "I", newIFDOffset))
+        os.fsync(file.fd)
+    finally:
+        file.close()
+    return True
+
+
+def appendOpcodes(opcodeList: bytes | None, opcodes: [PyffyGainMapOpcode]) -> bytes:
+    # opcode list is big-endian in any file, it starts with the number of opcodes, opcodes already present are kept and applied first
+    existingCount, existingOpcodes = 0, b""
+    if opcodeList is not None and len(opcodeList) >= 4:
+        existingCount, existingOpcodes = struct.unpack(">I", opcodeList[:4])[0], opcodeList[4:]
+    return struct.pack(">I", existingCount + len(opcodes)) + existingOpcodes + b"".join(opcode.toBytes() for opcode in opcodes)
+
+
+def findRawIFD(file: PositionalFile, byteOrder: str, ifdOffset: int, pointerOffset: int, dataOffset: int, visited: set) -> tuple[int, int] | None:
+    # returns offset of the IFD whose image data starts at dataOffset and the file offset of the pointer to it, IFD chain and SubIFDs are searched
+    while ifdOffset != 0 and ifdOffset not in visited:
+        visited.add(ifdOffset)
+        entries, nextIFDOffset = readIFD(file, byteOrder, ifdOffset)
+        for i, (tag, tagType, count, value) in enumerate(entries):
+            if tag in (stripOffsetsTag, tileOffsetsTag) and count != 0:
+                if getFirstValue(file, byteOrder, tagType, count, value) == dataOffset:
+                    return ifdOffset, pointerOffset
+            if tag == subIFDsTag:
+                subIFDPointersOffset = ifdOffset + 2 + i * 12 + 8 if count * 4 <= 4 else struct.unpack(byteOrder + "I", value)[0]
+                for j, subIFDOffset in enumerate(struct.unpack(byteOrder + "{0}I".format(count), readEntryValue(file, byteOrder, tagType, count, value))):
+                    found = findRawIFD(file, byteOrder, subIFDOffset, subIFDPointersOffset + j * 4, dataOffset, visited)
+                    if found is not None:
+                        return found
+        pointerOffset = ifdOffset + 2 + len(entries) * 12
+        ifdOffset = nextIFDOffset
+    return None
+
+
+def readIFD(file: PositionalFile, byteOrder: str, ifdOffset: int) -> ([(int, int, int, bytes)], int):
+    # entries are (tag, type, count, raw 4 bytes of value or offset)
+    entriesCount = struct.unpack(byteOrder + "H", file.readAt(ifdOffset, 2))[0]
+    data = file.readAt(ifdOffset + 2, entriesCount * 12 + 4)
+    entries = [struct.unpack(byteOrder + "HHI", data[i * 12:i * 12 + 8]) + (data[i * 12 + 8:i * 12 + 12],) for i in range(entriesCount)]
+    return entries, struct.unpack(byteOrder + "I", data[entriesCount * 12:entriesCount * 12 + 4])[0]
+
+
+def getFirstValue(file: PositionalFile, byteOrder: str, tagType: int, count: int, value: bytes) -> int | None:
+    # offsets are SHORT or LONG
+    if tagType == 3:
+        return struct.unpack(byteOrder + "H", readEntryValue(file, byteOrder, tagType, 1, value))[0]
+    if tagType == 4:
+        return struct.unpack(byteOrder + "I", readEntryValue(file, byteOrder, tagType, 1, value))[0]
+    return None
+
+
+def readEntryValue(file: PositionalFile, byteOrder: str, tagType: int, count: int, value: bytes) -> bytes:
+    size = tiffTypeSizes.get(tagType, 1) * count
+    if size <= 4:
+        return value[:size]
+    return file.readAt(struct.unpack(byteOrder + "I", value)[0], size)
@@ -0,0 +1,173 @@
+import copy
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from numpy import float32, ndarray, uint8, uint16
+
+import pyffyCFA
+import pyffyCommon
+import pyffyTiles
+from pyffyExif import PyffyExif
+from pyffyIO import PositionalFile
+from pyffySettings import PyffySettings
+
+contactSheetFileName = "contactSheet.jpg"
+contactSheetLabelHeight = 36
+previewGamma = 1 / 2.2
+
+
+class PyffyProofJob:
+    def __init__(self, fileName: str, relativeFilePath: str, exif: PyffyExif, referenceFileName: str, referenceExif: PyffyExif, pipeline, settings: PyffySettings):
+        # settings are the ones of the file, with intensities and sigma from processingSettings.json
+        self.fileName = fileName
+        self.relativeFilePath = relativeFilePath
+        self.exif = exif
+        self.referenceFileName = referenceFileName
+        self.referenceExif = referenceExif
+        self.pipeline = pipeline
+        self.settings = settings
+
+
+def createProofs(jobs: [PyffyProofJob], workingPath: str, settings: PyffySettings, executor: ThreadPoolExecutor):
+    # files are proofed in parallel, every one is corrected in one thread, it is small enough
+    startTime = time.time()
+    proofFolder = Path(workingPath).joinpath(settings.advProofFolder)
+    futures = [executor.submit(createProof, job, proofFolder, settings) for job in jobs]
+    thumbnails = []
+    for job, future in zip(jobs, futures):
+        try:
+            thumbnails.append((job, future.result()))
+        except (OSError, ValueError) as e:
+            print("Proof of {0} is not created: {1}".format(job.relativeFilePath, e))
+
+    if len(thumbnails) != 0:
+        writeJpeg(proofFolder.joinpath(contactSheetFileName), createContactSheet(thumbnails, settings.advProofThumbnailSize))
+    print("Proofs of {0} files are written to {1} in {2:.2f} s".format(len(thumbnails), proofFolder, time.time() - startTime))
+
+
+def createProof(job: PyffyProofJob, proofFolder: Path, settings: PyffySettings) -> ndarray[uint8]:
+    exif, referenceExif = job.exif, job.referenceExif
+    blockDim = pyffyCFA.getPatternDim(exif) if not exif.isFileLinear() else (1, 1)
+    area = exif.activeArea if not exif.isFileLinear() or exif.isFileMonochrome() else [0, 0, exif.imageHeight, exif.imageWidth]
+    factor = getDecimationFactor(area, blockDim, settings.advProofLongSide)
+
+    image = readDecimatedImage(job.fileName, exif, area, blockDim, factor)
+    reference = readDecimatedImage(job.referenceFileName, referenceExif, area, blockDim, factor)
+    proofExif = getDecimatedExif(exif, image.shape[0], image.shape[1] // max(1, exif.samplesPerPixel))
+    proofReferenceExif = getDecimatedExif(referenceExif, image.shape[0], image.shape[1] // max(1, exif.samplesPerPixel))
+
+    # blur radius is given in pixels of the full resolution channels, decimated channels are factor times smaller
+    proofSettings = copy.deepcopy(job.settings)
+    proofSettings.advGaussianFilterSigma = job.settings.advGaussianFilterSigma / factor
+    proofSettings.useMultithreading = False
+    corrected = job.pipeline.process(image.reshape(-1), reference.reshape(-1), proofExif, proofReferenceExif, proofSettings, None)
+
+    preview = renderPreview(np.asarray(corrected).reshape(image.shape), proofExif, blockDim)
+    writeJpeg(proofFolder.joinpath(job.relativeFilePath + ".jpg"), preview)
+    return resizeToFit(preview, settings.advProofThumbnailSize)
+
+
+def getDecimationFactor(area: [int], blockDim: (int, int), longSide: int) -> int:
+    # one pixel of the preview is made of one repeat pattern block, every factor-th block is read
+    blocksOnLongSide = max((area[2] - area[0]) // blockDim[0], (area[3] - area[1]) // blockDim[1])
+    return max(1, blocksOnLongSide // max(1, longSide))
+
+
+def readDecimatedImage(fileName: str, exif: PyffyExif, area: [int], blockDim: (int, int), factor: int) -> ndarray[uint16]:
+    # every factor-th block of rows is read from strips, so only a part of the file is read, tiled files are read whole
+    blockRows, blockColumns = blockDim
+    samplesPerPixel = max(1, exif.samplesPerPixel)
+    top, left, bottom, right = area
+    blocksDown, blocksAcross = (bottom - top) // blockRows, (right - left) // blockColumns
+    rowStarts = range(top, top + blocksDown * blockRows, blockRows * factor)
+
+    if exif.isFileTiled():
+        image = pyffyTiles.readTiledImageData(fileName, exif, None).reshape(exif.imageHeight, exif.imageWidth * samplesPerPixel)
+        rows = np.concatenate([image[rowStart:rowStart + blockRows] for rowStart in rowStarts])
+    else:
+        rowBytes = exif.imageWidth * samplesPerPixel * 2
+        file = PositionalFile(fileName)
+        try:
+            data = b"".join(file.readAt(exif.dataOffset + rowStart * rowBytes, blockRows * rowBytes) for rowStart in rowStarts)
+        finally:
+            file.close()
+        if len(data) != len(rowStarts) * blockRows * rowBytes:
+            raise ValueError("image data is shorter than expected")
+        rows = np.frombuffer(data, dtype = uint16).reshape(-1, exif.imageWidth * samplesPerPixel)
+
+    rows = rows.reshape(rows.shape[0], exif.imageWidth, samplesPerPixel)[:, left:left + blocksAcross * blockColumns]
+    blocks = rows.reshape(rows.shape[0], blocksAcross, blockColumns, samplesPerPixel)[:, ::factor]
+    # copy is writable, pipelines correct images in place
+    return blocks.copy().reshape(rows.shape[0], -1)
+
+
+def getDecimatedExif(exif: PyffyExif, height: int, width: int) -> PyffyExif:
+    proofExif = copy.copy(exif)
+    proofExif.imageHeight, proofExif.imageWidth = height, width
+    proofExif.activeArea = [0, 0, height, width]
+    proofExif.tileWidth, proofExif.tileLength, proofExif.tileOffsets, proofExif.tileByteCounts = 0, 0, [], []
+    proofExif.frames = []
+    return proofExif
+
+
+def renderPreview(image: ndarray[uint16], exif: PyffyExif, blockDim: (int, int)) -> ndarray[uint8]:
+    # every repeat pattern block becomes one pixel, colors of the block are averaged, gray world white balance and auto exposure are applied
+    if not exif.isFileLinear():
+        views = pyffyCFA.getChannelViews(image, blockDim)
+        rgb = np.zeros(views.shape[2:] + (3,), dtype = float32)
+        counts = np.zeros(3, dtype = float32)
+        blackLevels = pyffyCFA.getChannelBlackLevels(exif, blockDim)
+        for i in range(blockDim[0] * blockDim[1]):
+            color = exif.colorPattern[i]
+            rgb[:, :, color] += views[i // blockDim[1], i % blockDim[1]] - float32(blackLevels[i])
+            counts[color] += 1
+        rgb /= np.maximum(counts, 1)
+    elif exif.isFileMonochrome():
+        rgb = np.repeat(image.astype(float32)[:, :, np.newaxis] - pyffyCommon.getBlackWhiteLevel(exif.blackLevels, 0), 3, axis = 2)
+    else:
+        rgb = image.reshape(image.shape[0], -1, 3).astype(float32)
+        rgb -= np.array([pyffyCommon.getBlackWhiteLevel(exif.blackLevels, i) for i in range(3)], dtype = float32)
+
+    np.maximum(rgb, 0, out = rgb)
+    means = np.maximum(rgb.reshape(-1, 3).mean(axis = 0), 1e-6)
+    rgb *= means[1] / means
+    rgb /= max(float(np.percentile(rgb, 99.5)), 1e-6)
+    np.clip(rgb, 0, 1, out = rgb)
+    # OpenCV writes BGR
+    return (np.power(rgb, previewGamma)[:, :, ::-1] * 255 + 0.5).astype(uint8)
+
+
+def resizeToFit(image: ndarray[uint8], size: int) -> ndarray[uint8]:
+    cv2 = pyffyCommon.getOpenCV()
+    scale = min(1.0, size / max(image.shape[0], image.shape[1]))
+    return cv2.resize(image, (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale))), interpolation = cv2.INTER_AREA)
+
+
+def createContactSheet(thumbnails: [(PyffyProofJob, ndarray[uint8])], size: int) -> ndarray[uint8]:
+    # thumbnails are placed in file order on a square grid, file name and correction settings are written under every one
+    cv2 = pyffyCommon.getOpenCV()
+    columns = int(np.ceil(np.sqrt(len(thumbnails))))
+    rows = -(-len(thumbnails) // columns)
+    cellHeight, cellWidth = size + contactSheetLabelHeight, size
+    sheet = np.full((rows * cellHeight, columns * cellWidth, 3), 32, dtype = uint8)
+    for i, (job, thumbnail) in enumerate(thumbnails):
+        top, left = i // columns * cellHeight, i % columns * cellWidth
+        height, width = thumbnail.shape[:2]
+        sheet[top + (size - height) // 2:top + (size - height) // 2 + height, left + (size - width) // 2:left + (size - width) // 2 + width] = thumbnail
+        labels = [Path(job.relativeFilePath).name,
+                  "L {0:.2f} C {1:.2f} s {2:g}".format(job.settings.luminanceCorrectionIntensity, job.settings.colorCorrectionIntensity, job.settings.advGaussianFilterSigma)]
+        for j, label in enumerate(labels):
+            cv2.putText(sheet, label, (left + 4, top + size + 14 + j * 16), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (224, 224, 224), 1, cv2.LINE_AA)
+    return sheet
+
+
+def writeJpeg(path: Path, image: ndarray[uint8]):
+    # image is encoded in memory, cv2.imwrite can not write to paths with non-ASCII characters on Windows
+    cv2 = pyffyCommon.getOpenCV()
+    isEncoded, data = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    if not isEncoded:
+        raise ValueError("{0} can not be encoded".format(path))
+    path.parent.mkdir(parents = True, exist_ok = True)
+    path.write_bytes(data.tobytes())
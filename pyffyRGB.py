@@ -3,7 +3,11 @@ from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from numpy import float32, ndarray, uint16
 
+import pyffyArena
 import pyffyCommon
+import pyffyMemory
+import pyffyStatistics
+import pyffyTiles
 from pyffyExif import PyffyExif
 from pyffySettings import PyffySettings
 
@@ -17,41 +21,81 @@ def bitwiseMask(image: ndarray[uint16], exif: PyffyExif, bits: int, leaveLSB: bo
 
 
 def process(image: ndarray[uint16], reference: ndarray[uint16], exif: PyffyExif, referenceExif: PyffyExif, settings: PyffySettings, executor: ThreadPoolExecutor) -> ndarray[uint16]:
-    channels, referenceChannels = imagesToChannels(image, reference, exif.blackLevels, referenceExif.blackLevels, settings.useMultithreading, executor)
+    referenceChannels = prepareReference(reference, exif, referenceExif, settings, executor)
+    image = correct(image, referenceChannels, exif, settings, executor)
+    pyffyArena.giveBack(referenceChannels)
+    return image
 
-    referenceChannels = referenceChannels.astype(float32)
-    referenceChannels = pyffyCommon.blurChannels(referenceChannels, exif.imageHeight, exif.imageWidth, settings.advGaussianFilterSigma, settings.useMultithreading, executor)
-    referenceChannels = pyffyCommon.normalizeChannels(referenceChannels, settings.useMultithreading, executor)
 
-    channels = channels.astype(float32)
+def getChannelsGeometry(exif: PyffyExif) -> (int, int, int):
+    return 3, exif.imageHeight, exif.imageWidth
+
+
+def prepareReference(reference: ndarray[uint16], exif: PyffyExif, referenceExif: PyffyExif, settings: PyffySettings, executor: ThreadPoolExecutor) -> ndarray[float32]:
+    uint16Channels = imageToChannels(reference, referenceExif.blackLevels)
+    pyffyMemory.markStage("referenceToChannels")
+
+    referenceChannels = pyffyCommon.channelsToFloat(uint16Channels)
+    pyffyArena.giveBack(uint16Channels)
+    pyffyMemory.markStage("referenceToFloat")
+    blurredChannels = pyffyCommon.blurChannels(referenceChannels, exif.imageHeight, exif.imageWidth, settings.advGaussianFilterSigma, settings.useMultithreading, executor)
+    pyffyArena.giveBack(referenceChannels)
+    pyffyMemory.markStage("blurReference")
+    referenceChannels = pyffyCommon.normalizeChannels(blurredChannels, settings.useMultithreading, executor)
+    pyffyArena.giveBack(blurredChannels)
+    pyffyMemory.markStage("normalizeReference")
+    return referenceChannels
+
+
+def correct(image: ndarray[uint16], referenceChannels: ndarray[float32], exif: PyffyExif, settings: PyffySettings, executor: ThreadPoolExecutor) -> ndarray[uint16]:
+    uint16Channels = imageToChannels(image, exif.blackLevels)
+    pyffyMemory.markStage("imageToChannels")
+
+    # uint16 channels are read by statistics before they are overwritten with the result
+    sourceChannels = uint16Channels if pyffyStatistics.current is not None else None
+    channels = pyffyCommon.channelsToFloat(uint16Channels)
+    pyffyMemory.markStage("imageToFloat")
     channels, referenceChannels = pyffyCommon.correctLuminance(channels, referenceChannels, exif.colorPattern, settings.luminanceCorrectionIntensity, settings.useMultithreading, executor)
+    pyffyMemory.markStage("correctLuminance")
     channels = pyffyCommon.correctColor(channels, referenceChannels, exif.colorPattern, settings.colorCorrectionIntensity, settings.useMultithreading, executor)
-    channels = pyffyCommon.fitChannelsToAllowedRange(channels, exif.blackLevels, exif.whiteLevels, settings.advLimitToWhiteLevels, settings.useMultithreading, executor)
+    pyffyMemory.markStage("correctColor")
+    channels = pyffyCommon.fitChannelsToAllowedRange(channels, exif.blackLevels, exif.whiteLevels, settings.advLimitToWhiteLevels, settings.useMultithreading, executor, sourceChannels)
+    pyffyMemory.markStage("fitToAllowedRange")
 
-    channels = channels.astype(uint16)
-    return channelsToImage(channels)
+    np.copyto(uint16Channels, channels, casting = "unsafe")
+    pyffyArena.giveBack(channels)
+    pyffyMemory.markStage("channelsToUint16")
+    image = channelsToImage(uint16Channels, image)
+    pyffyArena.giveBack(uint16Channels)
+    pyffyMemory.markStage("channelsToImage")
+    return image
 
 
-def imagesToChannels(image: ndarray[uint16], reference: ndarray[uint16], blackLevels: [int], referenceBlackLevels: [int], useMultithreading: bool, executor: ThreadPoolExecutor) -> (ndarray[uint16], ndarray[uint16]):
-    if useMultithreading:
-        channelsFuture = executor.submit(imageToChannels, image, blackLevels)
-        referenceFuture = executor.submit(imageToChannels, reference, referenceBlackLevels)
-        return channelsFuture.result(), referenceFuture.result()
-    else:
-        channels = imageToChannels(image, blackLevels)
-        referenceChannels = imageToChannels(reference, referenceBlackLevels)
-        return channels, referenceChannels
+def getTileCorrection(referenceChannels: ndarray[float32], exif: PyffyExif, settings: PyffySettings, executor: ThreadPoolExecutor) -> pyffyTiles.PyffyTileCorrection:
+    gainChannels = np.ones_like(referenceChannels)
+    gainChannels, referenceChannels = pyffyCommon.correctLuminance(gainChannels, referenceChannels, exif.colorPattern, settings.luminanceCorrectionIntensity, settings.useMultithreading, executor)
+    gainChannels = pyffyCommon.correctColor(gainChannels, referenceChannels, exif.colorPattern, settings.colorCorrectionIntensity, settings.useMultithreading, executor)
+    gainRaster = channelsToImage(gainChannels).reshape(exif.imageHeight, exif.imageWidth * 3)
+
+    whiteLevels = exif.whiteLevels if settings.advLimitToWhiteLevels else [65535]
+    channelIndexPattern = [[0, 1, 2]]
+    return pyffyTiles.PyffyTileCorrection(gainRaster, [0, 0, exif.imageHeight, exif.imageWidth * 3], pyffyTiles.getLevelsPattern(exif.blackLevels, channelIndexPattern), pyffyTiles.getLevelsPattern(whiteLevels, channelIndexPattern))
 
 
 def imageToChannels(image: ndarray[uint16], blackLevels: [int]) -> ndarray[uint16]:
-    channels = np.empty((3, np.size(image) // 3), dtype = uint16)
-    channels[0] = image[0::3].clip(pyffyCommon.getBlackWhiteLevel(blackLevels, 0)) - pyffyCommon.getBlackWhiteLevel(blackLevels, 0)
-    channels[1] = image[1::3].clip(pyffyCommon.getBlackWhiteLevel(blackLevels, 1)) - pyffyCommon.getBlackWhiteLevel(blackLevels, 1)
-    channels[2] = image[2::3].clip(pyffyCommon.getBlackWhiteLevel(blackLevels, 2)) - pyffyCommon.getBlackWhiteLevel(blackLevels, 2)
+    channels = pyffyArena.borrow((3, np.size(image) // 3), uint16)
+    for i in range(3):
+        blackLevel = pyffyCommon.getBlackWhiteLevel(blackLevels, i)
+        np.maximum(image[i::3], blackLevel, out = channels[i])
+        channels[i] -= blackLevel
     return channels
 
 
-def channelsToImage(channels: ndarray[uint16]) -> ndarray[uint16]:
+def channelsToImage(channels: ndarray[uint16], image: ndarray[uint16] | None = None) -> ndarray[uint16]:
+    # channels are interleaved into image when it is given, a new image is made otherwise
+    if image is not None:
+        image.reshape(-1, 3)[...] = channels.T
+        return image.reshape(1, -1)
     channels = np.row_stack(channels)
     return np.reshape(channels, (1, np.size(channels[0]) * 3), "F")
 
@@ -65,26 +109,29 @@ def correctLuminance(channels: ndarray[float32],
     scaledGreenChannel = referenceChannels[colorPattern.index(1)]
     scaledGreenChannel = scaledGreenChannel / np.max(scaledGreenChannel)
 
+    # division results are written into borrowed buffers and copied back into the channels
+    outs = [pyffyArena.borrow(channels[i].shape, float32) for i in range(len(colorPattern))]
     if useMultithreading:
         futures = dict()
         if luminanceCorrectionIntensity != 0:
             for i in range(len(colorPattern)):
-                futures[i] = executor.submit(pyffyCommon.divideChannel, channels[i], scaledGreenChannel, luminanceCorrectionIntensity)
+                futures[i] = executor.submit(pyffyCommon.divideChannel, channels[i], scaledGreenChannel, luminanceCorrectionIntensity, outs[i])
             for i in range(len(futures)):
                 channels[i] = futures[i].result()
             futures.clear()
 
         for i in range(len(colorPattern)):
             if colorPattern[i] != 1:
-                futures[i] = executor.submit(pyffyCommon.divideChannel, referenceChannels[i], scaledGreenChannel, luminanceCorrectionIntensity)
+                futures[i] = executor.submit(pyffyCommon.divideChannel, referenceChannels[i], scaledGreenChannel, luminanceCorrectionIntensity, outs[i])
         for key in futures.keys():
             referenceChannels[key] = futures[key].result()
     else:
         if luminanceCorrectionIntensity != 0:
             for i in range(len(colorPattern)):
-                channels[i] = pyffyCommon.divideChannel(channels[i], scaledGreenChannel, luminanceCorrectionIntensity)
+                channels[i] = pyffyCommon.divideChannel(channels[i], scaledGreenChannel, luminanceCorrectionIntensity, outs[i])
 
         for i in range(len(colorPattern)):
             if colorPattern[i] != 1:
-                referenceChannels[i] = pyffyCommon.divideChannel(referenceChannels[i], scaledGreenChannel, luminanceCorrectionIntensity)
+                referenceChannels[i] = pyffyCommon.divideChannel(referenceChannels[i], scaledGreenChannel, luminanceCorrectionIntensity, outs[i])
+    pyffyArena.giveBack(*outs)
     return channels, referenceChannels
@@ -0,0 +1,150 @@
+import ctypes
+import importlib.util
+import math
+import os
+import platform
+import sys
+from pathlib import Path
+
+import pyffyCommon
+from pyffySettings import PyffySettings
+
+ioPriorityIdle = "idle"
+ioPriorityLow = "low"
+# ioprio_set syscall numbers, it has no wrapper in libc
+linuxIOPrioSetSyscalls = {"x86_64": 251, "aarch64": 30, "i686": 289, "i386": 289, "armv7l": 314}
+linuxIOPrioClassBestEffort = 2
+linuxIOPrioClassIdle = 3
+linuxIOPrioClassShift = 13
+
+
+def apply(settings: PyffySettings):
+    # must be called before executors are created, new threads inherit nice, I/O priority and affinity of the thread which creates them
+    setCpuPriority(settings.advNiceLevel)
+    setIOPriority(settings.advIOPriority)
+    if len(settings.advCpuAffinity) != 0:
+        setCpuAffinity(settings.advCpuAffinity)
+
+    pyffyCommon.cpuCount = getAvailableCpuCount()
+    setLibraryThreads(getLibraryThreads(settings))
+    print("Using {0} CPUs".format(pyffyCommon.cpuCount))
+
+
+def getLibraryThreads(settings: PyffySettings) -> int:
+    # when pyffy splits work into bands itself, threads of OpenCV and BLAS would only compete with its own pool
+    if settings.advLibraryThreads > 0:
+        return settings.advLibraryThreads
+    return 1 if settings.useMultithreading else pyffyCommon.cpuCount
+
+
+def setLibraryThreads(threads: int):
+    pyffyCommon.setOpenCVThreads(threads)
+    if isPackageInstalled("threadpoolctl"):
+        import threadpoolctl
+        threadpoolctl.threadpool_limits(threads)
+
+
+def setCpuPriority(niceLevel: int):
+    if niceLevel <= 0:
+        return
+    try:
+        if sys.platform == "win32":
+            if isPackageInstalled("psutil"):
+                import psutil
+                psutil.Process().nice(psutil.IDLE_PRIORITY_CLASS if niceLevel >= 19 else psutil.BELOW_NORMAL_PRIORITY_CLASS)
+        else:
+            os.nice(max(0, niceLevel - os.nice(0)))
+    except OSError as e:
+        print("CPU priority could not be lowered: {0}".format(e))
+
+
+def setIOPriority(ioPriority: str):
+    if ioPriority not in (ioPriorityIdle, ioPriorityLow):
+        return
+    try:
+        if isPackageInstalled("psutil"):
+            import psutil
+            if sys.platform == "win32":
+                psutil.Process().ionice(psutil.IOPRIO_VERYLOW if ioPriority == ioPriorityIdle else psutil.IOPRIO_LOW)
+                return
+            if sys.platform.startswith("linux"):
+                if ioPriority == ioPriorityIdle:
+                    psutil.Process().ionice(psutil.IOPRIO_CLASS_IDLE)
+                else:
+                    psutil.Process().ionice(psutil.IOPRIO_CLASS_BE, 7)
+                return
+        if sys.platform.startswith("linux"):
+            setLinuxIOPriority(ioPriority)
+    except OSError as e:
+        print("I/O priority could not be lowered: {0}".format(e))
+
+
+def setLinuxIOPriority(ioPriority: str):
+    syscallNumber = linuxIOPrioSetSyscalls.get(platform.machine())
+    if syscallNumber is None:
+        print("I/O priority is not set, install psutil to set it on {0}.".format(platform.machine()))
+        return
+    if ioPriority == ioPriorityIdle:
+        value = linuxIOPrioClassIdle << linuxIOPrioClassShift
+    else:
+        value = linuxIOPrioClassBestEffort << linuxIOPrioClassShift | 7
+    libc = ctypes.CDLL(None, use_errno = True)
+    # IOPRIO_WHO_PROCESS is 1, pid 0 is the calling thread
+    if libc.syscall(syscallNumber, 1, 0, value) != 0:
+        raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+
+def setCpuAffinity(cpus: [int]):
+    try:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus)
+        elif isPackageInstalled("psutil"):
+            import psutil
+            psutil.Process().cpu_affinity(cpus)
+        else:
+            print("CPU affinity is not set, install psutil to set it on this platform.")
+    except (OSError, ValueError) as e:
+        print("CPU affinity {0} could not be set: {1}".format(cpus, e))
+
+
+def getAvailableCpuCount() -> int:
+    # CPUs the process may run on, limited by cgroup CPU quota of the container if there is one
+    if hasattr(os, "sched_getaffinity"):
+        cpuCount = len(os.sched_getaffinity(0))
+    else:
+        cpuCount = os.cpu_count() or 1
+    quota = getCgroupCpuQuota()
+    if quota is not None:
+        cpuCount = min(cpuCount, math.ceil(quota))
+    return max(1, cpuCount)
+
+
+def getCgroupCpuQuota() -> float | None:
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        # cgroup v2, quota and period are in one file, quota is "max" when there is no limit
+        cpuMaxFile = getCgroupV2Folder().joinpath("cpu.max")
+        if cpuMaxFile.exists():
+            quota, period = cpuMaxFile.read_text().split()[:2]
+            return None if quota == "max" else int(quota) / int(period)
+        # cgroup v1, quota is -1 when there is no limit
+        quotaFile = Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+        if quotaFile.exists():
+            quota = int(quotaFile.read_text())
+            period = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us").read_text())
+            return None if quota <= 0 else quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def getCgroupV2Folder() -> Path:
+    for line in Path("/proc/self/cgroup").read_text().splitlines():
+        if line.startswith("0::"):
+            return Path("/sys/fs/cgroup").joinpath(line[3:].lstrip("/"))
+    return Path("/sys/fs/cgroup")
+
+
+def isPackageInstalled(packageName: str) -> bool:
+    return importlib.util.find_spec(packageName) is not None
@@ -18,6 +18,43 @@ class PyffySettings:
         self.advMaxAllowedFNumberDifferenceStops: float = 0.5
         self.advUpdateDngSoftwareTagToAvoidOverprocessing = True
         self.advOverWriteSourceFileInPlace: bool = False
+        self.advUseUndoJournal: bool = False
+        self.advUseVignettingModel: bool = False
+        self.advVignettingModelDegree: int = 6
+        self.advUseGainMapStore: bool = False
+        self.advGainMapDownsampleFactor: int = 4
+        self.advUseReferenceCatalog: bool = False
+        self.advIncludePatterns: [str] = []
+        self.advExcludePatterns: [str] = []
+        self.advMaxSubfolderDepth: int = -1
+        self.advProfileMemory: bool = False
+        self.advMemoryStageBudgetBytes: int = 0
+        self.advMemoryReportsFolder: str = "memoryReports"
+        self.advJobFolder: str = ""
+        self.advJobLeaseSeconds: float = 600.0
+        self.advWorkerId: str = ""
+        self.advMetadataCacheFile: str = ""
+        self.advUseIOScheduler: bool = False
+        self.advIODeviceLimits: dict[str, dict] = {}
+        self.advTelemetryPrometheusFile: str = ""
+        self.advTelemetryJsonFile: str = ""
+        self.advTelemetryExportIntervalSeconds: float = 15.0
+        self.advMaxParallelFrames: int = 4
+        self.advUseFixedPointCorrection: bool = False
+        self.advCollectCorrectionStatistics: bool = False
+        self.advCorrectionStatisticsFile: str = "correctionStatistics.json"
+        self.advNiceLevel: int = 19
+        self.advIOPriority: str = "idle"
+        self.advCpuAffinity: [int] = []
+        self.advLibraryThreads: int = 0
+        self.advWriteGainMapOpcode: bool = False
+        self.advGainMapOpcodePoints: int = 65
+        self.advUseBufferArena: bool = True
+        self.advBufferArenaMaxIdleBytes: int = 2 ** 31
+        self.advBufferArenaMinAvailableBytes: int = 2 ** 30
+        self.advProofFolder: str = "proof"
+        self.advProofLongSide: int = 1024
+        self.advProofThumbnailSize: int = 256
 
         if jsonDict is not None:
             [setattr(self, key, val) for key, val in jsonDict.items() if hasattr(self, key)]
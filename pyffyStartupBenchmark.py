@@ -0,0 +1,63 @@
+import ast
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+runsCount = 10
+measuredModules = ["pyffy",
+                   "pyffyCreateReferenceDB",
+                   "pyffyExportReferenceCatalog",
+                   "pyffyOnePassInFolder",
+                   "pyffyOnePassInTree",
+                   "pyffyTwoPassesInFolder",
+                   "pyffyTwoPassesInTree",
+                   "pyffyAutotune",
+                   "pyffyValidate",
+                   "pyffyMemoryBenchmark"]
+heavyModules = ["cv2", "pkg_resources", "numpy", "sqlite3", "hashlib"]
+
+measurementCode = """import sys
+import time
+startTime = time.perf_counter()
+{0}
+importTime = time.perf_counter() - startTime
+print(importTime, " ".join(name for name in {1} if name in sys.modules))"""
+
+
+def getImportCode(moduleName: str) -> str:
+    # entry scripts start working when they are imported, so only their top level imports are run, which is what they load before doing anything
+    tree = ast.parse(Path(__file__).with_name(moduleName + ".py").read_text(encoding = "utf-8"))
+    if all(isDefinition(node) for node in tree.body):
+        return "import {0}".format(moduleName)
+    return "\n".join(ast.unparse(node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom)))
+
+
+def isDefinition(node: ast.stmt) -> bool:
+    if isinstance(node, ast.If):
+        return isinstance(node.test, ast.Name) and node.test.id == "TYPE_CHECKING"
+    return isinstance(node, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef, ast.Assign, ast.AnnAssign))
+
+
+def measureStartup(moduleName: str) -> (float, float, str):
+    importTimes = []
+    processTimes = []
+    loadedHeavyModules = ""
+    importCode = getImportCode(moduleName)
+    for i in range(runsCount):
+        startTime = time.perf_counter()
+        cp = subprocess.run(args = [sys.executable, "-c", measurementCode.format(importCode, heavyModules)], capture_output = True, encoding = "utf-8")
+        processTimes.append(time.perf_counter() - startTime)
+        if cp.returncode != 0:
+            print(cp.stderr)
+            sys.exit(1)
+        importTime, _, loadedHeavyModules = cp.stdout.strip().partition(" ")
+        importTimes.append(float(importTime))
+    return statistics.median(importTimes), statistics.median(processTimes), loadedHeavyModules
+
+
+for measuredModule in measuredModules:
+    medianImportTime, medianProcessTime, loadedModules = measureStartup(measuredModule)
+    print("{0}: imports {1:.1f} ms, whole process: {2:.1f} ms (median of {3} runs)".format(measuredModule, medianImportTime * 1000, medianProcessTime * 1000, runsCount))
+    print("Heavy modules loaded at startup: {0}".format(loadedModules if len(loadedModules) != 0 else "none"))
@@ -0,0 +1,156 @@
+import json
+import threading
+
+import numpy as np
+from numpy import ndarray
+
+import pyffyTelemetry
+from pyffySettings import PyffySettings
+
+# output histogram is split into this many bins between 0 and white level
+histogramBinsCount = 16
+worstFilesCount = 5
+
+
+class PyffyChannelStatistics:
+    def __init__(self):
+        self.pixelsCount: int = 0
+        self.clippedAtBlackCount: int = 0
+        self.clippedAtWhiteCount: int = 0
+        self.minGain: float = 0
+        self.maxGain: float = 0
+        self.meanGain: float = 0
+        self.gainsCount: int = 0
+
+    def add(self, other: "PyffyChannelStatistics"):
+        self.pixelsCount += other.pixelsCount
+        self.clippedAtBlackCount += other.clippedAtBlackCount
+        self.clippedAtWhiteCount += other.clippedAtWhiteCount
+        if other.gainsCount == 0:
+            return
+        if self.gainsCount == 0:
+            self.minGain, self.maxGain = other.minGain, other.maxGain
+        else:
+            self.minGain, self.maxGain = min(self.minGain, other.minGain), max(self.maxGain, other.maxGain)
+        self.meanGain = (self.meanGain * self.gainsCount + other.meanGain * other.gainsCount) / (self.gainsCount + other.gainsCount)
+        self.gainsCount += other.gainsCount
+
+
+class PyffyFileStatistics:
+    def __init__(self, fileName: str):
+        self.fileName = fileName
+        self.channels: [PyffyChannelStatistics] = []
+        self.histogram: [int] = [0] * histogramBinsCount
+        self.lock = threading.Lock()
+
+    def add(self, channelIndex: int, channelStatistics: PyffyChannelStatistics, histogram: ndarray):
+        with self.lock:
+            while len(self.channels) <= channelIndex:
+                self.channels.append(PyffyChannelStatistics())
+            self.channels[channelIndex].add(channelStatistics)
+            self.histogram = [a + int(b) for a, b in zip(self.histogram, histogram)]
+
+    def getTotal(self) -> PyffyChannelStatistics:
+        total = PyffyChannelStatistics()
+        for channel in self.channels:
+            total.add(channel)
+        return total
+
+    def toTable(self) -> str:
+        lines = ["{0:<10}{1:>14}{2:>14}{3:>10}{4:>10}{5:>10}".format("channel", "clip. low, %", "clip. high, %", "min gain", "max gain", "mean gain")]
+        for i, channel in enumerate(self.channels):
+            lines.append("{0:<10}{1:>14.4f}{2:>14.4f}{3:>10.3f}{4:>10.3f}{5:>10.3f}".format(i, getShare(channel.clippedAtBlackCount, channel.pixelsCount), getShare(channel.clippedAtWhiteCount, channel.pixelsCount), channel.minGain, channel.maxGain, channel.meanGain))
+        lines.append("histogram, % per 1/{0} of white level: {1}".format(histogramBinsCount, " ".join("{0:.1f}".format(getShare(count, sum(self.histogram))) for count in self.histogram)))
+        return "\n".join(lines)
+
+    def toDict(self) -> dict:
+        return {"fileName": self.fileName, "channels": [vars(channel) for channel in self.channels], "histogram": self.histogram}
+
+
+class PyffyRunStatistics:
+    def __init__(self, reportFile: str):
+        self.reportFile = reportFile
+        self.files: [PyffyFileStatistics] = []
+
+    def getSummary(self) -> dict:
+        total = PyffyChannelStatistics()
+        histogram = [0] * histogramBinsCount
+        for fileStatistics in self.files:
+            total.add(fileStatistics.getTotal())
+            histogram = [a + b for a, b in zip(histogram, fileStatistics.histogram)]
+        worstFiles = sorted(self.files, key = lambda x: getShare(x.getTotal().clippedAtWhiteCount, x.getTotal().pixelsCount), reverse = True)[:worstFilesCount]
+        return {"filesCount": len(self.files),
+                "total": vars(total),
+                "histogram": histogram,
+                "mostClippedFiles": [{"fileName": x.fileName, "clippedAtWhitePercent": getShare(x.getTotal().clippedAtWhiteCount, x.getTotal().pixelsCount)} for x in worstFiles]}
+
+
+# statistics of the running batch and of the file being processed now, None when statistics are not collected
+run: PyffyRunStatistics | None = None
+current: PyffyFileStatistics | None = None
+
+
+def start(settings: PyffySettings):
+    global run
+    run = PyffyRunStatistics(settings.advCorrectionStatisticsFile) if settings.advCollectCorrectionStatistics else None
+
+
+def startFile(fileName: str):
+    global current
+    current = PyffyFileStatistics(fileName) if run is not None else None
+
+
+def addChannel(channelIndex: int, source: ndarray, blackLevel: float, gain: ndarray, corrected: ndarray, whiteLevel: float, gainScale: float = 1.0):
+    # corrected are values with black level added and before they are clipped to white level
+    fileStatistics = current
+    if fileStatistics is None:
+        return
+
+    channelStatistics = PyffyChannelStatistics()
+    channelStatistics.pixelsCount = source.size
+    channelStatistics.clippedAtBlackCount = int(np.count_nonzero(source <= blackLevel))
+    channelStatistics.clippedAtWhiteCount = int(np.count_nonzero(corrected > whiteLevel))
+    if gain.size != 0:
+        channelStatistics.gainsCount = gain.size
+        channelStatistics.minGain = float(np.min(gain)) * gainScale
+        channelStatistics.maxGain = float(np.max(gain)) * gainScale
+        channelStatistics.meanGain = float(np.mean(gain, dtype = np.float64)) * gainScale
+    bins = (np.minimum(corrected, whiteLevel) * (histogramBinsCount / (whiteLevel + 1))).astype(np.intp)
+    fileStatistics.add(channelIndex, channelStatistics, np.bincount(bins.reshape(-1), minlength = histogramBinsCount))
+
+
+def addBlock(block: ndarray, gain: ndarray, corrected: ndarray, blackLevelsPattern: ndarray, whiteLevelsPattern: ndarray, top: int, left: int, gainScale: float = 1.0):
+    # block is split by position in the levels pattern, every position is a channel the same way as in the pipelines
+    if current is None:
+        return
+    patternRows, patternColumns = blackLevelsPattern.shape
+    for row in range(patternRows):
+        for column in range(patternColumns):
+            rows = slice((row - top) % patternRows, None, patternRows)
+            columns = slice((column - left) % patternColumns, None, patternColumns)
+            addChannel(row * patternColumns + column, block[rows, columns], float(blackLevelsPattern[row, column]), gain[rows, columns], corrected[rows, columns], float(whiteLevelsPattern[row, column]), gainScale)
+
+
+def finishFile() -> PyffyFileStatistics | None:
+    global current
+    finishedStatistics = current
+    current = None
+    if finishedStatistics is not None:
+        run.files.append(finishedStatistics)
+    return finishedStatistics
+
+
+def finish():
+    global run
+    if run is None:
+        return
+    summary = run.getSummary()
+    total = summary["total"]
+    print("Correction statistics of {0} files: {1:.4f}% clipped at black, {2:.4f}% clipped at white, gain {3:.3f}..{4:.3f}, mean {5:.3f}".format(summary["filesCount"], getShare(total["clippedAtBlackCount"], total["pixelsCount"]), getShare(total["clippedAtWhiteCount"], total["pixelsCount"]), total["minGain"], total["maxGain"], total["meanGain"]))
+    if len(run.reportFile) != 0:
+        pyffyTelemetry.writeFileAtomically(run.reportFile, json.dumps({"summary": summary, "files": [x.toDict() for x in run.files]}, indent = 4))
+    run = None
+
+
+def getShare(count: int, totalCount: int) -> float:
+    return count / totalCount * 100 if totalCount != 0 else 0.0
@@ -0,0 +1,87 @@
+import numpy as np
+from numpy import float32, ndarray, uint16
+
+from pyffyExif import PyffyExif
+
+# xtransBlackRepeat is X-Trans with black levels repeating on a 2x2 grid, as many cameras write them
+syntheticKinds = ["cfa", "xtrans", "xtransBlackRepeat", "rgb", "mono"]
+xTransPattern = [1, 1, 0, 1, 1, 2,
+                 1, 1, 2, 1, 1, 0,
+                 2, 0, 1, 0, 2, 1,
+                 1, 1, 2, 1, 1, 0,
+                 1, 1, 0, 1, 1, 2,
+                 0, 2, 1, 2, 0, 1]
+syntheticBlackLevel = 512
+syntheticRepeatedBlackLevels = [512, 513, 514, 515]
+syntheticWhiteLevel = 16383
+
+
+def getSyntheticSizes(height: int, width: int) -> [(int, int)]:
+    # second size has rows and columns at the bottom and right edges which do not complete a Bayer or X-Trans repeat pattern
+    height, width = max(6, height // 6 * 6), max(6, width // 6 * 6)
+    return [(height, width), (height + 5, width + 1)]
+
+
+def createSyntheticExif(kind: str, height: int, width: int) -> PyffyExif:
+    exif = PyffyExif()
+    exif.cameraMaker = "pyffy"
+    exif.cameraModel = "synthetic {0}".format(kind)
+    exif.imageHeight = height
+    exif.imageWidth = width
+    exif.activeArea = [0, 0, height, width]
+    exif.blackLevels = [syntheticBlackLevel]
+    exif.whiteLevels = [syntheticWhiteLevel]
+    exif.software = "pyffy synthetic"
+
+    if kind == "cfa":
+        exif.photometricInterpretation = "Color Filter Array"
+        exif.samplesPerPixel = 1
+        exif.colorPattern = [0, 1, 1, 2]
+        exif.cfaRepeatPatternDim = [2, 2]
+    elif kind == "xtrans" or kind == "xtransBlackRepeat":
+        exif.photometricInterpretation = "Color Filter Array"
+        exif.samplesPerPixel = 1
+        exif.colorPattern = list(xTransPattern)
+        exif.cfaRepeatPatternDim = [6, 6]
+        if kind == "xtransBlackRepeat":
+            exif.blackLevels = list(syntheticRepeatedBlackLevels)
+            exif.blackLevelRepeatDim = [2, 2]
+    elif kind == "rgb":
+        exif.photometricInterpretation = "Linear Raw"
+        exif.samplesPerPixel = 3
+        exif.colorPattern = [0, 1, 2]
+    elif kind == "mono":
+        exif.photometricInterpretation = "Linear Raw"
+        exif.samplesPerPixel = 1
+    else:
+        raise ValueError("Unknown synthetic image kind {0}".format(kind))
+
+    exif.dataSizeInWords = height * width * exif.samplesPerPixel
+    return exif
+
+
+def createSyntheticPair(kind: str, height: int, width: int, seed: int = 0) -> (ndarray[uint16], ndarray[uint16], PyffyExif):
+    # vignetting with a slight color cast, reference is flat field with noise, image is a random scene under the same vignetting
+    exif = createSyntheticExif(kind, height, width)
+    random = np.random.default_rng(seed)
+
+    y = (np.arange(height, dtype = float32) - height / 2) / height
+    x = (np.arange(width, dtype = float32) - width / 2) / width
+    vignetting = 1 - 1.6 * (y[:, None] ** 2 + x[None, :] ** 2)
+
+    samplesPerPixel = exif.samplesPerPixel
+    channelGains = np.array([0.8, 1.0, 0.7], dtype = float32)[:samplesPerPixel] if samplesPerPixel == 3 else np.ones(1, dtype = float32)
+    castedVignetting = vignetting[:, :, None] * (1 + (channelGains - 1) * x[None, :, None])
+
+    reference = castedVignetting * 10000 + random.normal(0, 40, castedVignetting.shape).astype(float32)
+    image = castedVignetting * random.uniform(500, 12000, castedVignetting.shape).astype(float32)
+
+    blackLevels = np.full((height, width, 1), syntheticBlackLevel, dtype = float32)
+    if len(exif.blackLevelRepeatDim) == 2:
+        repeatRows, repeatColumns = exif.blackLevelRepeatDim
+        blackLevelsPattern = np.array(exif.blackLevels, dtype = float32).reshape(repeatRows, repeatColumns, 1)
+        blackLevels = np.tile(blackLevelsPattern, (-(-height // repeatRows), -(-width // repeatColumns), 1))[:height, :width]
+
+    reference = np.clip(reference + blackLevels, 0, syntheticWhiteLevel).astype(uint16).reshape(-1)
+    image = np.clip(image + blackLevels, 0, syntheticWhiteLevel).astype(uint16).reshape(-1)
+    return image, reference, exif
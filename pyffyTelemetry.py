@@ -0,0 +1,242 @@
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Iterator
+
+from pyffySettings import PyffySettings
+
+# rates are averaged over this many last files, so they follow throughput changes during long batches
+movingAverageFilesCount = 16
+
+
+class PyffyTelemetry:
+    def __init__(self, prometheusFile: str, jsonFile: str, exportIntervalSeconds: float):
+        self.prometheusFile = prometheusFile
+        self.jsonFile = jsonFile
+        self.exportIntervalSeconds = exportIntervalSeconds
+        self.lock = threading.Lock()
+        self.startTime = time.monotonic()
+        self.lastExportTime = 0.0
+        self.filesDiscovered = 0
+        self.isDiscoveryFinished = False
+        # files taken from the search, and the ones of them which reached processing, the rest were claimed by other instances or failed recovery
+        self.filesTaken = 0
+        self.filesToProcess = 0
+        self.filesCompleted = 0
+        self.filesSkipped = 0
+        self.bytesRead = 0
+        self.bytesWritten = 0
+        self.stageSeconds: dict[str, float] = dict()
+        # (time, bytes) of the last finished files, first item is the start of the averaging window
+        self.recentFiles = deque([(self.startTime, 0)], maxlen = movingAverageFilesCount + 1)
+
+    def getFilesPerSecond(self) -> float:
+        duration = time.monotonic() - self.recentFiles[0][0]
+        return (len(self.recentFiles) - 1) / duration if duration > 0 else 0
+
+    def getBytesPerSecond(self) -> float:
+        duration = time.monotonic() - self.recentFiles[0][0]
+        return sum(bytesCount for _, bytesCount in list(self.recentFiles)[1:]) / duration if duration > 0 else 0
+
+    def getFilesTotal(self) -> int:
+        # files which are not taken from the search yet are expected to be processed
+        return self.filesDiscovered - (self.filesTaken - self.filesToProcess)
+
+    def getEtaSeconds(self) -> float | None:
+        filesPerSecond = self.getFilesPerSecond()
+        if filesPerSecond == 0:
+            return None
+        return max(0, self.getFilesTotal() - self.filesCompleted - self.filesSkipped) / filesPerSecond
+
+    def getStatusLine(self) -> str:
+        etaSeconds = self.getEtaSeconds()
+        eta = "--:--" if etaSeconds is None else "{0:d}:{1:02d}:{2:02d}".format(int(etaSeconds) // 3600, int(etaSeconds) % 3600 // 60, int(etaSeconds) % 60)
+        return "{0}/{1}{2} files, {3} skipped, {4:.2f} files/s, {5:.1f} MB/s, ETA {6}{7}".format(self.filesCompleted + self.filesSkipped,
+                                                                                             self.getFilesTotal(),
+                                                                                             "" if self.isDiscoveryFinished else "+",
+                                                                                             self.filesSkipped,
+                                                                                             self.getFilesPerSecond(),
+                                                                                             self.getBytesPerSecond() / 2 ** 20,
+                                                                                             eta,
+                                                                                             "" if self.isDiscoveryFinished else " (still searching for files)")
+
+    def getMetrics(self) -> dict:
+        etaSeconds = self.getEtaSeconds()
+        return {"filesDiscovered": self.filesDiscovered,
+                "filesTotal": self.getFilesTotal(),
+                "isDiscoveryFinished": self.isDiscoveryFinished,
+                "filesCompleted": self.filesCompleted,
+                "filesSkipped": self.filesSkipped,
+                "bytesRead": self.bytesRead,
+                "bytesWritten": self.bytesWritten,
+                "filesPerSecond": self.getFilesPerSecond(),
+                "bytesPerSecond": self.getBytesPerSecond(),
+                "etaSeconds": etaSeconds,
+                "elapsedSeconds": time.monotonic() - self.startTime,
+                "stageSeconds": dict(self.stageSeconds)}
+
+    def toPrometheusText(self) -> str:
+        metrics = self.getMetrics()
+        lines = []
+        for name, metricType, value in [("files_discovered_total", "counter", metrics["filesDiscovered"]),
+                                        ("files", "gauge", metrics["filesTotal"]),
+                                        ("files_completed_total", "counter", metrics["filesCompleted"]),
+                                        ("files_skipped_total", "counter", metrics["filesSkipped"]),
+                                        ("read_bytes_total", "counter", metrics["bytesRead"]),
+                                        ("written_bytes_total", "counter", metrics["bytesWritten"]),
+                                        ("files_per_second", "gauge", metrics["filesPerSecond"]),
+                                        ("bytes_per_second", "gauge", metrics["bytesPerSecond"]),
+                                        ("eta_seconds", "gauge", -1 if metrics["etaSeconds"] is None else metrics["etaSeconds"]),
+                                        ("elapsed_seconds", "gauge", metrics["elapsedSeconds"])]:
+            lines.append("# TYPE pyffy_{0} {1}".format(name, metricType))
+            lines.append("pyffy_{0} {1}".format(name, value))
+        lines.append("# TYPE pyffy_stage_seconds_total counter")
+        for stageName, seconds in metrics["stageSeconds"].items():
+            lines.append("pyffy_stage_seconds_total{{stage=\"{0}\"}} {1}".format(stageName, seconds))
+        return "\n".join(lines) + "\n"
+
+    def export(self, isForced: bool = False):
+        now = time.monotonic()
+        if not isForced and now - self.lastExportTime < self.exportIntervalSeconds:
+            return
+        self.lastExportTime = now
+        # files are replaced atomically, so node exporter never reads a partially written one
+        if len(self.prometheusFile) != 0:
+            writeFileAtomically(self.prometheusFile, self.toPrometheusText())
+        if len(self.jsonFile) != 0:
+            writeFileAtomically(self.jsonFile, json.dumps(self.getMetrics(), indent = 4))
+
+
+# telemetry of the running batch, None when no batch is running
+telemetry: PyffyTelemetry | None = None
+
+
+def start(settings: PyffySettings):
+    global telemetry
+    telemetry = PyffyTelemetry(settings.advTelemetryPrometheusFile, settings.advTelemetryJsonFile, settings.advTelemetryExportIntervalSeconds)
+
+
+def discoverFilesAhead(dngFiles: Iterator[str]) -> Iterator[str]:
+    # files are searched in a background thread, so the total is known long before processing reaches the last file
+    if telemetry is None:
+        yield from dngFiles
+        return
+    currentTelemetry = telemetry
+    foundFiles = queue.Queue()
+    isStopped = threading.Event()
+
+    def discover():
+        try:
+            for fileName in dngFiles:
+                if isStopped.is_set():
+                    return
+                with currentTelemetry.lock:
+                    currentTelemetry.filesDiscovered += 1
+                foundFiles.put((fileName, None))
+        except Exception as e:
+            foundFiles.put((None, e))
+        finally:
+            currentTelemetry.isDiscoveryFinished = True
+            foundFiles.put((None, None))
+
+    threading.Thread(target = discover, name = "pyffyDiscovery", daemon = True).start()
+    try:
+        while True:
+            fileName, error = foundFiles.get()
+            if error is not None:
+                raise error
+            if fileName is None:
+                return
+            with currentTelemetry.lock:
+                currentTelemetry.filesTaken += 1
+            yield fileName
+    finally:
+        isStopped.set()
+
+
+def countFilesToProcess(dngFiles: Iterator[str]) -> Iterator[str]:
+    for fileName in dngFiles:
+        if telemetry is not None:
+            with telemetry.lock:
+                telemetry.filesToProcess += 1
+        yield fileName
+
+
+def addBytesRead(bytesCount: int):
+    if telemetry is not None:
+        with telemetry.lock:
+            telemetry.bytesRead += bytesCount
+
+
+def addBytesWritten(bytesCount: int):
+    if telemetry is not None:
+        with telemetry.lock:
+            telemetry.bytesWritten += bytesCount
+
+
+@contextmanager
+def stage(stageName: str):
+    # time spent in every stage is summed over the batch, so it shows where the time goes
+    if telemetry is None:
+        yield
+        return
+    currentTelemetry = telemetry
+    startTime = time.perf_counter()
+    try:
+        yield
+    finally:
+        addStageSeconds(currentTelemetry, stageName, time.perf_counter() - startTime)
+
+
+def trackFuture(stageName: str, future: Future):
+    # background work is timed from submission until it is done, so the time includes waiting for a free worker
+    if telemetry is None:
+        return
+    currentTelemetry = telemetry
+    startTime = time.perf_counter()
+    future.add_done_callback(lambda _: addStageSeconds(currentTelemetry, stageName, time.perf_counter() - startTime))
+
+
+def addStageSeconds(currentTelemetry: PyffyTelemetry, stageName: str, seconds: float):
+    with currentTelemetry.lock:
+        currentTelemetry.stageSeconds[stageName] = currentTelemetry.stageSeconds.get(stageName, 0) + seconds
+
+
+def fileCompleted(bytesCount: int):
+    if telemetry is None:
+        return
+    with telemetry.lock:
+        telemetry.filesCompleted += 1
+        telemetry.recentFiles.append((time.monotonic(), bytesCount))
+    print(telemetry.getStatusLine())
+    telemetry.export()
+
+
+def fileSkipped():
+    if telemetry is None:
+        return
+    with telemetry.lock:
+        telemetry.filesSkipped += 1
+    telemetry.export()
+
+
+def finish():
+    global telemetry
+    if telemetry is None:
+        return
+    telemetry.isDiscoveryFinished = True
+    print("Done in {0:.1f} s. {1}".format(time.monotonic() - telemetry.startTime, telemetry.getStatusLine()))
+    telemetry.export(isForced = True)
+    telemetry = None
+
+
+def writeFileAtomically(fileName: str, content: str):
+    tmpFileName = fileName + ".tmp"
+    with open(tmpFileName, "wt") as f:
+        f.write(content)
+    os.replace(tmpFileName, fileName)
@@ -0,0 +1,171 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from numpy import float32, ndarray, uint16
+
+import pyffyArena
+import pyffyCommon
+import pyffyDigest
+import pyffyIOScheduler
+import pyffyStatistics
+from pyffyExif import PyffyExif
+from pyffyIO import PositionalFile
+
+
+class PyffyTileCorrection:
+    def __init__(self, gainRaster: ndarray[float32], area: [int], blackLevelsPattern: ndarray[float32], whiteLevelsPattern: ndarray[float32]):
+        # gainRaster covers area [top, left, bottom, right], given in samples, patterns are anchored to the area origin
+        self.gainRaster = gainRaster
+        self.area = area
+        self.blackLevelsPattern = blackLevelsPattern
+        self.whiteLevelsPattern = whiteLevelsPattern
+
+    def correctBlock(self, block: ndarray[uint16], top: int, left: int) -> ndarray[uint16]:
+        return correctBlock(block, top, left, self)
+
+
+def getTilesAcross(exif: PyffyExif) -> int:
+    return (exif.imageWidth + exif.tileWidth - 1) // exif.tileWidth
+
+
+def getTileRegion(exif: PyffyExif, tileIndex: int) -> (int, int, int, int):
+    tilesAcross = getTilesAcross(exif)
+    top = tileIndex // tilesAcross * exif.tileLength
+    left = tileIndex % tilesAcross * exif.tileWidth
+    return top, left, min(top + exif.tileLength, exif.imageHeight), min(left + exif.tileWidth, exif.imageWidth)
+
+
+def readTile(file: PositionalFile, exif: PyffyExif, tileIndex: int) -> ndarray[uint16]:
+    data = file.readAt(exif.tileOffsets[tileIndex], exif.tileLength * exif.tileWidth * exif.samplesPerPixel * 2)
+    return np.frombuffer(data, dtype = uint16).reshape(exif.tileLength, exif.tileWidth * exif.samplesPerPixel).copy()
+
+
+def readTiledImageData(fileName: str, exif: PyffyExif, executor: ThreadPoolExecutor | None, ioAccess = pyffyIOScheduler.noAccessControl) -> ndarray[uint16]:
+    image = pyffyArena.borrow((exif.imageHeight, exif.imageWidth * exif.samplesPerPixel), uint16)
+    file = PositionalFile(fileName)
+    try:
+        adviseTilesRead(file, exif)
+        if executor is None:
+            for tileIndex in getTilesInFileOrder(exif):
+                readTileIntoImage(file, exif, tileIndex, image, ioAccess)
+            return image.reshape(-1)
+
+        futures = [executor.submit(readTileIntoImage, file, exif, tileIndex, image, ioAccess) for tileIndex in getTilesInFileOrder(exif)]
+        for future in futures:
+            future.result()
+    finally:
+        file.close()
+    return image.reshape(-1)
+
+
+def readTileIntoImage(file: PositionalFile, exif: PyffyExif, tileIndex: int, image: ndarray[uint16], ioAccess = pyffyIOScheduler.noAccessControl):
+    top, left, bottom, right = getTileRegion(exif, tileIndex)
+    with ioAccess(file.fileName, exif.tileLength * exif.tileWidth * exif.samplesPerPixel * 2):
+        tile = readTile(file, exif, tileIndex)
+    samplesPerPixel = exif.samplesPerPixel
+    image[top:bottom, left * samplesPerPixel:right * samplesPerPixel] = tile[:bottom - top, :(right - left) * samplesPerPixel]
+
+
+def getTilesInFileOrder(exif: PyffyExif) -> [int]:
+    # tiles are requested in the order they are placed in the file, so the disk reads forward
+    return sorted(range(len(exif.tileOffsets)), key = lambda tileIndex: exif.tileOffsets[tileIndex])
+
+
+def adviseTilesRead(file: PositionalFile, exif: PyffyExif):
+    if len(exif.tileOffsets) == 0:
+        return
+    start = min(exif.tileOffsets)
+    end = max(exif.tileOffsets) + exif.tileLength * exif.tileWidth * exif.samplesPerPixel * 2
+    file.adviseSequentialRead(start, end - start)
+
+
+def correctTiledFile(sourceFileName: str,
+                     destinationFileName: str,
+                     exif: PyffyExif,
+                     correction: PyffyTileCorrection,
+                     executor: ThreadPoolExecutor,
+                     isDigestComputed: bool = False,
+                     ioAccess = pyffyIOScheduler.noAccessControl) -> list[bytes] | None:
+    # digests of the corrected tiles are returned if requested, file tiles must match NewRawImageDigest tiles for that
+    isInPlace = sourceFileName == destinationFileName
+    sourceFile = PositionalFile(sourceFileName, writable = isInPlace)
+    destinationFile = sourceFile if isInPlace else PositionalFile(destinationFileName, writable = True)
+    try:
+        return correctTiles(sourceFile, destinationFile, exif, correction, executor, isDigestComputed, ioAccess)
+    finally:
+        sourceFile.close()
+        if not isInPlace:
+            destinationFile.close()
+
+
+def correctTiles(sourceFile: PositionalFile,
+                 destinationFile: PositionalFile,
+                 exif: PyffyExif,
+                 correction: PyffyTileCorrection,
+                 executor: ThreadPoolExecutor,
+                 isDigestComputed: bool = False,
+                 ioAccess = pyffyIOScheduler.noAccessControl) -> list[bytes] | None:
+    adviseTilesRead(sourceFile, exif)
+    futures = {tileIndex: executor.submit(correctTile, sourceFile, destinationFile, exif, tileIndex, correction, isDigestComputed, ioAccess) for tileIndex in getTilesInFileOrder(exif)}
+    tileDigests = [futures[tileIndex].result() for tileIndex in range(len(exif.tileOffsets))]
+    return tileDigests if isDigestComputed else None
+
+
+def correctTile(sourceFile: PositionalFile,
+                destinationFile: PositionalFile,
+                exif: PyffyExif,
+                tileIndex: int,
+                correction: PyffyTileCorrection,
+                isDigestComputed: bool = False,
+                ioAccess = pyffyIOScheduler.noAccessControl) -> bytes | None:
+    samplesPerPixel = exif.samplesPerPixel
+    tileTop, tileLeft, tileBottom, tileRight = getTileRegion(exif, tileIndex)
+    imageRowsInTile, imageSamplesInTile = tileBottom - tileTop, (tileRight - tileLeft) * samplesPerPixel
+    tileLeft *= samplesPerPixel
+
+    areaTop, areaLeft, areaBottom, areaRight = correction.area
+    top = max(tileTop, areaTop)
+    left = max(tileLeft, areaLeft)
+    bottom = min(tileTop + exif.tileLength, areaBottom)
+    right = min(tileLeft + exif.tileWidth * samplesPerPixel, areaRight)
+    isTileInArea = top < bottom and left < right
+    if not isTileInArea and not isDigestComputed:
+        return None
+
+    tileBytesCount = exif.tileLength * exif.tileWidth * samplesPerPixel * 2
+    with ioAccess(sourceFile.fileName, tileBytesCount):
+        tile = readTile(sourceFile, exif, tileIndex)
+    if isTileInArea:
+        block = tile[top - tileTop:bottom - tileTop, left - tileLeft:right - tileLeft]
+        tile[top - tileTop:bottom - tileTop, left - tileLeft:right - tileLeft] = correction.correctBlock(block, top - areaTop, left - areaLeft)
+        with ioAccess(destinationFile.fileName, tileBytesCount):
+            destinationFile.writeAt(exif.tileOffsets[tileIndex], tile.tobytes())
+
+    if not isDigestComputed:
+        return None
+    # padding of the edge tiles is not a part of the image
+    return pyffyDigest.getBlockDigest(tile[:imageRowsInTile, :imageSamplesInTile], samplesPerPixel)
+
+
+def correctBlock(block: ndarray[uint16], top: int, left: int, correction: PyffyTileCorrection) -> ndarray[uint16]:
+    height, width = block.shape
+    gain = correction.gainRaster[top:top + height, left:left + width]
+    blackLevels = getPatternBlock(correction.blackLevelsPattern, top, left, height, width)
+    whiteLevels = getPatternBlock(correction.whiteLevelsPattern, top, left, height, width)
+
+    values = np.maximum(block, blackLevels) - blackLevels
+    values *= gain
+    values += blackLevels
+    pyffyStatistics.addBlock(block, gain, values, correction.blackLevelsPattern, correction.whiteLevelsPattern, top, left)
+    np.clip(values, 0, whiteLevels, out = values)
+    return values.astype(uint16)
+
+
+def getPatternBlock(pattern: ndarray[float32], top: int, left: int, height: int, width: int) -> ndarray[float32]:
+    rows = np.arange(top, top + height) % pattern.shape[0]
+    columns = np.arange(left, left + width) % pattern.shape[1]
+    return pattern[np.ix_(rows, columns)]
+
+
+def getLevelsPattern(levels: [int], channelIndexPattern: [[int]]) -> ndarray[float32]:
+    return np.array([[pyffyCommon.getBlackWhiteLevel(levels, channelIndex) for channelIndex in row] for row in channelIndexPattern], dtype = float32)
@@ -0,0 +1,172 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from numpy import ndarray, uint16
+
+import pyffyCommon
+import pyffyIO
+from pyffyExif import PyffyExif
+from pyffySettings import PyffySettings
+
+blurEngines = ["GaussianBlur", "sepFilter2D"]
+bandsPerThreadCandidates = [1, 2, 4]
+benchmarkRunsCount = 2
+# candidates must produce the same output as default configuration
+maxAllowedDifference = 1
+
+profile: "PyffyTuningProfile | None" = None
+isProfileLoaded = False
+executors: dict[int, ThreadPoolExecutor] = dict()
+
+
+class PyffyTuningEntry:
+    def __init__(self, jsonDict: None | dict = None):
+        self.threads: int = 0
+        self.bandsPerThread: int = 1
+        self.blurEngine: str = blurEngines[0]
+        self.seconds: float = 0
+        self.defaultSeconds: float = 0
+
+        if jsonDict is not None:
+            [setattr(self, key, val) for key, val in jsonDict.items() if hasattr(self, key)]
+
+
+class PyffyTuningProfile:
+    def __init__(self, jsonDict: None | dict = None):
+        self.cpuCount: int = 0
+        self.geometries: dict[str, PyffyTuningEntry] = dict()
+
+        if jsonDict is not None:
+            [setattr(self, key, val) for key, val in jsonDict.items() if hasattr(self, key)]
+            self.geometries = {key: PyffyTuningEntry(value) for key, value in dict(self.geometries).items()}
+
+
+def getGeometryKey(geometry: (int, int, int)) -> str:
+    return "{0}x{1}x{2}".format(*geometry)
+
+
+def load() -> PyffyTuningProfile | None:
+    global profile, isProfileLoaded
+    isProfileLoaded = True
+    profileJson = pyffyIO.readTuningProfile()
+    if profileJson is None:
+        return None
+
+    try:
+        loadedProfile = PyffyTuningProfile(json.loads(profileJson))
+    except:
+        print("File {0} could not be parsed, default tuning is used.".format(pyffyIO.tuningProfileFileName))
+        return None
+
+    # profile measured on another machine does not say anything about this one
+    if loadedProfile.cpuCount != pyffyCommon.cpuCount:
+        print("File {0} was created for {1} CPUs, {2} are available now. Default tuning is used, please run pyffyAutotune.py again.".format(pyffyIO.tuningProfileFileName, loadedProfile.cpuCount, pyffyCommon.cpuCount))
+        return None
+
+    print("Tuning profile for {0} geometries is loaded".format(len(loadedProfile.geometries)))
+    profile = loadedProfile
+    return profile
+
+
+def apply(geometry: (int, int, int), defaultExecutor: ThreadPoolExecutor) -> ThreadPoolExecutor:
+    # returns executor to be used for the file, module settings of pyffyCommon are set for its geometry
+    if not isProfileLoaded:
+        load()
+
+    entry = None if profile is None else profile.geometries.get(getGeometryKey(geometry))
+    if entry is None or entry.threads == 0:
+        pyffyCommon.tunedParallelism = None
+        pyffyCommon.blurEngine = blurEngines[0]
+        return defaultExecutor
+
+    pyffyCommon.tunedParallelism = entry.threads * entry.bandsPerThread
+    pyffyCommon.blurEngine = entry.blurEngine
+    return getExecutor(entry.threads)
+
+
+def getExecutor(threads: int) -> ThreadPoolExecutor:
+    executor = executors.get(threads)
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers = threads)
+        executors[threads] = executor
+    return executor
+
+
+def shutdown():
+    for executor in executors.values():
+        executor.shutdown()
+    executors.clear()
+
+
+def tune(referenceFiles: dict[str, (object, PyffyExif)], settings: PyffySettings) -> PyffyTuningProfile:
+    # referenceFiles are (pipeline, exif) of one reference file per channels geometry
+    tunedProfile = PyffyTuningProfile()
+    tunedProfile.cpuCount = pyffyCommon.cpuCount
+    for geometryKey, (pipeline, exif) in referenceFiles.items():
+        print("Tuning {0}".format(geometryKey))
+        tunedProfile.geometries[geometryKey] = tuneGeometry(pipeline, exif, settings)
+    return tunedProfile
+
+
+def tuneGeometry(pipeline, exif: PyffyExif, settings: PyffySettings) -> PyffyTuningEntry:
+    # synthetic image of the camera geometry, content does not change the speed of any stage
+    random = np.random.default_rng(0)
+    blackLevel = pyffyCommon.getMinBlackWhiteLevel(exif.blackLevels)
+    whiteLevel = pyffyCommon.getMaxBlackWhiteLevel(exif.whiteLevels) if len(exif.whiteLevels) != 0 else 65535
+    reference = random.integers(blackLevel + (whiteLevel - blackLevel) // 2, whiteLevel, exif.imageHeight * exif.imageWidth * max(1, exif.samplesPerPixel), dtype = uint16)
+    image = random.integers(blackLevel, whiteLevel, reference.size, dtype = uint16)
+
+    defaultExecutor = ThreadPoolExecutor(max_workers = pyffyCommon.cpuCount)
+    try:
+        defaultSeconds, defaultOutput = measure(pipeline, image, reference, exif, settings, defaultExecutor, None, blurEngines[0])
+    finally:
+        defaultExecutor.shutdown()
+    print("  default: {0:.3f} s".format(defaultSeconds))
+
+    cpuCount = pyffyCommon.cpuCount
+    best = PyffyTuningEntry()
+    best.defaultSeconds = defaultSeconds
+    best.seconds = float("inf")
+    for threads in sorted({max(1, cpuCount // 2), cpuCount}):
+        executor = ThreadPoolExecutor(max_workers = threads)
+        try:
+            for bandsPerThread in bandsPerThreadCandidates:
+                for blurEngine in blurEngines:
+                    seconds, output = measure(pipeline, image, reference, exif, settings, executor, threads * bandsPerThread, blurEngine)
+                    difference = int(np.max(np.abs(output.astype(np.int32) - defaultOutput.astype(np.int32))))
+                    print("  {0} threads, {1} bands per thread, {2}: {3:.3f} s{4}".format(threads, bandsPerThread, blurEngine, seconds, "" if difference <= maxAllowedDifference else ", rejected, output differs by {0} DN".format(difference)))
+                    if difference <= maxAllowedDifference and seconds < best.seconds:
+                        best.threads, best.bandsPerThread, best.blurEngine, best.seconds = threads, bandsPerThread, blurEngine, seconds
+        finally:
+            executor.shutdown()
+
+    if best.seconds >= defaultSeconds:
+        # threads 0 keeps the default executor and bands
+        best.threads, best.bandsPerThread, best.blurEngine, best.seconds = 0, 1, blurEngines[0], defaultSeconds
+        print("  fastest: default")
+        return best
+
+    print("  fastest: {0} threads, {1} bands per thread, {2}, {3:.3f} s, {4:.0f}% of default time".format(best.threads, best.bandsPerThread, best.blurEngine, best.seconds, best.seconds / defaultSeconds * 100))
+    return best
+
+
+def measure(pipeline, image: ndarray[uint16], reference: ndarray[uint16], exif: PyffyExif, settings: PyffySettings, executor: ThreadPoolExecutor, parallelism: int | None, blurEngine: str) -> (float, ndarray[uint16]):
+    pyffyCommon.tunedParallelism = parallelism
+    pyffyCommon.blurEngine = blurEngine
+    try:
+        # first run warms up OpenCV and the allocator, best of the rest is taken
+        seconds = float("inf")
+        output = None
+        for i in range(benchmarkRunsCount + 1):
+            referenceCopy, imageCopy = reference.copy(), image.copy()
+            startTime = time.perf_counter()
+            referenceChannels = pipeline.prepareReference(referenceCopy, exif, exif, settings, executor)
+            output = pipeline.correct(imageCopy, referenceChannels, exif, settings, executor)
+            if i != 0:
+                seconds = min(seconds, time.perf_counter() - startTime)
+        return seconds, np.asarray(output).reshape(-1)
+    finally:
+        pyffyCommon.tunedParallelism = None
+        pyffyCommon.blurEngine = blurEngines[0]
@@ -2,9 +2,11 @@ import sys
 
 import pyffy
 
-if len(sys.argv) == 1:
-    pyffy.twoPasses(processFilesInSubfolders = True, workingPath = u".")
-elif len(sys.argv) == 2:
-    pyffy.twoPasses(processFilesInSubfolders = True, workingPath = sys.argv[1])
+arguments, shard = pyffy.extractShardArgument(sys.argv[1:])
+arguments, isProof = pyffy.extractProofArgument(arguments)
+if len(arguments) == 0:
+    pyffy.twoPasses(processFilesInSubfolders = True, workingPath = u".", shard = shard, isProof = isProof)
+elif len(arguments) == 1:
+    pyffy.twoPasses(processFilesInSubfolders = True, workingPath = arguments[0], shard = shard, isProof = isProof)
 else:
     pyffy.exitWithPrompt("Only one folder can be provided to this script. Exiting now.")
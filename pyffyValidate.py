@@ -0,0 +1,53 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pyffy
+import pyffyCommon
+import pyffyExif
+import pyffySynthetic
+import pyffyValidation
+
+parser = argparse.ArgumentParser(description = "Compares output of fast correction modes with the reference implementation")
+parser.add_argument("files", nargs = "*", help = "image and reference dng files, synthetic images are used if omitted")
+parser.add_argument("--modes", default = ",".join(pyffyValidation.validationModes), help = "comma separated modes to compare")
+parser.add_argument("--megapixels", type = float, default = 24, help = "size of synthetic images")
+parser.add_argument("--json", help = "file to save the reports to")
+arguments = parser.parse_args()
+
+if len(arguments.files) not in [0, 2]:
+    pyffy.exitWithPrompt("Either both image and reference files or none of them must be provided.")
+
+settings = pyffy.loadSettingsOrDefault()
+modes = arguments.modes.split(",")
+executor = ThreadPoolExecutor() if settings.useMultithreading else None
+reports = []
+
+if len(arguments.files) == 2:
+    imageFile, referenceFile = arguments.files
+    exif = pyffyExif.getExif(imageFile)
+    referenceExif = pyffyExif.getExif(referenceFile)
+    if exif is None or referenceExif is None or not pyffyExif.isFileAndReferenceCompatible(exif, referenceExif):
+        pyffy.exitWithPrompt("Image and reference files can not be read or are not compatible.")
+    image = pyffy.readImageData(imageFile, exif, executor)
+    reference = pyffy.readImageData(referenceFile, referenceExif, executor)
+    reports.append(pyffyValidation.validate(Path(imageFile).name, image, reference, exif, referenceExif, settings, modes, executor))
+else:
+    height = int((arguments.megapixels * 1e6 / 1.5) ** 0.5) // 2 * 2
+    width = int(height * 1.5) // 2 * 2
+    for kind in pyffySynthetic.syntheticKinds:
+        for syntheticHeight, syntheticWidth in pyffySynthetic.getSyntheticSizes(height, width):
+            image, reference, exif = pyffySynthetic.createSyntheticPair(kind, syntheticHeight, syntheticWidth)
+            reports.append(pyffyValidation.validate("synthetic_{0}_{1}x{2}".format(kind, syntheticWidth, syntheticHeight), image, reference, exif, exif, settings, modes, executor))
+
+if executor is not None:
+    executor.shutdown()
+
+for report in reports:
+    print(report.fileName)
+    print(report.toTable())
+    print("")
+
+if arguments.json is not None:
+    with open(arguments.json, "wt") as f:
+        f.write(pyffyCommon.dictToJson(reports))
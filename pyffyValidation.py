@@ -0,0 +1,219 @@
+import math
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from numpy import float64, int32, ndarray, uint16
+
+import pyffy
+import pyffyCommon
+import pyffyFixedPoint
+import pyffyGainMapStore
+import pyffyMemory
+import pyffyModel
+import pyffyOpcodes
+import pyffyTiles
+from pyffyExif import PyffyExif
+from pyffySettings import PyffySettings
+
+referenceModeName = "reference"
+tiledModeBlockLength = 256
+
+
+class PyffyValidationResult:
+    def __init__(self, mode: str):
+        self.mode = mode
+        self.maxAbsDifference: int = 0
+        self.meanAbsDifference: float = 0
+        # None when the output is identical to the reference one
+        self.psnr: float | None = None
+        self.differentBy1DNShare: float = 0
+        self.highlightsClippedDelta: int = 0
+        self.shadowsClippedDelta: int = 0
+        self.wallTime: float = 0
+        self.peakMemoryBytes: int = 0
+
+
+class PyffyValidationReport:
+    def __init__(self, fileName: str):
+        self.fileName = fileName
+        self.results: [PyffyValidationResult] = []
+
+    def toTable(self) -> str:
+        lines = ["{0:<18}{1:>9}{2:>11}{3:>10}{4:>10}{5:>12}{6:>12}{7:>10}{8:>11}".format("mode", "max, DN", "mean, DN", "PSNR, dB", ">1 DN, %", "clip. high", "clip. low", "time, s", "peak, MB")]
+        for result in self.results:
+            psnr = "inf" if result.psnr is None else "{0:.2f}".format(result.psnr)
+            lines.append("{0:<18}{1:>9}{2:>11.4f}{3:>10}{4:>10.4f}{5:>12}{6:>12}{7:>10.3f}{8:>11.1f}".format(result.mode,
+                                                                                                            result.maxAbsDifference,
+                                                                                                            result.meanAbsDifference,
+                                                                                                            psnr,
+                                                                                                            result.differentBy1DNShare * 100,
+                                                                                                            result.highlightsClippedDelta,
+                                                                                                            result.shadowsClippedDelta,
+                                                                                                            result.wallTime,
+                                                                                                            result.peakMemoryBytes / 2 ** 20))
+        return "\n".join(lines)
+
+
+# every mode is a pair of functions, prepare does the work that is done once per reference file (i.e. by pyffyCreateReferenceDB.py) and is not measured,
+# run does the per image work and returns corrected image
+def prepareRawReference(reference: ndarray[uint16], exif: PyffyExif, referenceExif: PyffyExif, settings: PyffySettings, executor: ThreadPoolExecutor | None):
+    return reference
+
+
+def runReferenceMode(image: ndarray[uint16], prepared, exif: PyffyExif, referenceExif: PyffyExif, settings: PyffySettings, executor: ThreadPoolExecutor | None) -> ndarray[uint16]:
+    return pyffy.getPipeline(exif).process(image, prepared, exif, referenceExif, settings, executor)
+
+
+def prepareVignettingModelMode(reference: ndarray[uint16], exif: PyffyExif, referenceExif: PyffyExif, settings: PyffySettings, executor: ThreadPoolExecutor | None):
+    pipeline = pyffy.getPipeline(exif)
+    _, height, width = pipeline.getChannelsGeometry(exif)
+    referenceChannels = pipeline.prepareReference(reference, exif, referenceExif, settings, executor)
+    return pyffyModel.fitModel(referenceChannels, height, width, settings.advVignettingModelDegree, settings.advGaussianFilterSigma)
+
+
+def runVignettingModelMode(image: ndarray[uint16], prepared, exif: PyffyExif, referenceExif: PyffyExif, settings: PyffySettings, executor: ThreadPoolExecutor | None) -> ndarray[uint16]:
+    pipeline = pyffy.getPipeline(exif)
+    _, height, width = pipeline.getChannelsGeometry(exif)
+    referenceChannels = pyffyModel.evaluateModel(prepared, height, width)
+    return pipeline.correct(image, referenceChannels, exif, settings, executor)
+
+
+def prepareGainMapStoreMode(reference: ndarray[uint16], exif: PyffyExif, referenceExif: PyffyExif, settings: PyffySettings, executor: ThreadPoolExecutor | None):
+    pipeline = pyffy.getPipeline(exif)
+    referenceChannels = pipeline.prepareReference(reference, exif, referenceExif, settings, executor)
+    return pyffyGainMapStore.downsampleChannels(referenceChannels, pipeline.getChannelsGeometry(exif), settings.advGainMapDownsampleFactor)
+
+
+def runGainMapStoreMode(image: ndarray[uint16], prepared, exif: PyffyExif, referenceExif: PyffyExif, settings: PyffySettings, executor: ThreadPoolExecutor | None) -> ndarray[uint16]:
+    pipeline = pyffy.getPipeline(exif)
+    referenceChannels = pyffyGainMapStore.upsampleChannels(prepared, pipeline.getChannelsGeometry(exif))
+    return pipeline.correct(image, referenceChannels, exif, settings, executor)
+
+
+def runTiledMode(image: ndarray[uint16], prepared, exif: PyffyExif, referenceExif: PyffyExif, settings: PyffySettings, executor: ThreadPoolExecutor | None) -> ndarray[uint16]:
+    # same math as pyffyTiles.correctTiledFile, applied to the image in memory in blocks of tile height
+    pipeline = pyffy.getPipeline(exif)
+    referenceChannels = pipeline.prepareReference(prepared, exif, referenceExif, settings, executor)
+    correction = pipeline.getTileCorrection(referenceChannels, exif, settings, executor)
+    return correctImageBlocks(image, exif, correction, executor)
+
+
+def correctImageBlocks(image: ndarray[uint16], exif: PyffyExif, correction: pyffyTiles.PyffyTileCorrection, executor: ThreadPoolExecutor | None) -> ndarray[uint16]:
+    image = image.reshape(exif.imageHeight, -1)
+    areaTop, areaLeft, areaBottom, areaRight = correction.area
+    blocks = [(top, min(top + tiledModeBlockLength, areaBottom)) for top in range(areaTop, areaBottom, tiledModeBlockLength)]
+    if executor is None:
+        for top, bottom in blocks:
+            correctImageBlock(image, top, bottom, correction)
+    else:
+        pyffyCommon.waitForAll([executor.submit(correctImageBlock, image, top, bottom, correction) for top, bottom in blocks])
+    return image.reshape(-1)
+
+
+def correctImageBlock(image: ndarray[uint16], top: int, bottom: int, correction: pyffyTiles.PyffyTileCorrection):
+    areaTop, areaLeft, _, areaRight = correction.area
+    image[top:bottom, areaLeft:areaRight] = correction.correctBlock(image[top:bottom, areaLeft:areaRight], top - areaTop, 0)
+
+
+def prepareFixedPointMode(reference: ndarray[uint16], exif: PyffyExif, referenceExif: PyffyExif, settings: PyffySettings, executor: ThreadPoolExecutor | None):
+    # fixed point gains are prepared once per reference and reused for all files which share it
+    pipeline = pyffy.getPipeline(exif)
+    referenceChannels = pipeline.prepareReference(reference, exif, referenceExif, settings, executor)
+    return pyffyFixedPoint.PyffyFixedPointCorrection(pipeline.getTileCorrection(referenceChannels, exif, settings, executor))
+
+
+def runFixedPointMode(image: ndarray[uint16], prepared, exif: PyffyExif, referenceExif: PyffyExif, settings: PyffySettings, executor: ThreadPoolExecutor | None) -> ndarray[uint16]:
+    return pyffyFixedPoint.correctImage(image, exif, prepared, executor).reshape(-1)
+
+
+def runGainMapOpcodeMode(image: ndarray[uint16], prepared, exif: PyffyExif, referenceExif: PyffyExif, settings: PyffySettings, executor: ThreadPoolExecutor | None) -> ndarray[uint16]:
+    # gain maps are interpolated back the way a raw converter applies them, difference shows what the map density loses
+    pipeline = pyffy.getPipeline(exif)
+    referenceChannels = pipeline.prepareReference(prepared, exif, referenceExif, settings, executor)
+    correction = pipeline.getTileCorrection(referenceChannels, exif, settings, executor)
+    opcodes = pyffyOpcodes.getGainMapOpcodes(correction, exif, settings.advGainMapOpcodePoints)
+    correction.gainRaster = pyffyOpcodes.renderGainRaster(opcodes, correction, exif.samplesPerPixel)
+    return correctImageBlocks(image, exif, correction, executor)
+
+
+validationModes = {referenceModeName: (prepareRawReference, runReferenceMode),
+                   "vignettingModel": (prepareVignettingModelMode, runVignettingModelMode),
+                   "gainMapStore": (prepareGainMapStoreMode, runGainMapStoreMode),
+                   "tiled": (prepareRawReference, runTiledMode),
+                   "fixedPoint": (prepareFixedPointMode, runFixedPointMode),
+                   "gainMapOpcode": (prepareRawReference, runGainMapOpcodeMode)}
+
+
+def validate(fileName: str,
+             image: ndarray[uint16],
+             reference: ndarray[uint16],
+             exif: PyffyExif,
+             referenceExif: PyffyExif,
+             settings: PyffySettings,
+             modes: [str],
+             executor: ThreadPoolExecutor | None) -> PyffyValidationReport:
+    report = PyffyValidationReport(fileName)
+    referenceOutput = None
+    for mode in [referenceModeName] + [mode for mode in modes if mode != referenceModeName]:
+        if mode not in validationModes:
+            print("Unknown validation mode {0}, available modes are: {1}".format(mode, ", ".join(validationModes)))
+            continue
+
+        output, wallTime, peakMemoryBytes = runMode(mode, image, reference, exif, referenceExif, settings, executor)
+        if referenceOutput is None:
+            referenceOutput = output
+
+        result = compare(mode, referenceOutput, output, exif, settings)
+        result.wallTime = wallTime
+        result.peakMemoryBytes = peakMemoryBytes
+        report.results.append(result)
+
+    return report
+
+
+def runMode(mode: str,
+            image: ndarray[uint16],
+            reference: ndarray[uint16],
+            exif: PyffyExif,
+            referenceExif: PyffyExif,
+            settings: PyffySettings,
+            executor: ThreadPoolExecutor | None) -> (ndarray[uint16], float, int):
+    prepare, run = validationModes[mode]
+    prepared = prepare(np.copy(reference), exif, referenceExif, settings, executor)
+
+    # time is measured without tracing, because tracemalloc slows allocations down
+    imageCopy = np.copy(image)
+    startTime = time.perf_counter()
+    output = run(imageCopy, prepared, exif, referenceExif, settings, executor)
+    wallTime = time.perf_counter() - startTime
+
+    isTracing = tracemalloc.is_tracing()
+    imageCopy = np.copy(image)
+    pyffyMemory.startFile(mode)
+    run(imageCopy, prepared, exif, referenceExif, settings, executor)
+    pyffyMemory.markStage("finish")
+    memoryReport = pyffyMemory.finishFile(None, 0)
+    if not isTracing:
+        tracemalloc.stop()
+
+    return np.copy(output.reshape(-1)), wallTime, max(stage.peakBytes for stage in memoryReport.stages)
+
+
+def compare(mode: str, referenceOutput: ndarray[uint16], output: ndarray[uint16], exif: PyffyExif, settings: PyffySettings) -> PyffyValidationResult:
+    result = PyffyValidationResult(mode)
+    difference = np.abs(output.astype(int32) - referenceOutput.astype(int32))
+    result.maxAbsDifference = int(np.max(difference))
+    result.meanAbsDifference = float(np.mean(difference, dtype = float64))
+    result.differentBy1DNShare = float(np.count_nonzero(difference > 1) / difference.size)
+
+    blackLevel = pyffyCommon.getMaxBlackWhiteLevel(exif.blackLevels)
+    whiteLevel = pyffyCommon.getMinBlackWhiteLevel(exif.whiteLevels) if settings.advLimitToWhiteLevels and len(exif.whiteLevels) != 0 else 65535
+    meanSquaredError = float(np.mean(np.square(difference, dtype = float64)))
+    if meanSquaredError != 0:
+        result.psnr = 10 * math.log10(max(1, whiteLevel - blackLevel) ** 2 / meanSquaredError)
+
+    result.highlightsClippedDelta = int(np.count_nonzero(output >= whiteLevel)) - int(np.count_nonzero(referenceOutput >= whiteLevel))
+    result.shadowsClippedDelta = int(np.count_nonzero(output <= blackLevel)) - int(np.count_nonzero(referenceOutput <= blackLevel))
+    return result